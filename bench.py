@@ -0,0 +1,68 @@
+"""
+Evaluation benchmark, translated with and without the JIT by `make bench`.
+
+    bin/bench file.m [repeat]
+
+parses the file once and evaluates the expression `repeat` times against
+the same definitions, then prints the total evaluation time in seconds.
+"""
+import os
+import sys
+import time
+
+from rmathics.parser import parse
+from rmathics.evaluation import evaluate, Evaluation
+from rmathics.definitions import Definitions
+
+
+def read_contents(filename):
+    fp = os.open(filename, os.O_RDONLY, 0o777)
+    contents = ''
+    while True:
+        read = os.read(fp, 4096)
+        if len(read) == 0:
+            break
+        contents += read
+    os.close(fp)
+    return contents
+
+
+def entry_point(argv):
+    if len(argv) not in (2, 3):
+        os.write(2, 'usage: %s file.m [repeat]\n' % argv[0])
+        return 1
+    repeat = 1
+    if len(argv) == 3:
+        repeat = int(argv[2])
+
+    expr, messages = parse(read_contents(argv[1]), Definitions())
+    if expr is None or messages:
+        os.write(2, 'could not parse %s\n' % argv[1])
+        return 1
+
+    # one Definitions throughout, so that its version stays the same and
+    # the JIT can fold the lookups keyed on it. Repetitions after the first
+    # may find results in its cache.
+    definitions = Definitions()
+    result = expr
+    start = time.time()
+    for i in range(repeat):
+        result = evaluate(expr, Evaluation(definitions))
+    elapsed = time.time() - start
+
+    os.write(1, '%s\n' % result.repr())
+    os.write(1, '%d evaluations in %f s\n' % (repeat, elapsed))
+    return 0
+
+
+def target(*args):
+    return entry_point, None
+
+
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
+
+if __name__ == "__main__":
+    entry_point(sys.argv)
@@ -2,15 +2,21 @@ import os
 import sys
 
 from rpython.rtyper.lltypesystem import rffi
+from rpython.rlib import rsignal
 
 from rmathics.parser import parse, WaitInputError
-from rmathics.evaluation import evaluate
+from rmathics.evaluation import evaluate, Evaluation, Interrupts
 from rmathics.definitions import Definitions
+from rmathics.printer import fullform
+from rmathics.profiler import profiler
 from rmathics.kernel import rzmq, rjson, rlogging
 
 
 rlogging.basicConfig(level=rlogging.INFO)
 
+# results longer than this (in characters) are elided before being sent
+OUTPUT_LIMIT = 1 << 20
+
 
 def read_contents(filename):
     fp = os.open(filename, os.O_RDONLY, 0o777)
@@ -24,6 +30,33 @@ def read_contents(filename):
     return contents
 
 
+class KernelInterrupts(Interrupts):
+    """
+    aborts evaluation on SIGINT or on an interrupt_request sent to the
+    control socket
+    """
+    def __init__(self, connection):
+        Interrupts.__init__(self)
+        self.connection = connection
+
+    def poll(self):
+        while True:
+            signum = rsignal.pypysig_poll()
+            if signum == -1:
+                break
+            if signum == rsignal.SIGINT:
+                self.abort()
+        self.connection.poll_control(0)
+
+    def reset(self):
+        """
+        drop requests which arrived while no evaluation was running
+        """
+        self.poll()
+        self.requested = False
+        self.aborted = False
+
+
 class Connection(object):
     def __init__(self, contents):
         contents = contents.strip()
@@ -66,6 +99,7 @@ class Connection(object):
                 raise ValueError("Unknown value type %s" % value)
         self.execution_count = 1
         self.definitions = Definitions()
+        self.interrupts = KernelInterrupts(self)
 
     @staticmethod
     def lrstrip1(s):
@@ -93,6 +127,9 @@ class Connection(object):
         self.control = rzmq.socket(self.ctx, rzmq.ROUTER)
         rc = rzmq.bind(self.control, base_endpoint + '%s' % self.control_port)
         assert rc == 0
+        self.control_pollitem = rffi.lltype.malloc(rzmq.pollitem_t, flavor='raw')
+        self.control_pollitem.c_socket = self.control
+        self.control_pollitem.c_events = rffi.r_short(rzmq.POLLIN)
 
         self.stdin = rzmq.socket(self.ctx, rzmq.ROUTER)
         rc = rzmq.bind(self.stdin, base_endpoint + '%s' % self.stdin_port)
@@ -168,11 +205,7 @@ class Connection(object):
                     request[0], request[3], '{"execution_state":"idle"}', 'status'))
 
             # Control
-            pollitem.c_socket = self.control
-            while rzmq.poll(pollitem, rffi.r_int(1), rffi.r_long(1)) > 0:
-                rlogging.debug('control message')
-                request = self.msg_recv(self.control)
-                self.control_msg(request)
+            self.poll_control(1)
 
             # HB
             pollitem.c_socket = self.hb
@@ -181,10 +214,30 @@ class Connection(object):
                 request = self.msg_recv(self.hb)
                 self.hb_msg(request)
 
+    def poll_control(self, timeout):
+        """
+        respond to any messages on the control socket
+
+        this is also called from the evaluator (see KernelInterrupts) so that
+        interrupts are seen while an evaluation is running
+        """
+        while rzmq.poll(self.control_pollitem, rffi.r_int(1),
+                        rffi.r_long(timeout)) > 0:
+            rlogging.debug('control message')
+            request = self.msg_recv(self.control)
+            self.control_msg(request)
+
     def control_msg(self, request):
         header = rjson.loads(request[3])
         msg_type = header['msg_type']._str
-        rlogging.warn("Ignoring msg %s" % msg_type)
+        if msg_type == 'interrupt_request':
+            self.interrupts.abort()
+            response = self.construct_message(request[0], request[3],
+                                              '{"status":"ok"}',
+                                              'interrupt_reply')
+            self.msg_send(self.control, response)
+        else:
+            rlogging.warn("Ignoring msg %s" % msg_type)
 
     def hb_msg(self, request):
         self.msg_send(self.hb, request)
@@ -219,8 +272,13 @@ class Connection(object):
 
             # Evaluate
             if expr is not None:
-                result, messages = evaluate(expr, self.definitions)
-                for message in messages:
+                self.interrupts.reset()
+                evaluation = Evaluation(self.definitions, self.interrupts)
+                result = evaluate(expr, evaluation)
+                if profiler.enabled:
+                    rlogging.info('profile:\n' + profiler.dump())
+                rlogging.debug(self.definitions.cache.stats())
+                for message in evaluation.messages:
                     error = rjson.JDict({       # FIXME
                         "ename": rjson.JStr(message[0]),
                         "evalue": rjson.JStr(message[1]),
@@ -232,15 +290,19 @@ class Connection(object):
 
                 execute_result = rjson.JDict({
                     "execution_count": rjson.JInt(self.execution_count),
-                    "data": rjson.JDict({'text/plain': rjson.JStr(result.repr())}),
+                    "data": rjson.JDict({'text/plain': rjson.JStr(fullform(result, OUTPUT_LIMIT))}),
                     "metadata": rjson.JDict({}),
                 }).dumps()
                 result_response = self.construct_message(
                     request[0], request[3], execute_result, 'execute_result')
                 self.msg_send(self.iopub, result_response)
 
+                if self.interrupts.aborted:
+                    status = "aborted"
+                else:
+                    status = "ok"
                 execute_reply = rjson.JDict({
-                    "status": rjson.JStr("ok"),
+                    "status": rjson.JStr(status),
                     "execution_count": rjson.JInt(self.execution_count),
                     "user_expressions": rjson.JDict({}),
                     "payload": rjson.JList([]),
@@ -302,6 +364,9 @@ def entry_point(argv):
     except ValueError:
         return 1
     connection.bind()
+    # SIGINT (sent by the frontend to interrupt) aborts the evaluation rather
+    # than killing the kernel
+    rsignal.pypysig_setflag(rsignal.SIGINT)
 
     rlogging.info(str((
         connection.control_port, connection.shell_port, connection.transport,
@@ -316,5 +381,10 @@ def target(*args):
     return entry_point, None
 
 
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
+
 if __name__ == "__main__":
     entry_point(sys.argv)
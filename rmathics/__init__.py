@@ -1,3 +1,4 @@
 from .expression import (
-    Expression, Symbol, String, Number, Integer, Real, Complex, Rational)
+    Expression, Symbol, String, Number, Integer, MachineInteger, BigInteger,
+    Real, Complex, Rational)
 from .version import __version__
@@ -0,0 +1,105 @@
+"""
+A bounded cache of evaluation results.
+
+The evaluator remembers the results of numeric function calls on numbers,
+such as Plus[1, 2], so that each distinct one is evaluated once per session
+rather than once per occurrence. Keys are compared structurally (hash, then
+`identical`), so equal subexpressions share an entry even when they are
+different objects, but Reals only do so if their values and precisions are
+exactly equal.
+
+The cache holds at most `capacity` entries and evicts the least recently
+used one when it is full. Every entry is only valid under the
+`Definitions.version` it was stored with: the first lookup or store under a
+new version empties the cache.
+"""
+
+from rmathics.expression import expression_dict_factory
+
+# results keyed by the cached call
+_new_entry_dict = expression_dict_factory()
+
+
+class _Entry(object):
+    """
+    a cached result, linked into the recency list
+    """
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.prev = self
+        self.next = self
+
+
+class EvaluationCache(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = _new_entry_dict()
+        # sentinel of a circular list, from most (next) to least (prev)
+        # recently used
+        self.recent = _Entry(None, None)
+        self.version = -1
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries = _new_entry_dict()
+        self.recent.prev = self.recent
+        self.recent.next = self.recent
+
+    def validate(self, version):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def lookup(self, key, version, count_miss=True):
+        """
+        the result stored for `key`, or None
+        """
+        self.validate(version)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            if count_miss:
+                self.misses += 1
+            return None
+        self.hits += 1
+        self.unlink(entry)
+        self.link(entry)
+        return entry.value
+
+    def store(self, key, value, version):
+        self.validate(version)
+        if self.capacity <= 0:
+            return
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            entry.value = value
+            self.unlink(entry)
+            self.link(entry)
+            return
+        if len(self.entries) >= self.capacity:
+            oldest = self.recent.prev
+            self.unlink(oldest)
+            del self.entries[oldest.key]
+            self.evictions += 1
+        entry = _Entry(key, value)
+        self.entries[key] = entry
+        self.link(entry)
+
+    def link(self, entry):
+        entry.prev = self.recent
+        entry.next = self.recent.next
+        self.recent.next.prev = entry
+        self.recent.next = entry
+
+    def unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def stats(self):
+        return 'cache: %d entries, %d hits, %d misses, %d evictions' % (
+            len(self.entries), self.hits, self.misses, self.evictions)
@@ -3,10 +3,12 @@ A collection of functions for converting between atomic types
 """
 
 from rpython.rtyper.lltypesystem import rffi
+from rpython.rlib.rarithmetic import string_to_int
+from rpython.rlib.rstring import ParseStringOverflowError
 
-from rmathics import Integer, Rational, Real
+from rmathics import MachineInteger, BigInteger, Rational, Real
 from rmathics.gmp import (
-    c_mpz_set_si, c_mpz_set_str, c_mpz_ui_pow_ui, c_mpz_mul,
+    c_mpz_set_str, c_mpz_ui_pow_ui, c_mpz_mul,
     c_mpq_set_si, c_mpq_set_str, c_mpq_set_d, c_mpq_canonicalize,
     c_mpf_set_str, c_mpf_set_d,
 )
@@ -14,20 +16,23 @@ from rmathics.gmp import (
 
 def int2Integer(value):
     assert isinstance(value, int)
-    result = Integer()
-    c_mpz_set_si(result.value, rffi.r_long(value))
-    return result
+    return MachineInteger(value)
 
 
 def str2Integer(value, base=10):
     assert isinstance(value, str)
     assert 2 <= base <= 62
-    result = Integer()
+    if base <= 36:
+        try:
+            return MachineInteger(string_to_int(value, base))
+        except ParseStringOverflowError:
+            pass
+    result = BigInteger()
     p = rffi.str2charp(value)
     retcode = c_mpz_set_str(result.value, p, rffi.r_int(base))
     assert retcode == 0
     rffi.free_charp(p)
-    return result
+    return result.normalize()
 
 
 def int2Rational(num, den):
@@ -82,8 +87,11 @@ def float2Real(value, prec):
 
 def _mul_pow(value, base, exp):
     """
-    Multiplies a given mpz by base^exp
+    Multiplies a given Integer by base^exp
     """
-    factor = Integer()
+    result = BigInteger()
+    value.to_mpz(result.value)
+    factor = BigInteger()
     c_mpz_ui_pow_ui(factor.value, base, exp)
-    c_mpz_mul(value, value, factor.value)
+    c_mpz_mul(result.value, result.value, factor.value)
+    return result.normalize()
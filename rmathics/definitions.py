@@ -1,12 +1,24 @@
 # from __future__ import unicode_literals
 
+from rpython.rlib import jit
+
 from rmathics.expression import (
     BaseExpression, Expression, Symbol, String, fully_qualified_symbol_name,
-    Integer, Rational, Real,
+    Integer, MachineInteger, Rational, Real, add_integers,
+    SymbolList, SymbolSequence, SymbolPattern, SymbolBlank,
+    SymbolBlankSequence, SymbolBlankNullSequence,
+    SymbolHoldPattern, SymbolRule, SymbolRuleDelayed, SymbolPlus,
+    SymbolInteger, SymbolRational, SymbolReal, SymbolEvaluate, SymbolNull,
+    machine_real,
 )
 from rmathics.rpython_util import all
-from rmathics.convert import int2Integer, int2Rational, float2Real
-from rmathics.gmp import c_mpz_add, c_mpq_add, c_mpf_add, c_mpq_set_z, c_mpf_set_z, c_mpf_set_q
+from rmathics.convert import int2Rational, float2Real
+from rmathics.gmp import c_mpq_add, c_mpf_add, c_mpf_set_q
+from rmathics.profiler import profiler
+from rmathics.cache import EvaluationCache
+from rmathics.pattern import compile_pattern
+from rmathics.discrimination import DiscriminationTree
+from rmathics.transformations import substitute
 
 known_attributes = (
     'Orderless', 'Flat', 'OneIdentity', 'Listable', 'Constant',
@@ -15,19 +27,76 @@ known_attributes = (
     'NHoldAll', 'SequenceHold', 'Temporary', 'Stub')
 
 
+# maximum number of results in `Definitions.cache`
+CACHE_SIZE = 4096
+
+# rule sets with at least this many rules are indexed, see `RuleSet`
+INDEX_THRESHOLD = 8
+
+
+# attributes of builtin symbols in a fresh session
+builtin_attributes = [
+    ('System`Plus', ['Flat', 'Orderless', 'OneIdentity', 'NumericFunction',
+                     'Protected']),   # FIXME
+    ('System`Hold', ['HoldAll']),
+    ('System`HoldComplete', ['HoldAllComplete']),
+    ('System`HoldPattern', ['HoldAll']),
+    ('System`Unevaluated', ['HoldAllComplete']),
+    ('System`Set', ['HoldFirst', 'SequenceHold']),
+    ('System`SetDelayed', ['HoldAll', 'SequenceHold']),
+    ('System`RuleDelayed', ['HoldRest', 'SequenceHold']),
+    ('System`Rule', ['SequenceHold']),
+    ('System`TimeConstrained', ['HoldAll']),
+    ('System`MemoryConstrained', ['HoldFirst']),
+]
+
+
+class _VersionCounter(object):
+    def __init__(self):
+        self.value = 0
+
+    def next(self):
+        self.value += 1
+        return self.value
+
+# shared by all Definitions so that versions are unique across instances
+_versions = _VersionCounter()
+
+
 class Definitions(object):
     """
     Symbol table of definitions (to be filled with Definition instances)
+
+    `version` changes whenever a definition changes. Expressions record the
+    version they were evaluated under (see `Expression.eval_stamp`) so
+    evaluation can skip subtrees that are already fully evaluated.
+
+    Attribute lookups are elidable given the version, which is
+    quasi-immutable so the JIT folds them while nothing changes. (Definitions
+    created on demand by `get_definition` have no attributes, so they do not
+    need a new version.)
+
+    `cache` holds results of numeric function calls for the evaluator, see
+    `rmathics.cache`.
     """
+    _immutable_fields_ = ['version?']
+
     def __init__(self):
         self.table = {}
+        self.version = _versions.next()
+        self.cache = EvaluationCache(CACHE_SIZE)
 
         self.add_definition('System`$Context', Definition())
         self.add_definition('System`$ContextPath', Definition())
         self.set_context('Global`')
         self.set_context_path(['System`', 'Global'])
-        # FIXME
-        self.set_attributes('System`Plus', ['Orderless'])
+        self.set_ownvalues('System`$RecursionLimit', MachineInteger(1024))
+        self.set_ownvalues('System`$IterationLimit', MachineInteger(4096))
+        for name, attributes in builtin_attributes:
+            self.set_attributes(name, attributes)
+        # so that the names of builtins resolve to System`
+        for name in builtins.down:
+            self.get_definition(name)
 
     def get_context(self):
         """
@@ -43,7 +112,7 @@ class Definitions(object):
         """
         path = self.get_ownvalues('System`$ContextPath')
         assert isinstance(path, Expression)
-        assert path.head.same(Symbol('System`List'))
+        assert path.head.same(SymbolList)
         return [leaf.to_str() for leaf in path.leaves]
 
     def set_context(self, context):
@@ -60,10 +129,28 @@ class Definitions(object):
         """
         assert isinstance(context_path, list)
         assert all([isinstance(c, str) for c in context_path])
-        ownvalues = Expression(Symbol('System`List'))
-        ownvalues.leaves = [String(c) for c in context_path]
+        ownvalues = Expression(SymbolList)
+        ownvalues.set_leaves([String(c) for c in context_path])
         self.set_ownvalues('System`$ContextPath', ownvalues)
 
+    def get_recursion_limit(self):
+        """
+        return $RecursionLimit as an int, or -1 if there is no limit
+        """
+        return self._get_limit('System`$RecursionLimit')
+
+    def get_iteration_limit(self):
+        """
+        return $IterationLimit as an int, or -1 if there is no limit
+        """
+        return self._get_limit('System`$IterationLimit')
+
+    def _get_limit(self, name):
+        limit = self.get_ownvalues(name)
+        if isinstance(limit, MachineInteger) and limit.intval >= 0:
+            return limit.intval
+        return -1
+
     def get_accessible_contexts(self):
         "Return the contexts reachable though $Context or $ContextPath."
         accessible_ctxts = set(self.get_context_path())
@@ -120,7 +207,7 @@ class Definitions(object):
     def get_ownvalues(self, name):
         assert isinstance(name, str)
         ownvalues = self.get_definition(name).ownvalues
-        assert ownvalues.head.same(Symbol('System`List'))
+        assert ownvalues.head.same(SymbolList)
         assert len(ownvalues.leaves) == 1
         head, leaves = ownvalues.leaves[0].head, ownvalues.leaves[0].leaves
         # assert head is rule
@@ -132,28 +219,95 @@ class Definitions(object):
         name = self.lookup_name(name)
         defn = self.get_definition(name)
         defn.ownvalues = Expression(
-            Symbol('System`List'),
+            SymbolList,
             Expression(
-                Symbol('System`RuleDelayed'),
-                Expression(Symbol('System`HoldPattern'), Symbol(name)),
+                SymbolRuleDelayed,
+                Expression(SymbolHoldPattern, Symbol.intern(name)),
                 ownvalues))
+        self.changed()
 
     def reset_definition(self, name):
         assert isinstance(name, str)
         del self.table[self.lookup_name(name)]
+        self.changed()
 
     def add_definition(self, name, definition):
         assert isinstance(name, str)
         self.table[self.lookup_name(name)] = definition
+        self.changed()
+
+    def changed(self):
+        """
+        invalidate everything evaluated under the current definitions
+        """
+        self.version = _versions.next()
+
+    def get_downvalues(self, name):
+        assert isinstance(name, str)
+        return self.get_definition(name).downvalues
+
+    def set_downvalues(self, name, downvalues):
+        """
+        replace the DownValues of name by a List of rules lhs :> rhs
+        """
+        assert isinstance(name, str) and isinstance(downvalues, Expression)
+        assert downvalues.head.same(SymbolList)
+        defn = self.get_definition(name)
+        defn.downvalues = downvalues
+        defn.downvalue_rules = None
+        self.changed()
+
+    def add_downvalue(self, name, lhs, rhs):
+        """
+        add the rule HoldPattern[lhs] :> rhs after the DownValues of name
+        """
+        assert isinstance(name, str)
+        downvalues = Expression(SymbolList)
+        downvalues.set_leaves(self.get_downvalues(name).leaves + [
+            Expression(SymbolRuleDelayed,
+                       Expression(SymbolHoldPattern, lhs), rhs)])
+        self.set_downvalues(name, downvalues)
+
+    def get_downvalue_rules(self, name):
+        """
+        the DownValues of name as a `RuleSet`
+        """
+        assert isinstance(name, str)
+        self = jit.promote(self)
+        return self._get_downvalue_rules(name, self.version)
+
+    @jit.elidable
+    def _get_downvalue_rules(self, name, version):
+        defn = self.get_definition(name)
+        if defn.downvalue_rules is None:
+            defn.downvalue_rules = compile_rules(defn.downvalues)
+        return defn.downvalue_rules
 
     def get_attributes(self, name):
         assert isinstance(name, str)
+        self = jit.promote(self)
+        return self._get_attributes(name, self.version)
+
+    @jit.elidable
+    def _get_attributes(self, name, version):
         attributes = self.get_definition(name).attributes
-        assert attributes.head.same(Symbol('System`List'))
+        assert attributes.head.same(SymbolList)
         assert all([leaf.get_name().startswith('System`')
                     for leaf in attributes.leaves])
         return [leaf.get_name()[7:] for leaf in attributes.leaves]
 
+    def has_attribute(self, name, attribute):
+        """
+        whether `attribute` is one of the attributes of name
+        """
+        assert isinstance(name, str)
+        self = jit.promote(self)
+        return self._has_attribute(name, attribute, self.version)
+
+    @jit.elidable
+    def _has_attribute(self, name, attribute, version):
+        return attribute in self._get_attributes(name, version)
+
     def set_attributes(self, name, attributes):
         assert isinstance(name, str)
         assert isinstance(attributes, list)
@@ -161,16 +315,17 @@ class Definitions(object):
                     for attr in attributes])
         name = self.lookup_name(name)
         defn = self.get_definition(name)
-        defn.attributes = Expression(Symbol('System`List'))
-        defn.attributes.leaves = [Symbol('System`' + attribute)
-                                  for attribute in attributes]
+        defn.attributes = Expression(SymbolList)
+        defn.attributes.set_leaves([Symbol.intern('System`' + attribute)
+                                    for attribute in attributes])
+        self.changed()
 
     def get_messages(self, name):
         assert isinstance(name, str)
         messages = self.get_definition(name).messages
-        assert messages.head.same(Symbol('System`List'))
+        assert messages.head.same(SymbolList)
         messages = messages.leaves
-        assert all([message.leaves[0].head.same(Symbol('HoldPattern'))
+        assert all([message.leaves[0].head.same(Symbol.intern('HoldPattern'))
                     for message in messages])
         assert all([isinstance(message.leaves[1], String)
                     for message in messages])
@@ -191,17 +346,17 @@ class Definition(object):
     Individual definition entry (to be stored in Definitions)
     """
     def __init__(self,
-                 rules=Expression(Symbol('System`List')),
-                 ownvalues=Expression(Symbol('System`List')),
-                 downvalues=Expression(Symbol('System`List')),
-                 subvalues=Expression(Symbol('System`List')),
-                 upvalues=Expression(Symbol('System`List')),
-                 formatvalues=Expression(Symbol('System`List')),
-                 messages=Expression(Symbol('System`List')),
-                 attributes=Expression(Symbol('System`List')),
-                 options=Expression(Symbol('System`List')),
-                 nvalues=Expression(Symbol('System`List')),
-                 defaultvalues=Expression(Symbol('System`List'))):
+                 rules=Expression(SymbolList),
+                 ownvalues=Expression(SymbolList),
+                 downvalues=Expression(SymbolList),
+                 subvalues=Expression(SymbolList),
+                 upvalues=Expression(SymbolList),
+                 formatvalues=Expression(SymbolList),
+                 messages=Expression(SymbolList),
+                 attributes=Expression(SymbolList),
+                 options=Expression(SymbolList),
+                 nvalues=Expression(SymbolList),
+                 defaultvalues=Expression(SymbolList)):
         self.rules = rules
         self.ownvalues = ownvalues
         self.downvalues = downvalues
@@ -213,6 +368,8 @@ class Definition(object):
         self.options = options
         self.nvalues = nvalues
         self.defaultvalues = defaultvalues
+        # compiled from downvalues on demand
+        self.downvalue_rules = None
 
     def __repr__(self):
         s = (
@@ -221,28 +378,170 @@ class Definition(object):
                 self.downvalues, self.formatvalues, self.attributes)
         return s.encode('unicode_escape')
 
-builtins = []
+class RewriteRule(object):
+    """
+    a rule lhs -> rhs or lhs :> rhs, with lhs compiled
+    """
+    def __init__(self, lhs, rhs):
+        self.lhs = lhs
+        self.rhs = rhs
+        self.matcher = compile_pattern(lhs)
+
+    def apply(self, expr, definitions):
+        """
+        the rewritten expr, or None if the rule does not match
+        """
+        if not self.matcher.signature.admits(expr, definitions):
+            return None
+        does_match, mappings = self.matcher.match(expr, definitions)
+        if not does_match:
+            return None
+        return substitute(self.rhs, mappings)
+
+
+class RuleSet(object):
+    """
+    a list of `RewriteRule`s, tried in order
+
+    Sets of at least INDEX_THRESHOLD rules are indexed by a
+    `DiscriminationTree`, so that only the rules which may match an
+    expression are tried.
+
+    Only DownValues are rule sets so far: UpValues are stored but the
+    evaluator does not apply them, and no builtin takes a list of rules yet.
+    Both should go through `compile_rules` when they are added.
+    """
+    _immutable_fields_ = ['rules[*]', 'index']
+
+    def __init__(self, rules):
+        # a fixed-size copy, `rules` is built by appending
+        self.rules = [rule for rule in rules]
+        self.index = None
+        if len(rules) >= INDEX_THRESHOLD:
+            self.index = DiscriminationTree()
+            for i in range(len(rules)):
+                self.index.add(rules[i].matcher, i)
+
+    def apply(self, expr, definitions):
+        """
+        expr rewritten by the first rule which matches, or None
+        """
+        if self.index is None:
+            for rule in self.rules:
+                result = rule.apply(expr, definitions)
+                if result is not None:
+                    return result
+            return None
+        for i in self.index.lookup(expr, definitions):
+            result = self.rules[i].apply(expr, definitions)
+            if result is not None:
+                return result
+        return None
+
+
+def compile_rules(rules):
+    """
+    compile a List of rules into a `RuleSet`, skipping anything which is not
+    a rule
+    """
+    result = []
+    for rule in rules.get_leaves():
+        if ((rule.head.same(SymbolRule) or rule.head.same(SymbolRuleDelayed))
+                and len(rule.get_leaves()) == 2):
+            leaves = rule.get_leaves()
+            result.append(RewriteRule(leaves[0], leaves[1]))
+    return RuleSet(result)
+
+
+class Builtin(object):
+    """
+    a builtin rule: `func` is called with the mappings of `patt`
+
+    `name` (the name of `func`) identifies the rule in profiles.
+    """
+    def __init__(self, patt, func):
+        self.patt = patt
+        self.func = func
+        self.name = func.__name__
+        self.matcher = compile_pattern(patt)
+
+
+def _is_pattern_head(head):
+    for symbol in [SymbolPattern, SymbolHoldPattern, SymbolBlank,
+                   SymbolBlankSequence, SymbolBlankNullSequence]:
+        if head.same(symbol):
+            return True
+    return False
+
+
+class BuiltinTable(object):
+    """
+    builtin rules indexed by the symbol their pattern is attached to
+
+    A pattern `f[...]` is filed under `f` in `down` and a pattern which is the
+    symbol `f` itself under `f` in `own`. Anything else (e.g. a blank or a
+    compound head) goes to `other`, which applies to every expression and is
+    tried after the indexed rules. Rules with the same key are tried in the
+    order they were registered.
+    """
+    def __init__(self):
+        self.down = {}
+        self.own = {}
+        self.other = []
+
+    def add(self, patt, func):
+        rule = Builtin(patt, func)
+        if isinstance(patt, Symbol):
+            self.own.setdefault(patt.get_name(), []).append(rule)
+        elif (isinstance(patt, Expression) and isinstance(patt.head, Symbol)
+              and not _is_pattern_head(patt.head)):
+            self.down.setdefault(patt.head.get_name(), []).append(rule)
+        else:
+            self.other.append(rule)
+
+    def lookup(self, expr):
+        """
+        the indexed rules which may apply to `expr` (see also `other`)
+        """
+        if isinstance(expr, Symbol):
+            return self._lookup_own(jit.promote(expr))
+        if isinstance(expr, Expression) and isinstance(expr.head, Symbol):
+            return self._lookup_down(jit.promote(expr.head))
+        return _no_builtins
+
+    # builtins are only registered while the modules are imported
+    @jit.elidable
+    def _lookup_own(self, symbol):
+        return self.own.get(symbol.get_name(), _no_builtins)
+
+    @jit.elidable
+    def _lookup_down(self, head):
+        return self.down.get(head.get_name(), _no_builtins)
+
+_no_builtins = []
+
+builtins = BuiltinTable()
 def builtin(patt):
     assert isinstance(patt, BaseExpression)
     def wrapper(func):
-        builtins.append((patt, func))
+        builtins.add(patt, func)
         return func
     return wrapper
 
 
-@builtin(Expression(Symbol('System`Plus'),
-    Expression(Symbol('System`Pattern'), Symbol('x0'), Expression(Symbol('System`BlankNullSequence'), Symbol('System`Integer'))),
-    Expression(Symbol('System`Pattern'), Symbol('x1'), Expression(Symbol('System`BlankNullSequence'), Symbol('System`Rational'))),
-    Expression(Symbol('System`Pattern'), Symbol('x2'), Expression(Symbol('System`BlankNullSequence'), Symbol('System`Real'))),
+@builtin(Expression(SymbolPlus,
+    Expression(SymbolPattern, Symbol.intern('x0'), Expression(SymbolBlankNullSequence, SymbolInteger)),
+    Expression(SymbolPattern, Symbol.intern('x1'), Expression(SymbolBlankNullSequence, SymbolRational)),
+    Expression(SymbolPattern, Symbol.intern('x2'), Expression(SymbolBlankNullSequence, SymbolReal)),
 ))
 def plus(mappings):
     ints = mappings['x0']
     rats = mappings['x1']
     reals = mappings['x2']
 
-    assert ints.head.same(Symbol('System`Sequence'))
-    assert rats.head.same(Symbol('System`Sequence'))
-    assert reals.head.same(Symbol('System`Sequence'))
+    assert ints.head.same(SymbolSequence)
+    assert rats.head.same(SymbolSequence)
+    assert reals.head.same(SymbolSequence)
 
     ints = ints.leaves
     rats = rats.leaves
@@ -251,20 +550,16 @@ def plus(mappings):
     # most of the asserts here are for the RPython annotator
     result = None
     if ints:
-        result = int2Integer(0)
-        assert isinstance(result, Integer)
-        value = result.value
-        for arg in ints:
-            assert isinstance(arg, Integer)
-            c_mpz_add(value, value, arg.value)
+        result = add_integers(ints)
 
     if rats:
         if result is None:
             result = int2Rational(0, 1)
         else:
             intresult = result
+            assert isinstance(intresult, Integer)
             result = Rational()
-            c_mpq_set_z(result.value, intresult.value)
+            intresult.to_mpq(result.value)
         assert isinstance(result, Rational)
         value = result.value
         for arg in rats:
@@ -284,7 +579,7 @@ def plus(mappings):
         elif isinstance(result, Integer):
             intresult = result
             result = Real(prec)
-            c_mpf_set_z(result.value, intresult.value)
+            intresult.to_mpf(result.value)
         elif isinstance(result, Rational):
             ratresult = result
             result = Real(prec)
@@ -297,3 +592,50 @@ def plus(mappings):
 
     assert result is not None
     return result
+
+
+@builtin(Expression(SymbolEvaluate,
+    Expression(SymbolPattern, Symbol.intern('x'), Expression(SymbolBlank))))
+def evaluate_(mappings):
+    # the leaf was evaluated already: Evaluate itself does not hold it
+    return mappings['x']
+
+
+@builtin(Expression(Symbol.intern('System`StartProfiling')))
+def start_profiling(mappings):
+    profiler.start()
+    return SymbolNull
+
+
+@builtin(Expression(Symbol.intern('System`StopProfiling')))
+def stop_profiling(mappings):
+    profiler.stop()
+    return SymbolNull
+
+
+def _profile_table(stats, with_attempts):
+    rows = []
+    for entry in stats:
+        row = [String(entry.name)]
+        if with_attempts:
+            row.append(MachineInteger(entry.attempts))
+        row.append(MachineInteger(entry.calls))
+        row.append(machine_real(entry.inclusive))
+        row.append(machine_real(entry.exclusive))
+        expr = Expression(SymbolList)
+        expr.set_leaves(row)
+        rows.append(expr)
+    table = Expression(SymbolList)
+    table.set_leaves(rows)
+    return table
+
+
+@builtin(Expression(Symbol.intern('System`ProfileData')))
+def profile_data(mappings):
+    """
+    {{{head, calls, inclusive, exclusive}, ...},
+     {{rule, attempts, matches, inclusive, exclusive}, ...}}
+    """
+    return Expression(SymbolList,
+                      _profile_table(profiler.head_stats(), False),
+                      _profile_table(profiler.rule_stats(), True))
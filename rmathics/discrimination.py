@@ -0,0 +1,227 @@
+"""
+An index of many patterns, to find the ones an expression may match.
+
+A `DiscriminationTree` is a trie over the terms of the patterns in preorder:
+an expression contributes its number of leaves, then its head, then its
+leaves, and an atom itself. Pattern objects become wildcard edges:
+  - a blank matches any one term, or any term with its head
+  - a Real matches any Real, as nearby values are `same`
+  - an expression with sequence patterns among its leaves only indexes its
+    head, its leaves are not looked at
+
+Looking an expression up walks the trie along its terms, taking every edge
+which may match, so it visits at most as many nodes as the expression and the
+trie have in common, however many patterns there are. The patterns it returns
+may still fail to match (e.g. x_ in f[x_, x_]), but the others certainly do.
+
+Leaves under Flat or Orderless heads may be grouped or reordered by the
+matcher, so lookups do not index them either.
+
+`definitions.RuleSet` indexes its rules with a tree. At present only
+DownValues are rule sets, as nothing applies UpValues or user rule lists.
+"""
+
+from rpython.rlib.listsort import make_timsort_class
+
+from rmathics.expression import Atom, Symbol, Real, expression_dict_factory
+from rmathics.pattern import (
+    NamedMatcher, LiteralMatcher, BlankMatcher, ExpressionMatcher)
+
+
+IndexSort = make_timsort_class()
+
+# children of a node by the head of a blank, and by atom
+_new_head_dict = expression_dict_factory()
+_new_atom_dict = expression_dict_factory()
+
+
+class _Node(object):
+    """
+    `wildcard` follows a blank, `heads` a blank with a head, `atoms` an atom,
+    `exprs` an expression by its number of leaves and `variadic` an
+    expression whose leaves are not indexed. `values` are the patterns which
+    end here.
+    """
+    def __init__(self):
+        self.wildcard = None
+        self.heads = _new_head_dict()
+        self.atoms = _new_atom_dict()
+        self.exprs = {}
+        self.variadic = None
+        self.values = []
+
+    def wildcard_child(self):
+        if self.wildcard is None:
+            self.wildcard = _Node()
+        return self.wildcard
+
+    def head_child(self, head):
+        child = self.heads.get(head, None)
+        if child is None:
+            child = _Node()
+            self.heads[head] = child
+        return child
+
+    def atom_child(self, atom):
+        child = self.atoms.get(atom, None)
+        if child is None:
+            child = _Node()
+            self.atoms[atom] = child
+        return child
+
+    def expr_child(self, length):
+        child = self.exprs.get(length, None)
+        if child is None:
+            child = _Node()
+            self.exprs[length] = child
+        return child
+
+    def variadic_child(self):
+        if self.variadic is None:
+            self.variadic = _Node()
+        return self.variadic
+
+
+class _Terms(object):
+    """
+    the terms left to look up, as a linked list
+
+    A `term` of None stands for a pattern term which is not looked at.
+    """
+    def __init__(self, term, rest):
+        self.term = term
+        self.rest = rest
+
+
+class DiscriminationTree(object):
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    def add(self, matcher, value):
+        """
+        index the compiled pattern `matcher` under `value`, a non-negative int
+
+        Lookups return values in increasing order.
+        """
+        assert value >= 0
+        node = _insert(self.root, matcher)
+        node.values.append(value)
+        self.size += 1
+
+    def lookup(self, expr, definitions):
+        """
+        the sorted values of the patterns which may match expr
+        """
+        result = []
+        _lookup(self.root, _Terms(expr, None), definitions, result)
+        IndexSort(result).sort()
+        return result
+
+
+def _insert(node, matcher):
+    """
+    the node reached from `node` by the terms of `matcher`
+    """
+    while isinstance(matcher, NamedMatcher):
+        matcher = matcher.pattern
+    if isinstance(matcher, LiteralMatcher):
+        return _insert_literal(node, matcher.source)
+    if isinstance(matcher, BlankMatcher) and matcher.head is not None:
+        return node.head_child(matcher.head)
+    if not isinstance(matcher, ExpressionMatcher):
+        return node.wildcard_child()
+    for leaf in matcher.leaves:
+        if leaf.min_length != 1 or leaf.max_length != 1:
+            return _insert_literal(node.variadic_child(), matcher.head)
+    node = _insert_literal(node.expr_child(len(matcher.leaves)),
+                           matcher.head)
+    for leaf in matcher.leaves:
+        node = _insert(node, leaf)
+    return node
+
+
+def _insert_literal(node, expr):
+    if isinstance(expr, Real):
+        # atoms are looked up with `identical`, but a pattern matches any
+        # Real which is `same`, up to a tolerance
+        return node.head_child(expr.head)
+    if isinstance(expr, Atom):
+        return node.atom_child(expr)
+    leaves = expr.get_leaves()
+    node = _insert_literal(node.expr_child(len(leaves)), expr.head)
+    for leaf in leaves:
+        node = _insert_literal(node, leaf)
+    return node
+
+
+def _lookup(node, terms, definitions, result):
+    if terms is None:
+        result.extend(node.values)
+        return
+    term = terms.term
+    rest = terms.rest
+    if term is None:
+        _skip(node, rest, definitions, result)
+        return
+    if node.wildcard is not None:
+        _lookup(node.wildcard, rest, definitions, result)
+    child = node.heads.get(term.head, None)
+    if child is not None:
+        _lookup(child, rest, definitions, result)
+    if isinstance(term, Atom):
+        child = node.atoms.get(term, None)
+        if child is not None:
+            _lookup(child, rest, definitions, result)
+        return
+    if node.variadic is not None:
+        _lookup(node.variadic, _Terms(term.head, rest), definitions, result)
+    if not node.exprs:
+        return
+    if _unordered(term.head, definitions):
+        for length, child in node.exprs.items():
+            _lookup(child, _Terms(term.head, _unknown(length, rest)),
+                    definitions, result)
+        return
+    child = node.exprs.get(term.get_length(), None)
+    if child is not None:
+        leaves = term.get_leaves()
+        i = len(leaves) - 1
+        while i >= 0:
+            rest = _Terms(leaves[i], rest)
+            i -= 1
+        _lookup(child, _Terms(term.head, rest), definitions, result)
+
+
+def _skip(node, rest, definitions, result):
+    """
+    look up rest after every pattern term leaving `node`
+    """
+    if node.wildcard is not None:
+        _lookup(node.wildcard, rest, definitions, result)
+    for child in node.heads.values():
+        _lookup(child, rest, definitions, result)
+    for child in node.atoms.values():
+        _lookup(child, rest, definitions, result)
+    if node.variadic is not None:
+        _lookup(node.variadic, _Terms(None, rest), definitions, result)
+    for length, child in node.exprs.items():
+        _lookup(child, _Terms(None, _unknown(length, rest)), definitions,
+                result)
+
+
+def _unknown(count, rest):
+    for i in range(count):
+        rest = _Terms(None, rest)
+    return rest
+
+
+def _unordered(head, definitions):
+    """
+    whether the matcher may group or reorder the leaves of expressions with
+    this head
+    """
+    if not isinstance(head, Symbol):
+        return False
+    attributes = definitions.get_attributes(head.get_name())
+    return 'Flat' in attributes or 'Orderless' in attributes
@@ -1,66 +1,675 @@
 """
 functions for evaluating expression trees
+
+Evaluation runs on an explicit stack of frames rather than on the native
+stack, so deeply nested expressions cannot overflow it. Each frame evaluates
+the head and leaves of one expression in turn. When the rebuilt expression
+differs from the original it is evaluated again in place of the frame, so
+chains of rewrites do not nest either.
+
+The number of nested frames is bounded by $RecursionLimit. When a
+subexpression would exceed it, a $RecursionLimit::reclim message is reported
+and the whole evaluation stops, returning that subexpression unevaluated and
+wrapped in Hold. Likewise an expression which is still changing after
+$IterationLimit rewrites by rules stops the evaluation with a
+$IterationLimit::itlim message, returning the next rewrite wrapped in Hold.
+Stopping the whole evaluation keeps the enclosing frames from rewriting the
+held result again, which would multiply the work by the limits.
+
+TimeConstrained[expr, t, failexpr] and MemoryConstrained[expr, b, failexpr]
+abort the evaluation of expr once it takes more than t seconds or requests
+more than (an estimated) b bytes, and evaluate failexpr instead, which
+defaults to $Aborted. The limits are checked every `CHECK_INTERVAL` steps of
+the evaluation loop, so an unconstrained evaluation pays only a counter
+increment per step and nothing reads the clock.
+
+The same periodic check polls an `Interrupts` instance, through which the
+kernel can abort a running evaluation: the whole evaluation then returns
+$Aborted.
+
+Leaves are not evaluated in positions held by the HoldFirst, HoldRest,
+HoldAll or HoldAllComplete attributes of the head, unless they are wrapped in
+Evaluate (which HoldAllComplete ignores). A leaf wrapped in Unevaluated is
+never evaluated, but builtins see it without the wrapper. If no builtin
+applies, the result keeps the wrapper. Sequence leaves are spliced into the
+enclosing expression, except under SequenceHold or HoldAllComplete.
+
+Results of NumericFunction heads applied to numbers are cached in
+`Definitions.cache` (see `rmathics.cache`) unless evaluating them produced
+messages.
+
+If the pattern matcher gives up on a rule (see `MATCH_BUDGET`), a
+General::matchlim message is reported and the rules after it are not tried,
+as it is unknown whether it applies.
+
+While the profiler is enabled (see `rmathics.profiler`) every frame and every
+builtin rule attempt is timed.
 """
 
-from rmathics.expression import Expression, Atom, Symbol
-from rmathics.definitions import Definitions
+import time
+
+from rpython.rlib import jit
+
+from rmathics.expression import (
+    Expression, PackedArray, Symbol, Integer, Real, SymbolHold,
+    SymbolSequence, SymbolEvaluate, SymbolUnevaluated, SymbolAborted,
+    SymbolTimeConstrained, SymbolMemoryConstrained)
 from rmathics.transformations import flatten, thread, sort
 from rmathics.definitions import builtins
-from rmathics.pattern import match
+from rmathics.printer import fullform
+from rmathics.profiler import profiler
+from rmathics.pattern import MatchBudgetExceeded
+
 
-def _builtin_evaluate(expr, definitions):
-    for patt, func in builtins:
-        does_match, mappings = match(expr, patt, definitions)
+def get_printable_location(head):
+    return head.repr()
+
+# the evaluation loop is traced per head of the expression being evaluated
+evaluation_driver = jit.JitDriver(
+    greens=['head'], reds='auto', is_recursive=True,
+    get_printable_location=get_printable_location)
+
+
+@jit.unroll_safe
+def _builtin_evaluate(expr, evaluation):
+    definitions = evaluation.definitions
+    if evaluation.is_profiling():
+        return _profiled_builtin_evaluate(expr, evaluation)
+    try:
+        for rule in builtins.lookup(expr):
+            if rule.matcher.signature.admits(expr, definitions):
+                does_match, mappings = rule.matcher.match(expr, definitions)
+                if does_match:
+                    return rule.func(mappings)
+        for rule in builtins.other:
+            if rule.matcher.signature.admits(expr, definitions):
+                does_match, mappings = rule.matcher.match(expr, definitions)
+                if does_match:
+                    return rule.func(mappings)
+    except MatchBudgetExceeded:
+        evaluation.message('General', 'matchlim')
+    return expr
+
+
+def _profiled_builtin_evaluate(expr, evaluation):
+    definitions = evaluation.definitions
+    profiler = evaluation.profiler
+    rules = [rule for rule in builtins.lookup(expr)
+             if rule.matcher.signature.admits(expr, definitions)]
+    for rule in builtins.other:
+        if rule.matcher.signature.admits(expr, definitions):
+            rules.append(rule)
+    for rule in rules:
+        start = time.time()
+        try:
+            does_match, mappings = rule.matcher.match(expr, definitions)
+        except MatchBudgetExceeded:
+            evaluation.message('General', 'matchlim')
+            return expr
+        called = time.time()
+        result = expr
+        if does_match:
+            result = rule.func(mappings)
+        end = time.time()
+        profiler.record_rule(rule.name, does_match, end - start, end - called)
         if does_match:
-            return func(mappings)
+            return result
     return expr
 
-def evaluate(expr, definitions=Definitions()):
-    messages = []
-    result = expr
-    if isinstance(expr, Expression):
-            # Evaluate head
-            head, head_messages = evaluate(expr.head, definitions)
-            messages.extend(head_messages)
-
-            # Evaluate leaves
-            leaves = []
-            for leaf in expr.leaves:
-                leaf, leaf_messages = evaluate(leaf, definitions)
-                messages.extend(leaf_messages)
-                leaves.append(leaf)
-
-            # Build the result
-            result = Expression(head)
-            result.leaves = leaves
-
-            # Apply transformations for Orderless, Listable, Flat
-            if isinstance(head, Symbol):
-                head_attributes = definitions.get_attributes(head.get_name())
-                if 'Listable' in head_attributes:
-                    result, thread_messages = thread(result)
-                    messages.extend(thread_messages)
-                if 'Orderless' in head_attributes:
-                    result = sort(result)
-                if 'Flat' in head_attributes:
-                    result = flatten(result)
-
-    elif isinstance(expr, Atom):
-        if isinstance(expr, Symbol):
-            # Apply user definitions
-            # TODO OwnValues
-            # TODO UpValues
-            # TODO DownValues
-
-            # Apply builtin definitions
-            # TODO
-            pass
+
+def _apply_downvalues(expr, evaluation):
+    """
+    the rewritten expr if one of the DownValues of its head applies, or None
+    """
+    head = expr.head
+    if not isinstance(head, Symbol):
+        return None
+    definitions = evaluation.definitions
+    rules = definitions.get_downvalue_rules(head.get_name())
+    try:
+        return rules.apply(expr, definitions)
+    except MatchBudgetExceeded:
+        evaluation.message('General', 'matchlim')
+        return None
+
+
+def _head_name(head):
+    if isinstance(head, Symbol):
+        return head.get_name()
+    return fullform(head, 40)
+
+
+@jit.unroll_safe
+def _is_numeric_call(expr, definitions):
+    """
+    whether `expr` is a NumericFunction applied to numbers, whose result can
+    be cached
+    """
+    head = expr.head
+    if not isinstance(head, Symbol):
+        return False
+    head = jit.promote(head)
+    if not definitions.has_attribute(head.get_name(), 'NumericFunction'):
+        return False
+    for leaf in expr.get_leaves():
+        if not leaf.is_number():
+            return False
+    return True
+
+
+def _is_wrapped(expr, wrapper):
+    return (isinstance(expr, Expression) and expr.head.same(wrapper) and
+            len(expr.get_leaves()) == 1)
+
+
+class _Frame(object):
+    """
+    an expression whose head and leaves are being evaluated
+
+    `pos` is the part evaluated next: -1 for the head, then the leaves. The
+    hold and transformation flags are set from the attributes of the
+    evaluated head.
+    """
+    def __init__(self, expr, version):
+        self.expr = expr
+        self.version = version
+        self.expr_leaves = expr.get_leaves()
+        self.pos = -1
+        self.head = expr.head
+        self.leaves = []
+        self.changed = False
+        self.iterations = 0
+        # the cacheable expression whose result this frame computes, and the
+        # number of messages before it started
+        self.cache_key = None
+        self.message_count = 0
+        # for the profiler
+        self.start = 0.0
+        self.nested_time = 0.0
+        self.hold_first = False
+        self.hold_rest = False
+        self.hold_complete = False
+        self.sequence_hold = False
+        self.listable = False
+        self.orderless = False
+        self.flat = False
+
+    @jit.unroll_safe
+    def set_attributes(self, attributes):
+        for attribute in attributes:
+            if attribute == 'HoldFirst':
+                self.hold_first = True
+            elif attribute == 'HoldRest':
+                self.hold_rest = True
+            elif attribute == 'HoldAll':
+                self.hold_first = True
+                self.hold_rest = True
+            elif attribute == 'HoldAllComplete':
+                self.hold_first = True
+                self.hold_rest = True
+                self.hold_complete = True
+            elif attribute == 'SequenceHold':
+                self.sequence_hold = True
+            elif attribute == 'Listable':
+                self.listable = True
+            elif attribute == 'Orderless':
+                self.orderless = True
+            elif attribute == 'Flat':
+                self.flat = True
+
+    def is_held(self, leaf):
+        """
+        whether the leaf at `pos` is to be kept unevaluated
+        """
+        if self.hold_complete:
+            return True
+        if _is_wrapped(leaf, SymbolUnevaluated):
+            return True
+        if self.pos == 0:
+            held = self.hold_first
+        else:
+            held = self.hold_rest
+        return held and not _is_wrapped(leaf, SymbolEvaluate)
+
+    def is_done(self):
+        return self.pos >= len(self.expr_leaves)
+
+    def next_part(self):
+        if self.pos == -1:
+            return self.expr.head
+        return self.expr_leaves[self.pos]
+
+    def receive(self, result):
+        """
+        store the evaluated part at `pos` and advance
+        """
+        if self.pos == -1:
+            self.changed = result is not self.head
+            self.head = result
+        else:
+            self.changed = (self.changed or
+                            result is not self.expr_leaves[self.pos])
+            self.leaves.append(result)
+        self.pos += 1
+
+
+def _splice_sequences(leaves):
+    result = []
+    for leaf in leaves:
+        if leaf.head.same(SymbolSequence):
+            result.extend(leaf.get_leaves())
+        else:
+            result.append(leaf)
+    return result
+
+
+def _strip_unevaluated(expr):
+    """
+    expr with Unevaluated[x] leaves replaced by x, or expr itself if it has
+    none
+    """
+    leaves = expr.get_leaves()
+    stripped = None
+    for i in range(len(leaves)):
+        leaf = leaves[i]
+        if _is_wrapped(leaf, SymbolUnevaluated):
+            if stripped is None:
+                stripped = leaves[:i]
+            stripped.append(leaf.get_leaves()[0])
+        elif stripped is not None:
+            stripped.append(leaf)
+    if stripped is None:
+        return expr
+    result = Expression(expr.head)
+    result.set_leaves(stripped)
+    return result
+
+
+# evaluation steps between checks of TimeConstrained and MemoryConstrained
+CHECK_INTERVAL = 1024
+
+# rough sizes in bytes of what the evaluator allocates, for MemoryConstrained
+_FRAME_BYTES = 96
+_EXPRESSION_BYTES = 64
+_LEAF_BYTES = 8
+
+
+class _Guard(object):
+    """
+    an active TimeConstrained or MemoryConstrained
+
+    `deadline` is a time.time() value and `max_bytes` counts from `bytes`, the
+    evaluator's allocation count when the guard was set up. Either is
+    negative if it does not apply.
+    """
+    def __init__(self, depth, deadline, max_bytes, bytes):
+        self.depth = depth
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.bytes = bytes
+
+
+class Interrupts(object):
+    """
+    requests to abort evaluation, arriving from outside the evaluator
+
+    `poll` is called every `CHECK_INTERVAL` evaluation steps. Subclasses
+    override it to look for requests (e.g. signals or control messages) and
+    call `abort`. `aborted` records that an evaluation was cut short; it is
+    up to the caller to reset it.
+    """
+    def __init__(self):
+        self.requested = False
+        self.aborted = False
+
+    def abort(self):
+        self.requested = True
+
+    def poll(self):
+        pass
+
+no_interrupts = Interrupts()
+
+
+class Evaluation(object):
+    """
+    the context of a top level evaluation
+
+    It carries the definitions, the limits read from them when the
+    evaluation started, where abort requests come from, the profiler, and
+    the single list that collects the messages of the whole evaluation as
+    (symbol, tag) pairs.
+    """
+    _immutable_fields_ = [
+        'definitions', 'interrupts', 'profiler', 'recursion_limit',
+        'iteration_limit']
+
+    def __init__(self, definitions, interrupts=no_interrupts):
+        self.definitions = definitions
+        self.interrupts = interrupts
+        self.profiler = profiler
+        self.recursion_limit = definitions.get_recursion_limit()
+        self.iteration_limit = definitions.get_iteration_limit()
+        self.messages = []
+
+    def message(self, symbol, tag):
+        self.messages.append((symbol, tag))
+
+    def is_profiling(self):
+        # promoted so the JIT can fold the quasi-immutable flag
+        return jit.promote(self.profiler).enabled
+
+
+class _Abort(Exception):
+    """
+    raised to unwind the evaluation up to `guard`, or entirely if it is None
+    """
+    def __init__(self, guard):
+        self.guard = guard
+
+
+class _LimitExceeded(Exception):
+    """
+    raised to unwind the whole evaluation when $RecursionLimit or
+    $IterationLimit is hit, which then returns `held`
+    """
+    def __init__(self, held):
+        self.held = held
+
+
+def _held(expr, version):
+    held = Expression(SymbolHold, expr)
+    # stamped so that evaluating the result again does nothing
+    held.eval_stamp = version
+    return held
+
+
+def _to_seconds(expr):
+    """
+    the value of a positive real number as a float, or -1.0
+    """
+    if isinstance(expr, Integer) or isinstance(expr, Real):
+        value = expr.to_float()
+        if value > 0.0:
+            return value
+    return -1.0
+
+
+class _Evaluator(object):
+    def __init__(self, evaluation):
+        self.evaluation = evaluation
+        self.definitions = evaluation.definitions
+        self.recursion_limit = evaluation.recursion_limit
+        self.iteration_limit = evaluation.iteration_limit
+        self.stack = []
+        self.guards = []
+        self.steps = 0
+        self.next_check = CHECK_INTERVAL
+        self.bytes = 0
+
+    def enter(self, expr, cached_call=False):
+        """
+        evaluate `expr` directly if possible, otherwise push a frame for it
+        and return None
+
+        `cached_call` is set when expr is a rewrite of a call that is being
+        cached, whose cache miss was already counted.
+        """
+        if isinstance(expr, PackedArray):
+            # machine numbers in a List are already fully evaluated
+            return expr
+        if isinstance(expr, Expression):
+            version = self.definitions.version
+            if expr.eval_stamp == version:
+                # nothing changed since expr was last evaluated
+                return expr
+            if 0 <= self.recursion_limit <= len(self.stack):
+                self.evaluation.message('$RecursionLimit', 'reclim')
+                raise _LimitExceeded(_held(expr, version))
+            if (expr.head.same(SymbolTimeConstrained) or
+                    expr.head.same(SymbolMemoryConstrained)):
+                return self.constrained(expr)
+            cache_key = None
+            if _is_numeric_call(expr, self.definitions):
+                cached = self.definitions.cache.lookup(
+                    expr, version, count_miss=not cached_call)
+                if cached is not None:
+                    return cached
+                cache_key = expr
+            frame = _Frame(expr, version)
+            frame.cache_key = cache_key
+            frame.message_count = len(self.evaluation.messages)
+            self.bytes += _FRAME_BYTES + _LEAF_BYTES * len(frame.expr_leaves)
+            if self.evaluation.is_profiling():
+                frame.start = time.time()
+            self.stack.append(frame)
+            return None
+        # TODO OwnValues
+        # TODO UpValues
+        return _builtin_evaluate(expr, self.evaluation)
+
+    def reenter(self, frame, expr, rewrite):
+        """
+        evaluate the changed result of a frame
+
+        `rewrite` is set if a rule produced expr, which counts towards
+        $IterationLimit. Results which only changed because their parts did
+        are not counted.
+        """
+        iterations = frame.iterations
+        if rewrite:
+            if 0 <= self.iteration_limit <= iterations:
+                self.evaluation.message('$IterationLimit', 'itlim')
+                raise _LimitExceeded(_held(expr, self.definitions.version))
+            iterations += 1
+        result = self.enter(expr, frame.cache_key is not None)
+        if result is None:
+            top = self.stack[-1]
+            top.iterations = iterations
+            if top.cache_key is None:
+                top.cache_key = frame.cache_key
+                top.message_count = frame.message_count
+            return None
+        return self.remember(frame, result)
+
+    def remember(self, frame, result):
+        """
+        cache the result of a frame if it is cacheable and evaluated quietly
+        """
+        if (frame.cache_key is not None and
+                len(self.evaluation.messages) == frame.message_count):
+            self.definitions.cache.store(frame.cache_key, result,
+                                         frame.version)
+        return result
+
+    def constrained(self, expr):
+        """
+        evaluate TimeConstrained[expr, t, failexpr] or
+        MemoryConstrained[expr, b, failexpr]
+        """
+        name = expr.head.get_name()[7:]
+        leaves = expr.get_leaves()
+        if not (2 <= len(leaves) <= 3):
+            self.evaluation.message(name, 'argt')
+            return expr
+        limit = self.run(leaves[1])
+        deadline = -1.0
+        max_bytes = -1
+        if expr.head.same(SymbolTimeConstrained):
+            seconds = _to_seconds(limit)
+            if seconds < 0.0:
+                self.evaluation.message(name, 'timc')
+                return expr
+            deadline = time.time() + seconds
+        else:
+            if not (isinstance(limit, Integer) and limit.to_float() > 0.0):
+                self.evaluation.message(name, 'ipnfm')
+                return expr
+            if limit.to_float() < float(1 << 62):
+                max_bytes = limit.to_int()
+        guard = _Guard(len(self.stack), deadline, max_bytes, self.bytes)
+        self.guards.append(guard)
+        self.next_check = self.steps     # check on the next step
+        try:
+            try:
+                return self.run(leaves[0])
+            except _Abort as abort:
+                if abort.guard is not guard:
+                    raise
+                del self.stack[guard.depth:]
+        finally:
+            self.guards.pop()
+        if len(leaves) == 3:
+            return self.run(leaves[2])
+        return SymbolAborted
+
+    def check(self):
+        """
+        raise _Abort if an interrupt was requested, or if a TimeConstrained or
+        MemoryConstrained ran out
+        """
+        self.next_check = self.steps + CHECK_INTERVAL
+        interrupts = self.evaluation.interrupts
+        interrupts.poll()
+        if interrupts.requested:
+            interrupts.requested = False
+            interrupts.aborted = True
+            raise _Abort(None)
+        now = -1.0
+        # the outermost exhausted guard wins, it aborts the inner ones too
+        for guard in self.guards:
+            if guard.deadline >= 0.0:
+                if now < 0.0:
+                    now = time.time()
+                if now > guard.deadline:
+                    raise _Abort(guard)
+            if (guard.max_bytes >= 0 and
+                    self.bytes - guard.bytes > guard.max_bytes):
+                raise _Abort(guard)
+
+    def receive_head(self, frame, head):
+        frame.receive(head)
+        if isinstance(head, Symbol):
+            # promoted so that the attribute lookup is folded, there are few
+            # heads in a loop
+            head = jit.promote(head)
+            frame.set_attributes(
+                self.definitions.get_attributes(head.get_name()))
+
+    @jit.unroll_safe
+    def finish(self, frame):
+        """
+        complete a frame whose parts are all evaluated
+
+        returns the result, or None if it has to be evaluated again
+        """
+        expr = frame.expr
+        head = frame.head
+
+        # Splice in Sequence leaves
+        if not (frame.sequence_hold or frame.hold_complete):
+            leaves = frame.leaves
+            for leaf in leaves:
+                if leaf.head.same(SymbolSequence):
+                    frame.leaves = _splice_sequences(leaves)
+                    frame.changed = True
+                    break
+
+        # Build the result (only if something changed)
         result = expr
+        if frame.changed:
+            result = Expression(head)
+            result.set_leaves(frame.leaves)
+            self.bytes += _EXPRESSION_BYTES + _LEAF_BYTES * len(frame.leaves)
+
+        # Apply transformations for Orderless, Listable, Flat
+        if frame.listable:
+            result = thread(result, self.evaluation)
+        if frame.orderless:
+            result = sort(result)
+        if frame.flat:
+            result = flatten(result)
+
+        # Parts that evaluate to themselves come back as the same object, so
+        # an identity check finds the fixed point without walking the tree. A
+        # rebuilt but equal result costs one more (shallow) pass below.
+        if result is expr:
+            # builtins see Unevaluated leaves without the wrapper
+            target = expr
+            if not frame.hold_complete:
+                target = _strip_unevaluated(expr)
+            rewritten = _apply_downvalues(target, self.evaluation)
+            if rewritten is not None:
+                return self.reenter(frame, rewritten, True)
+            result = _builtin_evaluate(target, self.evaluation)
+            if result is target:
+                # a fixed point: remember it until the definitions change
+                expr.eval_stamp = frame.version
+                result = expr
+            return self.remember(frame, result)
+        return self.reenter(frame, result, False)
+
+    def profile(self, frame):
+        """
+        finish `frame`, recording the time spent on it
+        """
+        parent = None
+        if self.stack:
+            parent = self.stack[-1]
+        result = self.finish(frame)
+        if frame.start == 0.0:
+            # pushed before the profiler was started
+            return result
+        elapsed = time.time() - frame.start
+        self.evaluation.profiler.record_head(
+            _head_name(frame.head), elapsed, elapsed - frame.nested_time)
+        if parent is not None:
+            parent.nested_time += elapsed
+        return result
+
+    def run(self, expr):
+        """
+        evaluate expr on top of the frames already on the stack
+        """
+        base = len(self.stack)
+        result = self.enter(expr)
+        while len(self.stack) > base:
+            frame = self.stack[-1]
+            head = frame.expr.head
+            evaluation_driver.jit_merge_point(head=head)
+            self.steps += 1
+            if self.steps >= self.next_check:
+                self.check()
+            if result is not None:
+                if frame.pos == -1:
+                    self.receive_head(frame, result)
+                else:
+                    frame.receive(result)
+            if frame.is_done():
+                self.stack.pop()
+                if self.evaluation.is_profiling():
+                    result = self.profile(frame)
+                else:
+                    result = self.finish(frame)
+            else:
+                part = frame.next_part()
+                if frame.pos >= 0 and frame.is_held(part):
+                    result = part
+                else:
+                    result = self.enter(part)
+        assert result is not None
+        return result
+
 
-    if expr.same(result):
-        result = _builtin_evaluate(expr, definitions)
-        return (result, messages)
-    else:
-        result, result_messages = evaluate(result, definitions)
-        messages.extend(result_messages)
-        return (result, messages)
+def evaluate(expr, evaluation):
+    """
+    evaluate `expr` in the context `evaluation`, which collects the messages
+    """
+    evaluator = _Evaluator(evaluation)
+    try:
+        result = evaluator.run(expr)
+    except _Abort:
+        result = SymbolAborted
+    except _LimitExceeded as exceeded:
+        result = exceeded.held
+    return result
@@ -5,11 +5,14 @@ The structure of things:
 
 - BaseExpression
   - Expression
+    - PackedArray
   - Atom
     - String
     - Symbol
     - Number
       - Integer
+        - MachineInteger
+        - BigInteger
       - Rational
       - Real
       - Complex
@@ -17,25 +20,138 @@ The structure of things:
 Every `BaseExpression` has attributes `head` and `leaves`:
   - `head` is itself a `BaseExpression` instances.
   - `leaves` is a list of `BaseExpression` instances. For atoms it is empty.
+
+Code that may see a `PackedArray` must read leaves with `get_leaves()`, which
+unpacks the array on demand.
+
+Every `BaseExpression` also caches some metadata which is computed lazily:
+  - a structural hash (see `get_hash`)
+  - a bit mask of the atoms among its leaves (see `get_atom_mask`)
+  - `get_depth` and `get_leaf_count`, as for Depth and LeafCount
+  - a canonical order sort key (see `get_sort_key` and `compare`)
+
+Expressions must not be mutated once evaluated. Build them bottom up and
+replace or extend leaves with `set_leaves` and `append_leaf`, which drop the
+cached metadata of the expression being changed (but not of its parents).
 """
 from rply.token import BaseBox
 from rmathics.rpython_util import zip, all
 from rmathics.gmp import (
-    MPZ_STRUCT, c_mpz_init, c_mpz_clear, c_mpz_sizeinbase, c_mpz_get_str,
-    c_mpz_cmp,
-    MPQ_STRUCT, c_mpq_init, c_mpq_clear, c_mpq_equal, c_mpq_get_str,
-    c_mpq_get_num, c_mpq_get_den, c_mpq_get_d,
-    MPF_STRUCT, MP_EXP_TP, c_mpf_init2, c_mpf_clear, c_mpf_get_str,
-    c_mpf_get_d, c_mpf_eq,
+    c_mpz_sizeinbase, c_mpz_get_str, c_mpz_cmp, c_mpz_cmp_si, c_mpz_set,
+    c_mpz_set_si, c_mpz_size, c_mpz_getlimbn, c_mpz_fits_slong_p,
+    c_mpz_get_si, c_mpz_get_d, c_mpz_add, c_mpz_add_ui, c_mpz_sub_ui,
+    c_mpq_equal, c_mpq_get_str, c_mpq_get_num, c_mpq_get_den, c_mpq_get_d,
+    c_mpq_set_si, c_mpq_set_z, c_mpq_cmp,
+    MP_EXP_TP, c_mpf_get_str, c_mpf_get_d, c_mpf_eq, c_mpf_cmp, c_mpf_set_d,
+    c_mpf_set_si, c_mpf_set_z, c_mpf_get_d_2exp,
+    mpz_acquire, mpz_release, mpq_acquire, mpq_release, mpf_acquire,
+    mpf_release,
 )
 
-from math import log
+from math import log, frexp
 from rpython.rtyper.lltypesystem import rffi, lltype
+from rpython.rlib import rgc
+from rpython.rlib.objectmodel import compute_hash, r_dict
+from rpython.rlib.rarithmetic import intmask, r_uint, ovfcheck
+
+
+# distinguishes e.g. the String "x" from the Symbol x when hashing
+_HASH_EXPRESSION = 0x345678
+_HASH_STRING = 0x1b873593
+_HASH_SYMBOL = 0x2c1b3c6d
+_HASH_INTEGER = 0x297a2d39
+_HASH_RATIONAL = 0x61c88647
+_HASH_REAL = 0x5bd1e995
+_HASH_COMPLEX = 0x27d4eb2f
+
+
+# bits of an atom mask: one per hash class of atoms, and one marking the mask
+# as computed
+_ATOM_BITS = 62
+_ATOM_MASK_COMPUTED = 1 << _ATOM_BITS
+_ATOM_MASK_ALL = (1 << (_ATOM_BITS + 1)) - 1
+
+
+def atom_bit(atom):
+    """
+    the bit an atom sets in the atom mask of expressions it is a leaf of
+    """
+    return 1 << intmask(r_uint(atom.get_hash()) % _ATOM_BITS)
+
+
+def _hash_combine(h1, h2):
+    return intmask((h1 ^ h2) * 1000003)
+
+
+def _hash_sign(sign):
+    if sign > 0:
+        return 1
+    elif sign < 0:
+        return -1
+    return 0
+
+
+def _hash_mpz(value):
+    """
+    hash an mpz by its sign and limbs
+    """
+    h = _hash_combine(_HASH_INTEGER, _hash_sign(intmask(c_mpz_cmp_si(value, 0))))
+    for i in range(intmask(c_mpz_size(value))):
+        h = _hash_combine(h, intmask(c_mpz_getlimbn(value, i)))
+    return h
+
+
+def _hash_real(mantissa, exp, prec):
+    """
+    hash a Real of precision prec and value mantissa * 2^exp, with the
+    mantissa (in [0.5, 1)) rounded to a double as by mpf_get_d_2exp
+    """
+    h = _hash_combine(_HASH_REAL, prec)
+    h = _hash_combine(h, compute_hash(mantissa))
+    return _hash_combine(h, exp)
+
+
+def _hash_int(value):
+    """
+    hash a machine integer, agreeing with `_hash_mpz` for the same value
+    """
+    h = _hash_combine(_HASH_INTEGER, _hash_sign(value))
+    if value > 0:
+        h = _hash_combine(h, intmask(r_uint(value)))
+    elif value < 0:
+        h = _hash_combine(h, intmask(r_uint(0) - r_uint(value)))
+    return h
+
+
+# ranks of the canonical order: numbers < strings < symbols < expressions
+SORT_NUMBER = 0
+SORT_STRING = 1
+SORT_SYMBOL = 2
+SORT_EXPRESSION = 3
+
+
+class SortKey(object):
+    """
+    cached prefix of an expression's position in the canonical order
+
+    keys with different ranks, or of strings and symbols, decide the order on
+    their own. Ties between numbers and between expressions are broken by
+    `compare`.
+    """
+    def __init__(self, rank, number, text):
+        self.rank = rank
+        self.number = number
+        self.text = text
 
 
 class BaseExpression(BaseBox):
     def __init__(self, *args):
         self.leaves = []
+        self._hash = 0
+        self._depth = 0
+        self._leaf_count = 0
+        self._sort_key = None
+        self._atom_mask = 0
 
     def get_precision(self):
         return None
@@ -58,6 +174,103 @@ class BaseExpression(BaseBox):
     def same(self, other):
         return False
 
+    def identical(self, other):
+        """
+        whether other is exactly the same expression
+
+        This is `same`, except that Reals must have equal values and
+        precisions where `same` allows them to differ in their last bits.
+        """
+        return self.same(other)
+
+    def get_leaves(self):
+        return self.leaves
+
+    def get_length(self):
+        """
+        number of leaves, without unpacking a `PackedArray`
+        """
+        return len(self.leaves)
+
+    def get_hash(self):
+        """
+        structural hash of the expression, computed once and cached
+
+        expressions which are `identical` have equal hashes. Expressions which
+        are only `same` may not, as nearby Reals hash differently.
+        """
+        h = self._hash
+        if h == 0:
+            h = self.compute_hash()
+            if h == 0:      # 0 marks an uncomputed hash
+                h = 1
+            self._hash = h
+        return h
+
+    def compute_hash(self):
+        raise NotImplementedError
+
+    def get_depth(self):
+        """
+        maximum number of indices needed to reach a leaf, as for Depth
+        """
+        if self._depth == 0:
+            self._depth = self.compute_depth()
+        return self._depth
+
+    def compute_depth(self):
+        return 1
+
+    def get_leaf_count(self):
+        """
+        number of atoms (including heads) in the expression, as for LeafCount
+        """
+        if self._leaf_count == 0:
+            self._leaf_count = self.compute_leaf_count()
+        return self._leaf_count
+
+    def compute_leaf_count(self):
+        return 1
+
+    def get_atom_mask(self):
+        """
+        the `atom_bit`s of the atoms among the leaves, ORed together
+
+        an atom whose bit is not set is certainly not a leaf.
+        """
+        mask = self._atom_mask
+        if mask == 0:
+            mask = self.compute_atom_mask() | _ATOM_MASK_COMPUTED
+            self._atom_mask = mask
+        return mask
+
+    def compute_atom_mask(self):
+        mask = 0
+        for leaf in self.leaves:
+            if leaf.is_atom():
+                mask |= atom_bit(leaf)
+        return mask
+
+    def get_sort_key(self):
+        key = self._sort_key
+        if key is None:
+            key = self.compute_sort_key()
+            self._sort_key = key
+        return key
+
+    def compute_sort_key(self):
+        raise NotImplementedError
+
+    def invalidate(self):
+        """
+        drop the cached metadata after the expression was changed in place
+        """
+        self._hash = 0
+        self._depth = 0
+        self._leaf_count = 0
+        self._sort_key = None
+        self._atom_mask = 0
+
     def to_str(self):
         raise NotImplementedError
 
@@ -66,34 +279,199 @@ class BaseExpression(BaseBox):
 
 
 class Expression(BaseExpression):
+    """
+    `eval_stamp` is the `Definitions.version` under which the expression was
+    last found to be fully evaluated, or -1.
+    """
     def __init__(self, head, *leaves):
         BaseExpression.__init__(self)
         assert isinstance(head, BaseExpression)
         assert all([isinstance(leaf, BaseExpression) for leaf in list(leaves)])
         self.head = head
         self.leaves = list(leaves)
+        self.eval_stamp = -1
+
+    def set_leaves(self, leaves):
+        self.leaves = leaves
+        self.invalidate()
+
+    def append_leaf(self, leaf):
+        self.leaves.append(leaf)
+        self.invalidate()
+
+    def invalidate(self):
+        BaseExpression.invalidate(self)
+        self.eval_stamp = -1
+
+    def compute_depth(self):
+        _compute_below(self, _DEPTH)
+        depth = 0
+        for leaf in self.get_leaves():
+            leaf_depth = leaf.get_depth()
+            if leaf_depth > depth:
+                depth = leaf_depth
+        return depth + 1
+
+    def compute_leaf_count(self):
+        _compute_below(self, _LEAF_COUNT)
+        count = self.head.get_leaf_count()
+        for leaf in self.get_leaves():
+            count += leaf.get_leaf_count()
+        return count
+
+    def compute_sort_key(self):
+        return SortKey(SORT_EXPRESSION, 0.0, '')
 
     def repr(self):
-        return "%s[%s]" % (
-            self.head.repr(), ", ".join([leaf.repr() for leaf in self.leaves]))
+        return fullform(self)
+
+    def compute_hash(self):
+        _compute_below(self, _HASH)
+        h = _hash_combine(_HASH_EXPRESSION, self.head.get_hash())
+        for leaf in self.get_leaves():
+            h = _hash_combine(h, leaf.get_hash())
+        return h
 
     def same(self, other):
-        if not isinstance(other, Expression):
-            return False
-        if not self.head.same(other.head):
-            return False
-        if len(self.leaves) != len(other.leaves):
+        return _same_trees(self, other, False)
+
+    def identical(self, other):
+        return _same_trees(self, other, True)
+
+
+class PackedArray(Expression):
+    """
+    A rectangular List of machine numbers stored in one flat buffer.
+
+    `shape` holds the tensor dimensions. Integer arrays keep their values in
+    `ints` and machine precision Real arrays in `floats` (the other buffer is
+    None). The array behaves like the equivalent nested List: `get_leaves`
+    unpacks it on first use, and rows of a higher rank array are views
+    sharing the same buffer.
+    """
+    def __init__(self, shape, ints, floats, offset=0):
+        Expression.__init__(self, SymbolList)
+        assert len(shape) >= 1
+        assert ints is not None or floats is not None
+        assert ints is None or floats is None
+        self.shape = shape
+        self.ints = ints
+        self.floats = floats
+        self.offset = offset
+        self.unpacked = False
+
+    def is_real(self):
+        return self.floats is not None
+
+    def get_length(self):
+        return self.shape[0]
+
+    def compute_atom_mask(self):
+        # could contain any number
+        return _ATOM_MASK_ALL
+
+    def get_size(self):
+        """
+        number of machine numbers in the array
+        """
+        size = 1
+        for dim in self.shape:
+            size *= dim
+        return size
+
+    def get_stride(self):
+        """
+        number of machine numbers per leaf
+        """
+        stride = 1
+        for dim in self.shape[1:]:
+            stride *= dim
+        return stride
+
+    def get_row(self, i):
+        assert len(self.shape) > 1
+        return PackedArray(self.shape[1:], self.ints, self.floats,
+                           self.offset + i * self.get_stride())
+
+    def get_atom(self, pos):
+        """
+        box the machine number at the given buffer position
+        """
+        if self.floats is not None:
+            return machine_real(self.floats[pos])
+        assert self.ints is not None
+        return MachineInteger(self.ints[pos])
+
+    def compute_depth(self):
+        return len(self.shape) + 1
+
+    def compute_leaf_count(self):
+        count = 1
+        for i in range(len(self.shape) - 1, -1, -1):
+            count = 1 + self.shape[i] * count
+        return count
+
+    def get_leaves(self):
+        if not self.unpacked:
+            n = self.shape[0]
+            if len(self.shape) == 1:
+                self.leaves = [self.get_atom(self.offset + i)
+                               for i in range(n)]
+            else:
+                self.leaves = [self.get_row(i) for i in range(n)]
+            self.unpacked = True
+        return self.leaves
+
+    def compute_hash(self):
+        h = _hash_combine(_HASH_EXPRESSION, self.head.get_hash())
+        n = self.shape[0]
+        if len(self.shape) > 1:
+            for i in range(n):
+                h = _hash_combine(h, self.get_row(i).get_hash())
+        elif self.floats is not None:
+            for i in range(n):
+                mantissa, exp = frexp(self.floats[self.offset + i])
+                h = _hash_combine(h, _hash_real(mantissa, exp, 53))
+        else:
+            assert self.ints is not None
+            for i in range(n):
+                h = _hash_combine(h, _hash_int(self.ints[self.offset + i]))
+        return h
+
+    def same_buffer(self, other, exact):
+        """
+        compare the elements of two arrays, Reals up to the tolerance of
+        `same` unless exact is set
+        """
+        if self.shape != other.shape or self.is_real() != other.is_real():
             return False
-        for self_leaf, other_leaf in zip(self.leaves, other.leaves):
-            if not self_leaf.same(other_leaf):
+        size = self.get_size()
+        if self.floats is not None:
+            assert other.floats is not None
+            for i in range(size):
+                pos1 = self.offset + i
+                pos2 = other.offset + i
+                if self.floats[pos1] == other.floats[pos2]:
+                    continue
+                if exact or not self.get_atom(pos1).same(
+                        other.get_atom(pos2)):
+                    return False
+            return True
+        assert self.ints is not None and other.ints is not None
+        for i in range(size):
+            if self.ints[self.offset + i] != other.ints[other.offset + i]:
                 return False
         return True
 
 
 class Atom(BaseExpression):
+    """
+    Atoms share their head: `head` is a class attribute (set to the matching
+    prebuilt symbol at the bottom of this module) rather than a per-instance
+    Symbol.
+    """
     def __init__(self):
         BaseExpression.__init__(self)
-        self.head = Symbol('System`%s' % self.__class__.__name__)
 
     def is_atom(self):
         return True
@@ -114,19 +492,29 @@ class String(Atom):
     def same(self, other):
         return isinstance(other, String) and self.value == other.value
 
+    def compute_hash(self):
+        return _hash_combine(_HASH_STRING, compute_hash(self.value))
+
+    def compute_sort_key(self):
+        return SortKey(SORT_STRING, 0.0, self.value)
+
     def to_str(self):
         return self.value
 
 
 class Symbol(Atom):
+    """
+    Symbols are interned: there is exactly one Symbol instance per name.
+
+    Always construct symbols with `Symbol.intern(name)` (or use one of the
+    prebuilt `SymbolXXX` constants below) so that `same` reduces to an
+    identity check.
+    """
+    _immutable_fields_ = ['name']
+
     def __init__(self, name):
         assert isinstance(name, str)
-        if name == 'System`Symbol':     # prevent recursion at the root symbol
-            BaseExpression.__init__(self)
-            self.head = self
-            self.leaves = []
-        else:
-            Atom.__init__(self)
+        Atom.__init__(self)
         self.name = name
 
     def repr(self):
@@ -139,27 +527,137 @@ class Symbol(Atom):
         return self.name
 
     def same(self, other):
-        return (isinstance(other, Symbol) and
-                self.get_name() == other.get_name())
+        return self is other
+
+    def compute_hash(self):
+        return _hash_combine(_HASH_SYMBOL, compute_hash(self.name))
+
+    def compute_sort_key(self):
+        return SortKey(SORT_SYMBOL, 0.0, self.name)
+
+    @staticmethod
+    def intern(name):
+        """
+        return the unique Symbol with the given name, creating it if needed
+        """
+        assert isinstance(name, str)
+        symbol = _symbol_table.get(name, None)
+        if symbol is None:
+            symbol = Symbol(name)
+            _symbol_table[name] = symbol
+        return symbol
+
+
+# maps symbol names to their unique Symbol instance
+_symbol_table = {}
 
 
 class Number(Atom):
     def is_number(self):
         return True
 
+    def to_float(self):
+        raise NotImplementedError
+
+    def compute_sort_key(self):
+        return SortKey(SORT_NUMBER, self.to_float(), '')
+
     def repr(self):
         return self.to_str()
 
 
 class Integer(Number):
+    """
+    Integers come in two representations:
+      - MachineInteger stores a machine word inline
+      - BigInteger stores a GMP mpz
+
+    An Integer is a MachineInteger exactly when its value fits in a machine
+    word, so `same` never needs to compare across representations.
+    """
+    def to_mpz(self, dest):
+        """
+        store the value in the given (initialised) mpz
+        """
+        raise NotImplementedError
+
+    def to_mpq(self, dest):
+        """
+        store the value in the given (initialised) mpq
+        """
+        raise NotImplementedError
+
+    def to_mpf(self, dest):
+        """
+        store the value in the given (initialised) mpf
+        """
+        raise NotImplementedError
+
+    def add_to_mpz(self, dest):
+        """
+        add the value to the given mpz in place
+        """
+        raise NotImplementedError
+
+
+class MachineInteger(Integer):
+    def __init__(self, value):
+        Integer.__init__(self)
+        self.intval = value
+
+    def to_str(self, base=10):
+        assert 2 <= base <= 62
+        if base == 10:
+            return str(self.intval)
+        result = BigInteger()
+        self.to_mpz(result.value)
+        return result.to_str(base)
+
+    def to_int(self):
+        return self.intval
+
+    def to_float(self):
+        return float(self.intval)
+
+    def to_mpz(self, dest):
+        c_mpz_set_si(dest, self.intval)
+
+    def to_mpq(self, dest):
+        c_mpq_set_si(dest, self.intval, rffi.r_ulong(1))
+
+    def to_mpf(self, dest):
+        c_mpf_set_si(dest, self.intval)
+
+    def add_to_mpz(self, dest):
+        if self.intval >= 0:
+            c_mpz_add_ui(dest, dest, rffi.r_ulong(self.intval))
+        else:
+            c_mpz_sub_ui(dest, dest, r_uint(0) - r_uint(self.intval))
+
+    def same(self, other):
+        return (isinstance(other, MachineInteger) and
+                self.intval == other.intval)
+
+    def compute_hash(self):
+        return _hash_int(self.intval)
+
+
+class BigInteger(Integer):
     def __init__(self):
-        Number.__init__(self)
-        self.value = lltype.malloc(MPZ_STRUCT, flavor='raw')
-        c_mpz_init(self.value)
+        Integer.__init__(self)
+        self.value = mpz_acquire()
 
+    @rgc.must_be_light_finalizer
     def __del__(self):
-        c_mpz_clear(self.value)
-        lltype.free(self.value, flavor='raw')
+        mpz_release(self.value)
+
+    def normalize(self):
+        """
+        return an equal MachineInteger if the value fits in a machine word
+        """
+        if c_mpz_fits_slong_p(self.value) != 0:
+            return MachineInteger(intmask(c_mpz_get_si(self.value)))
+        return self
 
     def to_str(self, base=10):
         assert 2 <= base <= 62
@@ -170,21 +668,71 @@ class Integer(Number):
         lltype.free(p, flavor='raw')
         return result
 
+    def to_int(self):
+        raise OverflowError
+
+    def to_float(self):
+        return c_mpz_get_d(self.value)
+
+    def to_mpz(self, dest):
+        c_mpz_set(dest, self.value)
+
+    def to_mpq(self, dest):
+        c_mpq_set_z(dest, self.value)
+
+    def to_mpf(self, dest):
+        c_mpf_set_z(dest, self.value)
+
+    def add_to_mpz(self, dest):
+        c_mpz_add(dest, dest, self.value)
+
     def same(self, other):
-        return (isinstance(other, Integer) and
+        return (isinstance(other, BigInteger) and
                 c_mpz_cmp(self.value, other.value) == 0)
 
+    def compute_hash(self):
+        return _hash_mpz(self.value)
+
+
+def add_integers(ints):
+    """
+    sum a list of Integers
+
+    the sum is accumulated in a machine word and only promoted to GMP on
+    overflow or when a BigInteger is encountered.
+    """
+    total = 0
+    i = 0
+    while i < len(ints):
+        arg = ints[i]
+        if not isinstance(arg, MachineInteger):
+            break
+        try:
+            total = ovfcheck(total + arg.intval)
+        except OverflowError:
+            break
+        i += 1
+    if i == len(ints):
+        return MachineInteger(total)
+    result = BigInteger()
+    c_mpz_set_si(result.value, total)
+    while i < len(ints):
+        arg = ints[i]
+        assert isinstance(arg, Integer)
+        arg.add_to_mpz(result.value)
+        i += 1
+    return result.normalize()
+
 
 class Real(Number):
     def __init__(self, prec):
         Number.__init__(self)
         self.prec = prec
-        self.value = lltype.malloc(MPF_STRUCT, flavor='raw')
-        c_mpf_init2(self.value, rffi.r_ulong(prec))
+        self.value = mpf_acquire(rffi.r_ulong(prec))
 
-    def __clear__(self):
-        c_mpf_clear(self.value)
-        lltype.free(self.value, flavor='raw')
+    @rgc.must_be_light_finalizer
+    def __del__(self):
+        mpf_release(self.value)
 
     def to_str(self, base=10):
         assert 2 <= base <= 62
@@ -231,6 +779,19 @@ class Real(Number):
         # in proportion to the precision of the numbers.
         return c_mpf_eq(self.value, other.value, rffi.r_ulong(prec)) != 0
 
+    def identical(self, other):
+        return (isinstance(other, Real) and self.prec == other.prec and
+                c_mpf_cmp(self.value, other.value) == 0)
+
+    def compute_hash(self):
+        # agrees with `identical`, so Reals which are only `same` may hash
+        # differently
+        expp = lltype.malloc(MP_EXP_TP.TO, 1, flavor='raw')
+        mantissa = c_mpf_get_d_2exp(expp, self.value)
+        exp = intmask(expp[0])
+        lltype.free(expp, flavor='raw')
+        return _hash_real(mantissa, exp, self.prec)
+
 
 class Complex(Number):
     def __init__(self, value):
@@ -256,33 +817,50 @@ class Complex(Number):
     def to_complex(self):
         pass
 
+    def to_float(self):
+        return 0.0
+
+    def compute_hash(self):
+        return _HASH_COMPLEX
+
+    def compute_leaf_count(self):
+        return 3
+
 
 class Rational(Number):
     def __init__(self):
         Number.__init__(self)
-        self.value = lltype.malloc(MPQ_STRUCT, flavor='raw')
-        c_mpq_init(self.value)
+        self.value = mpq_acquire()
 
+    @rgc.must_be_light_finalizer
     def __del__(self):
-        c_mpq_clear(self.value)
-        lltype.free(self.value, flavor='raw')
+        mpq_release(self.value)
 
     def same(self, other):
         return (isinstance(other, Rational) and
                 c_mpq_equal(self.value, other.value) != 0)
 
+    def compute_hash(self):
+        part = mpz_acquire()
+        c_mpq_get_num(part, self.value)
+        h = _hash_combine(_HASH_RATIONAL, _hash_mpz(part))
+        c_mpq_get_den(part, self.value)
+        h = _hash_combine(h, _hash_mpz(part))
+        mpz_release(part)
+        return h
+
     def to_str(self, base=10):
         assert 2 <= base <= 62
 
         # find the required length
-        num = lltype.malloc(MPZ_STRUCT, flavor='raw')
-        den = lltype.malloc(MPZ_STRUCT, flavor='raw')
+        num = mpz_acquire()
+        den = mpz_acquire()
         c_mpq_get_num(num, self.value)
         c_mpq_get_den(den, self.value)
         l = (c_mpz_sizeinbase(num, rffi.r_int(base)) +
              c_mpz_sizeinbase(den, rffi.r_int(base)) + 3)
-        lltype.free(num, flavor='raw')
-        lltype.free(den, flavor='raw')
+        mpz_release(num)
+        mpz_release(den)
 
         # get the str
         p = lltype.malloc(rffi.CCHARP.TO, l, flavor='raw')
@@ -294,6 +872,360 @@ class Rational(Number):
     def to_float(self):
         return c_mpq_get_d(self.value)
 
+    def compute_leaf_count(self):
+        return 3
+
+
+# prebuilt symbols used throughout the parser, evaluator and pattern matcher
+SymbolSymbol = Symbol.intern('System`Symbol')
+SymbolString = Symbol.intern('System`String')
+SymbolInteger = Symbol.intern('System`Integer')
+SymbolRational = Symbol.intern('System`Rational')
+SymbolReal = Symbol.intern('System`Real')
+SymbolComplex = Symbol.intern('System`Complex')
+SymbolList = Symbol.intern('System`List')
+SymbolSequence = Symbol.intern('System`Sequence')
+SymbolNull = Symbol.intern('System`Null')
+SymbolAll = Symbol.intern('System`All')
+SymbolPattern = Symbol.intern('System`Pattern')
+SymbolBlank = Symbol.intern('System`Blank')
+SymbolBlankSequence = Symbol.intern('System`BlankSequence')
+SymbolBlankNullSequence = Symbol.intern('System`BlankNullSequence')
+SymbolOptional = Symbol.intern('System`Optional')
+SymbolHold = Symbol.intern('System`Hold')
+SymbolHoldComplete = Symbol.intern('System`HoldComplete')
+SymbolEvaluate = Symbol.intern('System`Evaluate')
+SymbolUnevaluated = Symbol.intern('System`Unevaluated')
+SymbolAborted = Symbol.intern('System`$Aborted')
+SymbolTimeConstrained = Symbol.intern('System`TimeConstrained')
+SymbolMemoryConstrained = Symbol.intern('System`MemoryConstrained')
+SymbolHoldPattern = Symbol.intern('System`HoldPattern')
+SymbolRule = Symbol.intern('System`Rule')
+SymbolRuleDelayed = Symbol.intern('System`RuleDelayed')
+SymbolPlus = Symbol.intern('System`Plus')
+SymbolTimes = Symbol.intern('System`Times')
+SymbolPower = Symbol.intern('System`Power')
+SymbolSpan = Symbol.intern('System`Span')
+SymbolPart = Symbol.intern('System`Part')
+SymbolOut = Symbol.intern('System`Out')
+SymbolSlot = Symbol.intern('System`Slot')
+SymbolSlotSequence = Symbol.intern('System`SlotSequence')
+SymbolFunction = Symbol.intern('System`Function')
+SymbolApply = Symbol.intern('System`Apply')
+SymbolDerivative = Symbol.intern('System`Derivative')
+SymbolMessageName = Symbol.intern('System`MessageName')
+SymbolCompoundExpression = Symbol.intern('System`CompoundExpression')
+SymbolInequality = Symbol.intern('System`Inequality')
+SymbolSet = Symbol.intern('System`Set')
+SymbolSetDelayed = Symbol.intern('System`SetDelayed')
+SymbolTagSet = Symbol.intern('System`TagSet')
+SymbolTagSetDelayed = Symbol.intern('System`TagSetDelayed')
+SymbolUnset = Symbol.intern('System`Unset')
+SymbolTagUnset = Symbol.intern('System`TagUnset')
+SymbolPreIncrement = Symbol.intern('System`PreIncrement')
+SymbolPreDecrement = Symbol.intern('System`PreDecrement')
+
+# every atom of a given class shares the same head
+String.head = SymbolString
+Symbol.head = SymbolSymbol
+Integer.head = SymbolInteger
+Rational.head = SymbolRational
+Real.head = SymbolReal
+Complex.head = SymbolComplex
+
+
+def _number_type_rank(number):
+    if isinstance(number, Integer):
+        return 0
+    elif isinstance(number, Rational):
+        return 1
+    elif isinstance(number, Real):
+        return 2
+    return 3
+
+
+def _compare_exact(number1, number2):
+    """
+    break a tie between numbers whose float approximations are equal
+    """
+    rank1 = _number_type_rank(number1)
+    rank2 = _number_type_rank(number2)
+    if rank1 != rank2:
+        return -1 if rank1 < rank2 else 1
+    if isinstance(number1, Integer) and isinstance(number2, Integer):
+        value1 = mpq_acquire()
+        value2 = mpq_acquire()
+        number1.to_mpq(value1)
+        number2.to_mpq(value2)
+        c = intmask(c_mpq_cmp(value1, value2))
+        mpq_release(value1)
+        mpq_release(value2)
+    elif isinstance(number1, Rational) and isinstance(number2, Rational):
+        c = intmask(c_mpq_cmp(number1.value, number2.value))
+    else:
+        c = 0
+    if c < 0:
+        return -1
+    elif c > 0:
+        return 1
+    return 0
+
+
+# returned by `_compare_keys` for two expressions, which are then compared
+# by their parts
+_BY_PARTS = 2
+
+
+def _compare_keys(expr1, expr2):
+    key1 = expr1.get_sort_key()
+    key2 = expr2.get_sort_key()
+    if key1.rank != key2.rank:
+        return -1 if key1.rank < key2.rank else 1
+    if key1.rank == SORT_NUMBER:
+        if key1.number != key2.number:
+            return -1 if key1.number < key2.number else 1
+        assert isinstance(expr1, Number) and isinstance(expr2, Number)
+        return _compare_exact(expr1, expr2)
+    elif key1.rank != SORT_EXPRESSION:
+        if key1.text != key2.text:
+            return -1 if key1.text < key2.text else 1
+        return 0
+    return _BY_PARTS
+
+
+def compare(expr1, expr2):
+    """
+    compare two expressions in canonical order (as used by Sort and by the
+    Orderless attribute): returns -1, 0 or 1
+
+    Expressions are compared by head, then number of leaves, then leaves,
+    taking the pairs of parts from an explicit stack.
+    """
+    stack1 = [expr1]
+    stack2 = [expr2]
+    # set for a pair whose heads are equal, so that its leaves are next
+    heads_done = [False]
+    while stack1:
+        e1 = stack1.pop()
+        e2 = stack2.pop()
+        if heads_done.pop():
+            leaves1 = e1.get_leaves()
+            leaves2 = e2.get_leaves()
+            if len(leaves1) != len(leaves2):
+                return -1 if len(leaves1) < len(leaves2) else 1
+            i = len(leaves1) - 1
+            while i >= 0:
+                stack1.append(leaves1[i])
+                stack2.append(leaves2[i])
+                heads_done.append(False)
+                i -= 1
+            continue
+        if e1 is e2:
+            continue
+        c = _compare_keys(e1, e2)
+        if c == _BY_PARTS:
+            stack1.append(e1)
+            stack2.append(e2)
+            heads_done.append(True)
+            stack1.append(e1.head)
+            stack2.append(e2.head)
+            heads_done.append(False)
+        elif c != 0:
+            return c
+    return 0
+
+
+def _same_trees(expr1, expr2, exact):
+    """
+    `same`, or `identical` if exact is set, comparing the pairs of parts of
+    two expressions from an explicit stack
+    """
+    stack1 = [expr1]
+    stack2 = [expr2]
+    while stack1:
+        e1 = stack1.pop()
+        e2 = stack2.pop()
+        if e1 is e2:
+            continue
+        if not (isinstance(e1, Expression) and isinstance(e2, Expression)):
+            if isinstance(e1, Expression) or isinstance(e2, Expression):
+                return False
+            if exact:
+                if not e1.identical(e2):
+                    return False
+            elif not e1.same(e2):
+                return False
+            continue
+        if isinstance(e1, PackedArray) and isinstance(e2, PackedArray):
+            if not e1.same_buffer(e2, exact):
+                return False
+            continue
+        # only compare hashes which are already known: computing them walks
+        # both trees, which is no cheaper than comparing them. Reals which
+        # are `same` may hash differently.
+        if (exact and e1._hash != 0 and e2._hash != 0 and
+                e1._hash != e2._hash):
+            return False
+        if e1.get_length() != e2.get_length():
+            return False
+        leaves1 = e1.get_leaves()
+        leaves2 = e2.get_leaves()
+        i = len(leaves1) - 1
+        while i >= 0:
+            stack1.append(leaves1[i])
+            stack2.append(leaves2[i])
+            i -= 1
+        stack1.append(e1.head)
+        stack2.append(e2.head)
+    return True
+
+
+# metadata filled in by `_compute_below`
+_HASH = 0
+_DEPTH = 1
+_LEAF_COUNT = 2
+
+
+def _needs_computing(expr, kind):
+    """
+    whether expr is an Expression whose metadata `kind` is not cached yet
+    (that of packed arrays does not depend on nested expressions)
+    """
+    if not isinstance(expr, Expression) or isinstance(expr, PackedArray):
+        return False
+    if kind == _HASH:
+        return expr._hash == 0
+    elif kind == _DEPTH:
+        return expr._depth == 0
+    return expr._leaf_count == 0
+
+
+def _compute_below(expr, kind):
+    """
+    compute and cache the metadata `kind` of the subexpressions of expr,
+    deepest first, on an explicit stack
+
+    expr itself then only needs that of its head and leaves, so computing it
+    does not recurse however deeply expr is nested.
+    """
+    stack = [expr]
+    while stack:
+        top = stack[-1]
+        pushed = False
+        if kind != _DEPTH and _needs_computing(top.head, kind):
+            stack.append(top.head)
+            pushed = True
+        for leaf in top.get_leaves():
+            if _needs_computing(leaf, kind):
+                stack.append(leaf)
+                pushed = True
+        if pushed:
+            continue
+        stack.pop()
+        if top is expr:
+            continue
+        if kind == _HASH:
+            top.get_hash()
+        elif kind == _DEPTH:
+            top.get_depth()
+        else:
+            top.get_leaf_count()
+
+
+def machine_real(value):
+    result = Real(53)
+    c_mpf_set_d(result.value, value)
+    return result
+
+
+def _packable(leaf):
+    """
+    return 1 for machine sized Integers, 2 for machine precision Reals and 0
+    for anything else
+    """
+    if isinstance(leaf, MachineInteger):
+        return 1
+    elif isinstance(leaf, Real):
+        if leaf.prec == 53:
+            return 2
+    return 0
+
+
+def pack(expr):
+    """
+    return a PackedArray equivalent to the given List, or the List itself if
+    it is not a rectangular array of machine Integers or machine Reals
+    """
+    assert isinstance(expr, Expression)
+    if isinstance(expr, PackedArray) or not expr.head.same(SymbolList):
+        return expr
+    leaves = expr.get_leaves()
+    if not leaves:
+        return expr
+    first = leaves[0]
+    if isinstance(first, PackedArray):
+        # stack packed rows of equal shape and type
+        for leaf in leaves:
+            if not (isinstance(leaf, PackedArray) and
+                    leaf.shape == first.shape and
+                    leaf.is_real() == first.is_real()):
+                return expr
+        shape = [len(leaves)] + first.shape
+        if first.is_real():
+            floats = []
+            for leaf in leaves:
+                assert isinstance(leaf, PackedArray)
+                start = leaf.offset
+                stop = start + leaf.get_size()
+                assert leaf.floats is not None and start >= 0 and stop >= 0
+                floats.extend(leaf.floats[start:stop])
+            return PackedArray(shape, None, floats)
+        ints = []
+        for leaf in leaves:
+            assert isinstance(leaf, PackedArray)
+            start = leaf.offset
+            stop = start + leaf.get_size()
+            assert leaf.ints is not None and start >= 0 and stop >= 0
+            ints.extend(leaf.ints[start:stop])
+        return PackedArray(shape, ints, None)
+    kind = _packable(first)
+    if kind == 0:
+        return expr
+    for leaf in leaves:
+        if _packable(leaf) != kind:
+            return expr
+    if kind == 1:
+        ints = []
+        for leaf in leaves:
+            assert isinstance(leaf, MachineInteger)
+            ints.append(leaf.intval)
+        return PackedArray([len(leaves)], ints, None)
+    floats = []
+    for leaf in leaves:
+        assert isinstance(leaf, Real)
+        floats.append(leaf.to_float())
+    return PackedArray([len(leaves)], None, floats)
+
+
+def expression_dict_factory():
+    """
+    return a function creating empty dicts keyed by BaseExpression (compared
+    with `identical`)
+
+    The annotator gives every dict created at one call site the same key and
+    value types, so each kind of dict needs a factory (and eq and hash
+    functions) of its own.
+    """
+    def expression_eq(expr1, expr2):
+        return expr1.identical(expr2)
+
+    def expression_hash(expr):
+        return expr.get_hash()
+
+    def new_expression_dict():
+        return r_dict(expression_eq, expression_hash)
+    return new_expression_dict
+
 
 def fully_qualified_symbol_name(name):
     return (isinstance(name, str) and
@@ -307,3 +1239,7 @@ def strip_context(name):
     if '`' in name:
         return name[name.rindex('`') + 1:]
     return name
+
+
+# the printer walks expression trees so it is imported once they are defined
+from rmathics.printer import fullform
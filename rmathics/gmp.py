@@ -9,35 +9,72 @@ from rpython.rtyper.lltypesystem import rffi, lltype
 info = ExternalCompilationInfo(includes=['gmp.h'], libraries=['gmp'])
 
 
+def llexternal(name, args, result, **kwds):
+    """
+    an external GMP function. These are short and never block, so they keep
+    the GIL, which lets the JIT call them from elidable functions.
+    """
+    return rffi.llexternal(name, args, result, releasegil=False, **kwds)
+
+
 ## MPZ
 MPZ_STRUCT = rffi.COpaque('__mpz_struct', compilation_info=info)
 MPZ_PTR = lltype.Ptr(MPZ_STRUCT)
+MP_LIMB_T = rffi.ULONG
+MP_SIZE_T = rffi.LONG
 
-c_mpz_init = rffi.llexternal(
+c_mpz_init = llexternal(
     '__gmpz_init', [MPZ_PTR], lltype.Void, compilation_info=info)
-c_mpz_clear = rffi.llexternal(
+c_mpz_clear = llexternal(
     '__gmpz_clear', [MPZ_PTR], lltype.Void, compilation_info=info)
-c_mpz_set_si = rffi.llexternal(
-    '__gmpz_init_set_si', [MPZ_PTR, rffi.LONG], lltype.Void,
+c_mpz_set_si = llexternal(
+    '__gmpz_set_si', [MPZ_PTR, rffi.LONG], lltype.Void,
     compilation_info=info)
-c_mpz_set_ui = rffi.llexternal(
+c_mpz_fits_slong_p = llexternal(
+    '__gmpz_fits_slong_p', [MPZ_PTR], rffi.INT, compilation_info=info)
+c_mpz_get_si = llexternal(
+    '__gmpz_get_si', [MPZ_PTR], rffi.LONG, compilation_info=info)
+c_mpz_set = llexternal(
+    '__gmpz_set', [MPZ_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
+c_mpz_set_ui = llexternal(
     '__gmpz_set_ui', [MPZ_PTR, rffi.ULONG], lltype.Void, compilation_info=info)
-c_mpz_sizeinbase = rffi.llexternal(
+c_mpz_sizeinbase = llexternal(
     '__gmpz_sizeinbase', [MPZ_PTR, rffi.INT], rffi.SIZE_T,
     compilation_info=info)
-c_mpz_get_str = rffi.llexternal(
+c_mpz_get_str = llexternal(
     '__gmpz_get_str', [rffi.CCHARP, rffi.INT, MPZ_PTR], rffi.CCHARP,
     compilation_info=info)
-c_mpz_set_str = rffi.llexternal(
+c_mpz_set_str = llexternal(
     '__gmpz_set_str', [MPZ_PTR, rffi.CCHARP, rffi.INT], rffi.INT,
     compilation_info=info)
-c_mpz_cmp = rffi.llexternal(
+c_mpz_cmp = llexternal(
     '__gmpz_cmp', [MPZ_PTR, MPZ_PTR], rffi.INT, compilation_info=info)
-c_mpz_add = rffi.llexternal(
+c_mpz_cmp_si = llexternal(
+    '__gmpz_cmp_si', [MPZ_PTR, rffi.LONG], rffi.INT, compilation_info=info)
+c_mpz_size = llexternal(
+    '__gmpz_size', [MPZ_PTR], rffi.SIZE_T, compilation_info=info)
+c_mpz_getlimbn = llexternal(
+    '__gmpz_getlimbn', [MPZ_PTR, MP_SIZE_T], MP_LIMB_T, compilation_info=info)
+c_mpz_import = llexternal(
+    '__gmpz_import',
+    [MPZ_PTR, rffi.SIZE_T, rffi.INT, rffi.SIZE_T, rffi.INT, rffi.SIZE_T,
+     rffi.CCHARP],
+    lltype.Void, compilation_info=info)
+c_mpz_neg = llexternal(
+    '__gmpz_neg', [MPZ_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
+c_mpz_get_d = llexternal(
+    '__gmpz_get_d', [MPZ_PTR], rffi.DOUBLE, compilation_info=info)
+c_mpz_add = llexternal(
     '__gmpz_add', [MPZ_PTR, MPZ_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
-c_mpz_mul = rffi.llexternal(
+c_mpz_add_ui = llexternal(
+    '__gmpz_add_ui', [MPZ_PTR, MPZ_PTR, rffi.ULONG], lltype.Void,
+    compilation_info=info)
+c_mpz_sub_ui = llexternal(
+    '__gmpz_sub_ui', [MPZ_PTR, MPZ_PTR, rffi.ULONG], lltype.Void,
+    compilation_info=info)
+c_mpz_mul = llexternal(
     '__gmpz_mul', [MPZ_PTR, MPZ_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
-c_mpz_ui_pow_ui = rffi.llexternal(
+c_mpz_ui_pow_ui = llexternal(
     '__gmpz_ui_pow_ui', [MPZ_PTR, rffi.ULONG, rffi.ULONG], lltype.Void, compilation_info=info)
 
 
@@ -45,41 +82,43 @@ c_mpz_ui_pow_ui = rffi.llexternal(
 MPQ_STRUCT = rffi.COpaque('__mpq_struct', compilation_info=info)
 MPQ_PTR = lltype.Ptr(MPQ_STRUCT)
 
-c_mpq_init = rffi.llexternal(
+c_mpq_init = llexternal(
     '__gmpq_init', [MPQ_PTR], lltype.Void, compilation_info=info)
-c_mpq_clear = rffi.llexternal(
+c_mpq_clear = llexternal(
     '__gmpq_clear', [MPQ_PTR], lltype.Void, compilation_info=info)
-c_mpq_canonicalize = rffi.llexternal(
+c_mpq_canonicalize = llexternal(
     '__gmpq_canonicalize', [MPQ_PTR], lltype.Void, compilation_info=info)
-c_mpq_set_si = rffi.llexternal(
+c_mpq_set_si = llexternal(
     '__gmpq_set_si', [MPQ_PTR, rffi.LONG, rffi.ULONG], lltype.Void,
     compilation_info=info)
-c_mpq_set_ui = rffi.llexternal(
+c_mpq_set_ui = llexternal(
     '__gmpq_set_ui', [MPQ_PTR, rffi.ULONG, rffi.ULONG], lltype.Void,
     compilation_info=info)
-c_mpq_set_str = rffi.llexternal(
+c_mpq_set_str = llexternal(
     '__gmpq_set_str', [MPQ_PTR, rffi.CCHARP, rffi.INT], rffi.INT,
     compilation_info=info)
-c_mpq_set_d = rffi.llexternal(
+c_mpq_set_d = llexternal(
     '__gmpq_set_d', [MPQ_PTR, rffi.DOUBLE], lltype.Void, compilation_info=info)
-c_mpq_equal = rffi.llexternal(
+c_mpq_equal = llexternal(
     '__gmpq_equal', [MPQ_PTR, MPQ_PTR], rffi.INT, compilation_info=info)
-c_mpq_get_num = rffi.llexternal(
+c_mpq_get_num = llexternal(
     '__gmpq_get_num', [MPZ_PTR, MPQ_PTR], lltype.Void, compilation_info=info)
-c_mpq_get_den = rffi.llexternal(
+c_mpq_get_den = llexternal(
     '__gmpq_get_den', [MPZ_PTR, MPQ_PTR], lltype.Void, compilation_info=info)
-c_mpq_set_num = rffi.llexternal(
-    '__gmpq_set_num', [MPQ_PTR, MPZ_PTR], rffi.INT, compilation_info=info)
-c_mpq_set_den = rffi.llexternal(
-    '__gmpq_set_den', [MPQ_PTR, MPZ_PTR], rffi.INT, compilation_info=info)
-c_mpq_get_str = rffi.llexternal(
+c_mpq_set_num = llexternal(
+    '__gmpq_set_num', [MPQ_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
+c_mpq_set_den = llexternal(
+    '__gmpq_set_den', [MPQ_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
+c_mpq_get_str = llexternal(
     '__gmpq_get_str', [rffi.CCHARP, rffi.INT, MPQ_PTR], rffi.CCHARP,
     compilation_info=info)
-c_mpq_get_d = rffi.llexternal(
+c_mpq_get_d = llexternal(
     '__gmpq_get_d', [MPQ_PTR], rffi.DOUBLE, compilation_info=info)
-c_mpq_set_z = rffi.llexternal(
+c_mpq_set_z = llexternal(
     '__gmpq_set_z', [MPQ_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
-c_mpq_add = rffi.llexternal(
+c_mpq_cmp = llexternal(
+    '__gmpq_cmp', [MPQ_PTR, MPQ_PTR], rffi.INT, compilation_info=info)
+c_mpq_add = llexternal(
     '__gmpq_add', [MPQ_PTR, MPQ_PTR, MPQ_PTR], lltype.Void, compilation_info=info)
 
 
@@ -90,27 +129,176 @@ MPF_BITCNT_T = rffi.ULONG
 MP_EXP_T = rffi.LONG
 MP_EXP_TP = rffi.LONGP
 
-c_mpf_init2 = rffi.llexternal(
+c_mpf_init2 = llexternal(
     '__gmpf_init2', [MPF_PTR, MPF_BITCNT_T], lltype.Void,
     compilation_info=info)
-c_mpf_clear = rffi.llexternal(
+c_mpf_clear = llexternal(
     '__gmpf_clear', [MPF_PTR], lltype.Void, compilation_info=info)
-c_mpf_set_d = rffi.llexternal(
+c_mpf_set_d = llexternal(
     '__gmpf_set_d', [MPF_PTR, rffi.DOUBLE], lltype.Void, compilation_info=info)
-c_mpf_get_d = rffi.llexternal(
+c_mpf_get_d = llexternal(
     '__gmpf_get_d', [MPF_PTR], rffi.DOUBLE, compilation_info=info)
-c_mpf_set_str = rffi.llexternal(
+c_mpf_set_str = llexternal(
     '__gmpf_set_str', [MPF_PTR, rffi.CCHARP, rffi.INT], rffi.INT,
     compilation_info=info)
-c_mpf_get_str = rffi.llexternal(
+c_mpf_get_str = llexternal(
     '__gmpf_get_str', [rffi.CCHARP, MP_EXP_TP, rffi.INT, rffi.SIZE_T, MPF_PTR],
     rffi.CCHARP, compilation_info=info)
-c_mpf_eq = rffi.llexternal(
+c_mpf_eq = llexternal(
     '__gmpf_eq', [MPF_PTR, MPF_PTR, MPF_BITCNT_T], rffi.INT,
     compilation_info=info)
-c_mpf_set_z = rffi.llexternal(
+c_mpf_cmp = llexternal(
+    '__gmpf_cmp', [MPF_PTR, MPF_PTR], rffi.INT, compilation_info=info)
+c_mpf_set = llexternal(
+    '__gmpf_set', [MPF_PTR, MPF_PTR], lltype.Void, compilation_info=info)
+c_mpf_set_si = llexternal(
+    '__gmpf_set_si', [MPF_PTR, rffi.LONG], lltype.Void, compilation_info=info)
+c_mpf_set_z = llexternal(
     '__gmpf_set_z', [MPF_PTR, MPZ_PTR], lltype.Void, compilation_info=info)
-c_mpf_set_q = rffi.llexternal(
+c_mpf_set_q = llexternal(
     '__gmpf_set_q', [MPF_PTR, MPQ_PTR], lltype.Void, compilation_info=info)
-c_mpf_add = rffi.llexternal(
+c_mpf_add = llexternal(
     '__gmpf_add', [MPF_PTR, MPF_PTR, MPF_PTR], lltype.Void, compilation_info=info)
+c_mpf_get_prec = llexternal(
+    '__gmpf_get_prec', [MPF_PTR], MPF_BITCNT_T, compilation_info=info)
+c_mpf_get_d_2exp = llexternal(
+    '__gmpf_get_d_2exp', [MP_EXP_TP, MPF_PTR], rffi.DOUBLE,
+    compilation_info=info)
+c_mpf_mul_2exp = llexternal(
+    '__gmpf_mul_2exp', [MPF_PTR, MPF_PTR, MPF_BITCNT_T], lltype.Void,
+    compilation_info=info)
+c_mpf_div_2exp = llexternal(
+    '__gmpf_div_2exp', [MPF_PTR, MPF_PTR, MPF_BITCNT_T], lltype.Void,
+    compilation_info=info)
+c_mpz_set_f = llexternal(
+    '__gmpz_set_f', [MPZ_PTR, MPF_PTR], lltype.Void, compilation_info=info)
+c_mpf_set_prec = llexternal(
+    '__gmpf_set_prec', [MPF_PTR, MPF_BITCNT_T], lltype.Void,
+    compilation_info=info)
+
+
+## Struct pools
+#
+# Numeric atoms take their GMP structs from a free list and hand them back
+# from a light finalizer. Pooled structs stay initialised, so a reused struct
+# also reuses its limbs. Structs whose limbs have grown large are cleared
+# instead of pooled so the pool never pins much memory.
+
+_pool_source = r'''
+#include <stdlib.h>
+#include <gmp.h>
+
+#define RMATHICS_POOL_SIZE 4096
+#define RMATHICS_POOL_MAX_LIMBS 16
+
+static mpz_ptr mpz_pool[RMATHICS_POOL_SIZE];
+static long mpz_pool_count = 0;
+static mpq_ptr mpq_pool[RMATHICS_POOL_SIZE];
+static long mpq_pool_count = 0;
+static mpf_ptr mpf_pool[RMATHICS_POOL_SIZE];
+static long mpf_pool_count = 0;
+
+RPY_EXTERN mpz_ptr rmathics_mpz_acquire(void)
+{
+    mpz_ptr p;
+    if (mpz_pool_count > 0) {
+        p = mpz_pool[--mpz_pool_count];
+        mpz_set_ui(p, 0);
+        return p;
+    }
+    p = (mpz_ptr) malloc(sizeof(__mpz_struct));
+    mpz_init(p);
+    return p;
+}
+
+RPY_EXTERN void rmathics_mpz_release(mpz_ptr p)
+{
+    if (mpz_pool_count < RMATHICS_POOL_SIZE &&
+            p->_mp_alloc <= RMATHICS_POOL_MAX_LIMBS) {
+        mpz_pool[mpz_pool_count++] = p;
+        return;
+    }
+    mpz_clear(p);
+    free(p);
+}
+
+RPY_EXTERN mpq_ptr rmathics_mpq_acquire(void)
+{
+    mpq_ptr p;
+    if (mpq_pool_count > 0) {
+        p = mpq_pool[--mpq_pool_count];
+        mpq_set_ui(p, 0, 1);
+        return p;
+    }
+    p = (mpq_ptr) malloc(sizeof(__mpq_struct));
+    mpq_init(p);
+    return p;
+}
+
+RPY_EXTERN void rmathics_mpq_release(mpq_ptr p)
+{
+    if (mpq_pool_count < RMATHICS_POOL_SIZE &&
+            mpq_numref(p)->_mp_alloc <= RMATHICS_POOL_MAX_LIMBS &&
+            mpq_denref(p)->_mp_alloc <= RMATHICS_POOL_MAX_LIMBS) {
+        mpq_pool[mpq_pool_count++] = p;
+        return;
+    }
+    mpq_clear(p);
+    free(p);
+}
+
+RPY_EXTERN mpf_ptr rmathics_mpf_acquire(mp_bitcnt_t prec)
+{
+    mpf_ptr p;
+    if (mpf_pool_count > 0) {
+        p = mpf_pool[--mpf_pool_count];
+        mpf_set_prec(p, prec);
+        mpf_set_ui(p, 0);
+        return p;
+    }
+    p = (mpf_ptr) malloc(sizeof(__mpf_struct));
+    mpf_init2(p, prec);
+    return p;
+}
+
+RPY_EXTERN void rmathics_mpf_release(mpf_ptr p)
+{
+    if (mpf_pool_count < RMATHICS_POOL_SIZE &&
+            p->_mp_prec <= RMATHICS_POOL_MAX_LIMBS) {
+        mpf_pool[mpf_pool_count++] = p;
+        return;
+    }
+    mpf_clear(p);
+    free(p);
+}
+'''
+
+pool_info = info.merge(ExternalCompilationInfo(
+    separate_module_sources=[_pool_source],
+    post_include_bits=[
+        'RPY_EXTERN mpz_ptr rmathics_mpz_acquire(void);',
+        'RPY_EXTERN void rmathics_mpz_release(mpz_ptr);',
+        'RPY_EXTERN mpq_ptr rmathics_mpq_acquire(void);',
+        'RPY_EXTERN void rmathics_mpq_release(mpq_ptr);',
+        'RPY_EXTERN mpf_ptr rmathics_mpf_acquire(mp_bitcnt_t);',
+        'RPY_EXTERN void rmathics_mpf_release(mpf_ptr);',
+    ]))
+
+# the release functions are called from light finalizers so they must not
+# go through an rffi wrapper
+mpz_acquire = llexternal(
+    'rmathics_mpz_acquire', [], MPZ_PTR, compilation_info=pool_info)
+mpz_release = llexternal(
+    'rmathics_mpz_release', [MPZ_PTR], lltype.Void,
+    compilation_info=pool_info, _nowrapper=True)
+mpq_acquire = llexternal(
+    'rmathics_mpq_acquire', [], MPQ_PTR, compilation_info=pool_info)
+mpq_release = llexternal(
+    'rmathics_mpq_release', [MPQ_PTR], lltype.Void,
+    compilation_info=pool_info, _nowrapper=True)
+mpf_acquire = llexternal(
+    'rmathics_mpf_acquire', [MPF_BITCNT_T], MPF_PTR,
+    compilation_info=pool_info)
+mpf_release = llexternal(
+    'rmathics_mpf_release', [MPF_PTR], lltype.Void,
+    compilation_info=pool_info, _nowrapper=True)
@@ -8,7 +8,14 @@ from rply.token import BaseBox, Token
 from math import log10
 
 from rmathics.expression import (
-    BaseExpression, Expression, Integer, Symbol, String, Rational)
+    BaseExpression, Expression, Integer, Symbol, String, Rational, pack,
+    SymbolAll, SymbolApply, SymbolBlank, SymbolCompoundExpression,
+    SymbolDerivative, SymbolFunction, SymbolInequality, SymbolList,
+    SymbolMessageName, SymbolNull, SymbolOptional, SymbolOut, SymbolPart,
+    SymbolPattern, SymbolPlus, SymbolPower, SymbolPreDecrement,
+    SymbolPreIncrement, SymbolSet, SymbolSetDelayed, SymbolSlot,
+    SymbolSlotSequence, SymbolSpan, SymbolTagSet, SymbolTagSetDelayed,
+    SymbolTagUnset, SymbolTimes, SymbolUnset)
 from rmathics.characters import letters, letterlikes, named_characters
 from rmathics.rpython_util import replace
 from rmathics.convert import int2Integer, str2Integer, str2Real, _mul_pow
@@ -566,7 +573,7 @@ def number(state, p):
     if isint:
         result = str2Integer(value, base)
         if exp != '0':
-            _mul_pow(result.value, base, int(exp))
+            result = _mul_pow(result, base, int(exp))
         return result
     else:
         value = value + '@' + exp
@@ -585,32 +592,32 @@ def string(state, p):
 def slotseq(state, p):
     s = p[0].getstr()
     value = 1 if len(s) == 2 else int(s[2:])
-    return Expression(Symbol('System`SlotSequence'), int2Integer(value))
+    return Expression(SymbolSlotSequence, int2Integer(value))
 
 @pg.production('expr : slotsingle_1')
 @pg.production('expr : slotsingle_2')
 def slotsingle(state, p):
     s = p[0].getstr()
     value = 1 if len(s) == 1 else int(s[1:])
-    return Expression(Symbol('System`Slot'), int2Integer(value))
+    return Expression(SymbolSlot, int2Integer(value))
 
 @pg.production('expr : out_1')
 def out_1(state, p):
     s = p[0].getstr()
     value = int(p[0].getstr()[1:])
     if value == -1:
-        return Expression(Symbol('System`Out'))
+        return Expression(SymbolOut)
     else:
-        return Expression(Symbol('System`Out'), int2Integer(value))
+        return Expression(SymbolOut, int2Integer(value))
 
 @pg.production('expr : out_2')
 def out_2(state, p):
     s = p[0].getstr()
     value = -len(s)
     if value == -1:
-        return Expression(Symbol('System`Out'))
+        return Expression(SymbolOut)
     else:
-        return Expression(Symbol('System`Out'), int2Integer(value))
+        return Expression(SymbolOut, int2Integer(value))
 
 # def t_PutAppend(self, t):
 #     r' \>\>\> '
@@ -644,14 +651,14 @@ def out_2(state, p):
 
 for prefix_op, prefix_tokens in prefix_operators:
     code = """def %s_prefix(state, p):
-    return Expression(Symbol('System`%s'), p[1])""" % (prefix_op, prefix_op)
+    return Expression(Symbol.intern('System`%s'), p[1])""" % (prefix_op, prefix_op)
     for token in prefix_tokens:
         code = ("@pg.production('expr : %s expr')\n" % token) + code
     exec(code)
 
 for infix_op, infix_tokens in infix_operators:
     code = """def %s_infix(state, p):
-    return Expression(Symbol('System`%s'), p[0], p[2])""" % (
+    return Expression(Symbol.intern('System`%s'), p[0], p[2])""" % (
         infix_op, infix_op)
     for token in infix_tokens:
         code = ("@pg.production('expr : expr %s expr')\n" % token) + code
@@ -660,16 +667,16 @@ for infix_op, infix_tokens in infix_operators:
 for flat_infix_op, flat_infix_tokens in flat_infix_operators:
     code = """def %s_flat_infix(state, p):
     args = []
-    if p[0].head.same(Symbol('System`%s')):
+    if p[0].head.same(Symbol.intern('System`%s')):
         args.extend(p[0].leaves)
     else:
         args.append(p[0])
-    if p[2].head.same(Symbol('System`%s')):
+    if p[2].head.same(Symbol.intern('System`%s')):
         args.extend(p[2].leaves)
     else:
         args.append(p[2])
-    expr = Expression(Symbol('System`%s'))
-    expr.leaves = args
+    expr = Expression(Symbol.intern('System`%s'))
+    expr.set_leaves(args)
     return expr""" % (
         flat_infix_op, flat_infix_op, flat_infix_op, flat_infix_op)
     for token in flat_infix_tokens:
@@ -678,7 +685,7 @@ for flat_infix_op, flat_infix_tokens in flat_infix_operators:
 
 for postfix_op, postfix_tokens in postfix_operators:
     code = """def %s_postfix(state, p):
-    return Expression(Symbol('System`%s'), p[0])""" % (postfix_op, postfix_op)
+    return Expression(Symbol.intern('System`%s'), p[0])""" % (postfix_op, postfix_op)
     for token in postfix_tokens:
         code = ("@pg.production('expr : expr %s')\n" % token) + code
     exec(code)
@@ -687,12 +694,12 @@ for ineq_op, ineq_tokens in inequality_operators:
     code = """def %s_inequality(state, p):
         head = p[0].head
         ineq_op = 'System`%s'
-        if head.same(Symbol(ineq_op)):
-            p[0].leaves.append(p[2])
+        if head.same(Symbol.intern(ineq_op)):
+            p[0].append_leaf(p[2])
             return p[0]
-        elif head.same(Symbol('System`Inequality')):
-            p[0].leaves.append(Symbol(ineq_op))
-            p[0].leaves.append(p[2])
+        elif head.same(SymbolInequality):
+            p[0].append_leaf(Symbol.intern(ineq_op))
+            p[0].append_leaf(p[2])
             return p[0]
         elif head.get_name() in ['System`%%s' %% k[0] for k in list(inequality_operators)]:
             leaves = []
@@ -700,13 +707,13 @@ for ineq_op, ineq_tokens in inequality_operators:
                 if i != 0:
                     leaves.append(head)
                 leaves.append(leaf)
-            leaves.append(Symbol(ineq_op))
+            leaves.append(Symbol.intern(ineq_op))
             leaves.append(p[0])
-            expr = Expression(Symbol('System`Inequality'))
-            expr.leaves = leaves
+            expr = Expression(SymbolInequality)
+            expr.set_leaves(leaves)
             return expr
         else:
-            return Expression(Symbol(ineq_op), p[0], p[2])""" % (
+            return Expression(Symbol.intern(ineq_op), p[0], p[2])""" % (
         ineq_op, ineq_op)
     for token in ineq_tokens:
         code = ("@pg.production('expr : expr %s expr')\n" % token) + code
@@ -740,13 +747,13 @@ class SequenceBox(BaseBox):
 @pg.production('expr : expr args', precedence='PART')
 def call(state, p):
     expr = Expression(p[0])
-    expr.leaves = p[1].leaves
+    expr.set_leaves(p[1].leaves)
     return expr
 
 @pg.production('expr : expr position', precedence='PART')
 def part(state, p):
-    expr = Expression(Symbol('System`Part'))
-    expr.leaves = [p[0]] + p[1].leaves
+    expr = Expression(SymbolPart)
+    expr.set_leaves([p[0]] + p[1].leaves)
     return expr
 
 @pg.production('args : RawLeftBracket sequence RawRightBracket')
@@ -755,9 +762,9 @@ def args(state, p):
 
 @pg.production('expr : RawLeftBrace sequence RawRightBrace')
 def llist(state, p): # name prevents collision with builtin list
-    expr = Expression(Symbol('System`List'))
-    expr.leaves = p[1].leaves
-    return expr
+    expr = Expression(SymbolList)
+    expr.set_leaves(p[1].leaves)
+    return pack(expr)
 
 @pg.production('position : RawLeftBracket RawLeftBracket sequence RawRightBracket RawRightBracket')
 def position(state, p):
@@ -775,10 +782,10 @@ def sequence(state, p):
     elif len(p) == 3:
         if p[0].leaves == []:
             state.messages.append(('Syntax', 'com'))
-            p[0].leaves = [Symbol('System`Null')]
+            p[0].leaves = [SymbolNull]
         if p[2].leaves == []:
             state.messages.append(('Syntax', 'com'))
-            p[2].leaves = [Symbol('System`Null')]
+            p[2].leaves = [SymbolNull]
         return SequenceBox(p[0].leaves + p[2].leaves)
     else:
         raise ValueError
@@ -786,7 +793,7 @@ def sequence(state, p):
 @pg.production('expr : symbol')
 def symbol(state, p):
     name = p[0].getstr()
-    return Symbol(state.definitions.lookup_name(name))
+    return Symbol.intern(state.definitions.lookup_name(name))
 
 @pg.production('pattern : blanks')
 def blanks(state, p):
@@ -804,13 +811,13 @@ def blanks(state, p):
     if pieces[-1]:
         piece = Token('symbol', pieces[-1])
         # p[0].getsourcepos() + len(''.join(pieces[:-1]))
-        blank = Expression(Symbol(name), symbol(state, [piece]))
+        blank = Expression(Symbol.intern(name), symbol(state, [piece]))
     else:
-        blank = Expression(Symbol(name))
+        blank = Expression(Symbol.intern(name))
     if pieces[0]:
         piece = Token('symbol', pieces[0])
         # p[0].getsourcepos() + len(''.join(pieces[1:]))
-        return Expression(Symbol('System`Pattern'), symbol(state, [piece]), blank)
+        return Expression(SymbolPattern, symbol(state, [piece]), blank)
     else:
         return blank
 
@@ -819,10 +826,10 @@ def blankdefault(state, p):
     assert isinstance(p[0], str) and len(p[0]) >= 2
     name = p[0][:-2]
     if name:
-        return Expression(Symbol('System`Optional'), Expression(
-            Symbol('System`Pattern'), Symbol(state.definitions.lookup_name(name)), Expression(Symbol('System`Blank'))))
+        return Expression(SymbolOptional, Expression(
+            SymbolPattern, Symbol.intern(state.definitions.lookup_name(name)), Expression(SymbolBlank)))
     else:
-        return Expression(Symbol('System`Optional'), Expression(Symbol('System`Blank')))
+        return Expression(SymbolOptional, Expression(SymbolBlank))
 
 @pg.production('expr : pattern')
 def pattern(state, p):
@@ -845,21 +852,21 @@ def MessageName(state, p):
     else:
         p2 = symbol(state, [p[2]])
     if len(p) == 3:
-        return Expression(Symbol('System`MessageName'), p[0], p2)
+        return Expression(SymbolMessageName, p[0], p2)
     elif len(p) == 5:
         if p[4].getstr().startswith('"'):
             p4 = string(state, [p[4]])
         else:
             p4 = symbol(state, [p[4]])
-        return Expression(Symbol('System`MessageName'), p[0], p2, p4)
+        return Expression(SymbolMessageName, p[0], p2, p4)
 
 @pg.production('expr : Increment expr', precedence='PreIncrement')
 def PreIncrement(state, p):
-    return Expression(Symbol('System`PreIncrement'), p[1])
+    return Expression(SymbolPreIncrement, p[1])
 
 @pg.production('expr : Decrement expr', precedence='PreDecrement')
 def PreDecrement(state, p):
-    return Expression(Symbol('System`PreDecrement'), p[1])
+    return Expression(SymbolPreDecrement, p[1])
 
 @pg.production('expr : expr Prefix expr')
 def Prefix(state, p):
@@ -872,23 +879,23 @@ def p_Infix(state, p):
 @pg.production('expr : expr Apply2 expr')
 def p_Apply2(state, p):
     return Expression(
-        Symbol('System`Apply'), p[0], p[2],
-        Expression(Symbol('System`List'), int2Integer(1)))
+        SymbolApply, p[0], p[2],
+        Expression(SymbolList, int2Integer(1)))
 
 @pg.production('expr : expr Derivative')
 def Derivative(state, p):
     n = len(p[1].getstr())
     is_derivative = (isinstance(p[0], Expression) and
-                     p[0].head.same(Symbol('System`Derivative')) and
+                     p[0].head.same(SymbolDerivative) and
                      isinstance(p[0].head.leaves[0], Integer))
-    if isinstance(p[0].head, Expression) and p[0].head.head.same(Symbol('System`Derivative')):
+    if isinstance(p[0].head, Expression) and p[0].head.head.same(SymbolDerivative):
         head = p[0].head
         leaves = p[0].leaves
         if len(head.leaves) == 1 and isinstance(head.leaves[0], Integer) and len(leaves) == 1:
             n += head.leaves[0].to_int()
             p[0] = leaves[0]
     return Expression(
-        Expression(Symbol('System`Derivative'), int2Integer(n)), p[0])
+        Expression(SymbolDerivative, int2Integer(n)), p[0])
 
 # @pg.production('expr : Integral expr DifferentialD expr',
 #                precedence='Integral')
@@ -897,8 +904,8 @@ def Derivative(state, p):
 
 @pg.production('expr : expr Minus expr')
 def Minus(state, p):
-    return Expression(Symbol('System`Plus'), p[0],
-                      Expression(Symbol('System`Times'), int2Integer(-1), p[2]))
+    return Expression(SymbolPlus, p[0],
+                      Expression(SymbolTimes, int2Integer(-1), p[2]))
 
 @pg.production('expr : Plus expr', precedence='UPlus')
 def UPlus(state, p):
@@ -908,7 +915,7 @@ def UPlus(state, p):
 def UMinus(state, p):
     # if isinstance(p[0], (Integer, Real)):
     # TODO
-    return Expression(Symbol('System`Times'), int2Integer(-1), p[1])
+    return Expression(SymbolTimes, int2Integer(-1), p[1])
 
 # @pg.production('expr : PlusMinus expr', precedence='UPlusMinus')
 # def UPlusMinus(state, p):
@@ -921,8 +928,8 @@ def UMinus(state, p):
 @pg.production('expr : expr RawSlash expr')
 @pg.production('expr : expr Divide expr')
 def Divide(state, p):
-    return Expression(Symbol('System`Times'), p[0],
-                      Expression(Symbol('System`Power'), p[2], int2Integer(-1)))
+    return Expression(SymbolTimes, p[0],
+                      Expression(SymbolPower, p[2], int2Integer(-1)))
 
 @pg.production('expr : expr Times expr')
 @pg.production('expr : expr RawStar expr')
@@ -938,16 +945,16 @@ def Times(state, p):
 
     # flatten
     args = []
-    if arg1.head.same(Symbol('System`Times')):
+    if arg1.head.same(SymbolTimes):
         args.extend(arg1.leaves)
     else:
         args.append(arg1)
-    if arg2.head.same(Symbol('System`Times')):
+    if arg2.head.same(SymbolTimes):
         args.extend(arg2.leaves)
     else:
         args.append(arg2)
-    expr = Expression(Symbol('System`Times'))
-    expr.leaves = args
+    expr = Expression(SymbolTimes)
+    expr.set_leaves(args)
     return expr
 
 @pg.production('expr :      Span')
@@ -960,25 +967,25 @@ def Times(state, p):
 @pg.production('expr : expr Span expr Span expr')
 def Span(state, p):
     if len(p) == 5:
-        return Expression(Symbol('System`Span'), p[0], p[2], p[4])
+        return Expression(SymbolSpan, p[0], p[2], p[4])
     elif len(p) == 4:
         if isinstance(p[0], BaseExpression):
-            return Expression(Symbol('System`Span'), p[0], Symbol('All'), p[3])
+            return Expression(SymbolSpan, p[0], Symbol.intern('All'), p[3])
         elif isinstance(p[1], BaseExpression):
-            return Expression(Symbol('System`Span'), int2Integer(1), p[1], p[3])
+            return Expression(SymbolSpan, int2Integer(1), p[1], p[3])
     elif len(p) == 3:
         if isinstance(p[0], BaseExpression):
-            return Expression(Symbol('System`Span'), p[0], p[2])
+            return Expression(SymbolSpan, p[0], p[2])
         else:
-            return Expression(Symbol('System`Span'), int2Integer(1),
-                              Symbol('System`All'), p[2])
+            return Expression(SymbolSpan, int2Integer(1),
+                              SymbolAll, p[2])
     elif len(p) == 2:
         if isinstance(p[0], BaseExpression):
-            return Expression(Symbol('System`Span'), p[0], Symbol('All'))
+            return Expression(SymbolSpan, p[0], Symbol.intern('All'))
         elif isinstance(p[1], BaseExpression):
-            return Expression(Symbol('System`Span'), int2Integer(1), p[1])
+            return Expression(SymbolSpan, int2Integer(1), p[1])
     elif len(p) == 1:
-            return Expression(Symbol('System`Span'), int2Integer(1), Symbol('All'))
+            return Expression(SymbolSpan, int2Integer(1), Symbol.intern('All'))
 
 # @pg.production('expr : Not expr')
 # FIXME
@@ -997,19 +1004,19 @@ def Pattern(state, p):
     p0 =  symbol(state, [p[0]])
     if len(p) == 5:
         return Expression(
-            Symbol('System`Optional'), Expression(Symbol('System`Pattern'), p0, p[2]), p[4])
+            SymbolOptional, Expression(SymbolPattern, p0, p[2]), p[4])
     elif len(p) == 3:
-        if p[2].head.same(Symbol('System`Pattern')):
+        if p[2].head.same(SymbolPattern):
             return Expression(
-                Symbol('System`Optional'),
-                Expression(Symbol('System`Pattern'), p0, p[2].leaves[0]),
+                SymbolOptional,
+                Expression(SymbolPattern, p0, p[2].leaves[0]),
                 p[2].leaves[1])
         else:
-            return Expression(Symbol('System`Pattern'), p0, p[2])
+            return Expression(SymbolPattern, p0, p[2])
 
 @pg.production('expr : pattern RawColon expr')
 def Optional(state, p):
-    return Expression(Symbol('System`Optional'), p[0], p[2])
+    return Expression(SymbolOptional, p[0], p[2])
 
 @pg.production('expr : expr Postfix expr')
 def Postfix(state, p):
@@ -1019,30 +1026,30 @@ def Postfix(state, p):
 @pg.production('expr : expr Set expr')
 def Set(state, p):
     if len(p) == 3:
-        return Expression(Symbol('System`Set'), p[0], p[2])
+        return Expression(SymbolSet, p[0], p[2])
     elif len(p) == 5:
-        return Expression(Symbol('System`TagSet'), p[0], p[2], p[4])
+        return Expression(SymbolTagSet, p[0], p[2], p[4])
 
 @pg.production('expr : expr TagSet expr SetDelayed expr')
 @pg.production('expr : expr SetDelayed expr')
 def SetDelayed(state, p):
     if len(p) == 3:
-        return Expression(Symbol('System`SetDelayed'), p[0], p[2])
+        return Expression(SymbolSetDelayed, p[0], p[2])
     elif len(p) == 5:
-        return Expression(Symbol('System`TagSetDelayed'), p[0], p[2], p[4])
+        return Expression(SymbolTagSetDelayed, p[0], p[2], p[4])
 
 @pg.production('expr : expr TagSet expr Unset')
 @pg.production('expr : expr Unset')
 def p_Unset(state, p):
     if len(p) == 2:
-        return Expression(Symbol('System`Unset'), p[0])
+        return Expression(SymbolUnset, p[0])
     elif len(p) == 4:
-        return Expression(Symbol('System`TagUnset'), p[0], p[2])
+        return Expression(SymbolTagUnset, p[0], p[2])
 
 @pg.production('expr : expr Function expr')
 def Function(state, p):
-    return Expression(Symbol('System`Function'),
-                      Expression(Symbol('System`List'), p[0]),
+    return Expression(SymbolFunction,
+                      Expression(SymbolList, p[0]),
                       p[2])
 
 # def p_Put(self, args):
@@ -1056,15 +1063,15 @@ def Function(state, p):
 @pg.production('expr : expr Semicolon expr')
 @pg.production('expr : expr Semicolon')
 def Compound(state, p):
-    if p[0].head.same(Symbol('System`CompoundExpression')):
+    if p[0].head.same(SymbolCompoundExpression):
         # TODO?
         pass
     else:
-        p[0] = Expression(Symbol('System`CompoundExpression'), p[0])
+        p[0] = Expression(SymbolCompoundExpression, p[0])
     if len(p) == 3:
-        p[0].leaves.append(p[2])
+        p[0].append_leaf(p[2])
     else:
-        p[0].leaves.append(Symbol('System`Null'))
+        p[0].append_leaf(SymbolNull)
     return p[0]
 
 
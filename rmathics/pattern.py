@@ -1,71 +1,557 @@
 """
-A collection of pattern matching functions
+Pattern matching
+
+Patterns are compiled once with `compile_pattern` into a tree of `Matcher`
+nodes, which can then be matched against any number of expressions without
+looking at the pattern expression again:
+  - `LiteralMatcher`: an atom (or anything else without pattern objects),
+    compared with `same`
+  - `BlankMatcher`: Blank, BlankSequence or BlankNullSequence, optionally
+    restricted to a head
+  - `NamedMatcher`: Pattern[name, p], binding name to what p matches
+  - `ExpressionMatcher`: an expression with a literal head, whose leaves are
+    matched by a precomputed `SequencePlan`, or as a multiset by an
+    `OrderlessPlan` if the head is Orderless
+
+HoldPattern[p] compiles to the matcher of p.
+
+A compiled pattern also carries a `Signature`, conditions that are cheap to
+check and necessary for a match, so that most expressions which do not
+match are turned away without matching them.
+
+Under a Flat head f every pattern which would match one leaf can also match
+a run of them, as if they were grouped into f[...] (see `FlatMatcher`). A
+run of one leaf is matched as the leaf itself, as with OneIdentity. Runs are
+only wrapped into an expression when a pattern needs one, e.g. to bind it to
+a name.
+
+Matching the leaves of one expression tries at most `MATCH_BUDGET`
+candidates. A matcher which runs out raises `MatchBudgetExceeded` rather
+than reporting no match, since the expression may well match.
 """
 
-from rmathics.expression import Atom, Symbol, Expression
-from rmathics.rpython_util import all, permutations
+from rpython.rlib import jit
 
+from rmathics.profiler import profiler
 
-def match(expr, pattern, definitions):
+from rmathics.expression import (
+    Atom, Expression, Symbol, Real, SymbolSequence, SymbolPattern, SymbolBlank,
+    SymbolBlankSequence, SymbolBlankNullSequence, SymbolHoldPattern,
+    expression_dict_factory, atom_bit)
+
+
+def get_printable_location(patt):
+    return patt.repr()
+
+# matching a pattern against each candidate leaf is traced per pattern
+match_driver = jit.JitDriver(
+    greens=['patt'], reds='auto', is_recursive=True,
+    get_printable_location=get_printable_location)
+
+
+class Signature(object):
     """
-    determine whether the expr matches the pattern
-    if it doesn't match return (False, {})
+    necessary conditions for an expression to match a pattern
 
-    if the pattern matches return True and a dict {str: BaseExpression} which
-    maps pattern names to matches subexpressions.
+    `head` is the head it must have (or None), `min_leaves` and `max_leaves`
+    (-1 for any) bound its number of leaves, unless the head is Flat, and
+    `atoms` holds the `atom_bit`s of atoms which must be among them.
     """
+    _immutable_fields_ = ['head', 'min_leaves', 'max_leaves', 'atoms']
 
-    if isinstance(pattern, Atom):
-        return (expr.same(pattern), {})
-    assert isinstance(pattern, Expression)
-    phead = pattern.head
-    if phead.same(Symbol('System`Pattern')):
-        if len(pattern.leaves) != 2:
-            # TODO message Pattern::argr:
-            return False, {}
-        name, patt = pattern.leaves
-        name = name.get_name()
-        doesmatch, mapping = match(expr, patt, definitions)
-        if doesmatch:
-            if name in mapping.keys():
-                # a recursive name can never match e.g. x:_^x_
-                return False, {}
-            mapping[name] = expr
-            return True, mapping
-    elif (phead.same(Symbol('System`Blank')) or
-          phead.same(Symbol('System`BlankSequence')) or
-          phead.same(Symbol('System`BlankNullSequence'))):
-        if len(pattern.leaves) == 0:
+    def __init__(self, head=None, min_leaves=0, max_leaves=-1, atoms=0):
+        self.head = head
+        self.min_leaves = min_leaves
+        self.max_leaves = max_leaves
+        self.atoms = atoms
+
+    def admits(self, expr, definitions):
+        """
+        False if expr certainly does not match, counted by the profiler
+        """
+        admitted = self.check(expr, definitions)
+        if profiler.enabled:
+            profiler.record_signature(admitted)
+        return admitted
+
+    def check(self, expr, definitions):
+        head = self.head
+        if head is not None and not expr.head.same(head):
+            return False
+        length = expr.get_length()
+        if length < self.min_leaves:
+            return False
+        if (self.max_leaves >= 0 and length > self.max_leaves and
+                not (isinstance(head, Symbol) and
+                     'Flat' in definitions.get_attributes(head.get_name()))):
+            return False
+        atoms = self.atoms
+        if atoms != 0 and expr.get_atom_mask() & atoms != atoms:
+            return False
+        return True
+
+# the signature of patterns which can match anything
+any_signature = Signature()
+
+
+class Matcher(object):
+    """
+    a compiled pattern
+
+    `min_length` and `max_length` (-1 for any) give how many consecutive
+    leaves the pattern can match when it is a leaf of another pattern.
+    `signature` is only computed for the patterns returned by
+    `compile_pattern`, the others accept anything.
+    """
+    _immutable_fields_ = ['source', 'min_length', 'max_length']
+
+    def __init__(self, source, min_length=1, max_length=1):
+        self.source = source
+        self.min_length = min_length
+        self.max_length = max_length
+        self.signature = any_signature
+
+    def repr(self):
+        return self.source.repr()
+
+    def match(self, expr, definitions):
+        """
+        determine whether expr matches the pattern
+
+        if it doesn't match return (False, {})
+
+        if the pattern matches return True and a dict {str: BaseExpression}
+        which maps pattern names to matched subexpressions.
+
+        raises MatchBudgetExceeded if it cannot tell in `MATCH_BUDGET` steps.
+        """
+        raise NotImplementedError
+
+    def matches_element(self, expr, definitions):
+        """
+        whether expr can be one of the leaves matched by a sequence pattern
+        """
+        return self.match(expr, definitions)[0]
+
+    def bind_sequence(self, exprs, start, stop, definitions):
+        """
+        the mapping for matching exprs[start:stop], each of which passed
+        `matches_element`, returning like `match`
+        """
+        return True, {}
+
+    def match_run(self, head, exprs, start, stop, definitions):
+        """
+        match head[exprs[start:stop]], returning like `match`
+
+        subclasses avoid building the expression where they can.
+        """
+        expr = Expression(head)
+        expr.set_leaves(exprs[start:stop])
+        return self.match(expr, definitions)
+
+    def required_head(self):
+        """
+        the head every expression matched by the pattern has, or None
+        """
+        return None
+
+    def orderless_rank(self):
+        """
+        how selective the pattern is, 0 (a literal) to 3 (anything), which
+        decides the order patterns are assigned leaves in `OrderlessPlan`
+        """
+        return 3
+
+
+class FailMatcher(Matcher):
+    """
+    a malformed pattern, which matches nothing
+    """
+    def match(self, expr, definitions):
+        return False, {}
+
+
+class LiteralMatcher(Matcher):
+    def match(self, expr, definitions):
+        return expr.same(self.source), {}
+
+    def required_head(self):
+        return self.source.head
+
+    def orderless_rank(self):
+        return 0
+
+
+class BlankMatcher(Matcher):
+    """
+    `head` is the head required of matched expressions, or None
+    """
+    _immutable_fields_ = ['head']
+
+    def __init__(self, source, head, min_length, max_length):
+        Matcher.__init__(self, source, min_length, max_length)
+        self.head = head
+
+    def match(self, expr, definitions):
+        if self.head is None or expr.head.same(self.head):
+            return True, {}
+        return False, {}
+
+    def matches_element(self, expr, definitions):
+        return self.head is None or expr.head.same(self.head)
+
+    def match_run(self, head, exprs, start, stop, definitions):
+        if self.head is None or head.same(self.head):
             return True, {}
-        elif len(pattern.leaves) == 1:
-            if expr.head.same(pattern.leaves[0]):
-                return True, {}
+        return False, {}
+
+    def required_head(self):
+        return self.head
+
+    def orderless_rank(self):
+        if self.head is None:
+            return 3
+        return 2
+
+
+class NamedMatcher(Matcher):
+    _immutable_fields_ = ['name', 'pattern']
+
+    def __init__(self, source, name, pattern):
+        Matcher.__init__(self, source, pattern.min_length, pattern.max_length)
+        self.name = name
+        self.pattern = pattern
+
+    def bind(self, mapping, value):
+        if self.name in mapping:
+            # a recursive name can never match e.g. x:_^x_
+            return False, {}
+        mapping[self.name] = value
+        return True, mapping
+
+    def match(self, expr, definitions):
+        doesmatch, mapping = self.pattern.match(expr, definitions)
+        if not doesmatch:
+            return False, {}
+        return self.bind(mapping, expr)
+
+    def matches_element(self, expr, definitions):
+        return self.pattern.matches_element(expr, definitions)
+
+    def bind_sequence(self, exprs, start, stop, definitions):
+        doesmatch, mapping = self.pattern.bind_sequence(exprs, start, stop,
+                                                        definitions)
+        if not doesmatch:
+            return False, {}
+        value = Expression(SymbolSequence)
+        value.set_leaves(exprs[start:stop])
+        return self.bind(mapping, value)
+
+    def match_run(self, head, exprs, start, stop, definitions):
+        doesmatch, mapping = self.pattern.match_run(head, exprs, start, stop,
+                                                    definitions)
+        if not doesmatch:
+            return False, {}
+        value = Expression(head)
+        value.set_leaves(exprs[start:stop])
+        return self.bind(mapping, value)
+
+    def required_head(self):
+        return self.pattern.required_head()
+
+    def orderless_rank(self):
+        return self.pattern.orderless_rank()
+
+
+class ExpressionMatcher(Matcher):
+    """
+    the plans for every combination of Flat and Orderless are made up front,
+    as the attributes of the head are only known when matching
+    """
+    _immutable_fields_ = ['head', 'leaves[*]', 'plan', 'orderless_plan',
+                          'flat_plan', 'flat_orderless_plan']
+
+    def __init__(self, source, head, leaves):
+        Matcher.__init__(self, source)
+        self.head = head
+        # a fixed-size copy: the plans below share their lists' types with
+        # flat_leaves, which is built by appending
+        self.leaves = [leaf for leaf in leaves]
+        self.plan = make_plan(leaves)
+        self.orderless_plan = OrderlessPlan(leaves)
+        flat_leaves = []
+        for leaf in leaves:
+            # only patterns which can match an expression with our head can
+            # match a run of leaves
+            required_head = leaf.required_head()
+            if leaf.max_length == 1 and (required_head is None or
+                                         required_head.same(head)):
+                flat_leaves.append(FlatMatcher(leaf, head))
             else:
-                return False, {}
-        else:
-            # TODO message p.head::argt
+                flat_leaves.append(leaf)
+        self.flat_plan = make_plan(flat_leaves)
+        self.flat_orderless_plan = OrderlessPlan(flat_leaves)
+
+    def match(self, expr, definitions):
+        if not self.head.same(expr.head):
             return False, {}
-    elif phead.same(expr.head):
-        head_attributes = definitions.get_attributes(phead.get_name())
-        if 'Orderless' in head_attributes:
-            for leaves in permutations(expr.leaves):
-                match0, mapping = _match_seq(leaves, pattern.leaves, definitions)
-                if match0:
-                    return match0, mapping
+        leaves = expr.get_leaves()
+        return self.match_leaves(leaves, 0, len(leaves), definitions)
+
+    def match_run(self, head, exprs, start, stop, definitions):
+        if not self.head.same(head):
             return False, {}
-        return _match_seq(expr.leaves, pattern.leaves, definitions)
-    return False, {}
+        return self.match_leaves(exprs, start, stop, definitions)
+
+    def match_leaves(self, exprs, start, stop, definitions):
+        """
+        match the leaves exprs[start:stop] of an expression with our head
+        """
+        flat = orderless = False
+        head = self.head
+        if isinstance(head, Symbol):
+            head_attributes = definitions.get_attributes(head.get_name())
+            flat = 'Flat' in head_attributes
+            orderless = 'Orderless' in head_attributes
+        if orderless:
+            if start != 0 or stop != len(exprs):
+                exprs = exprs[start:stop]
+            # grouping leaves is only tried if matching them one by one fails
+            matched, mapping = _match_orderless(exprs, self.orderless_plan,
+                                                definitions)
+            if matched or not flat:
+                return matched, mapping
+            return _match_orderless(exprs, self.flat_orderless_plan,
+                                    definitions)
+        if flat:
+            return _match_seq(exprs, self.flat_plan, definitions, start, stop)
+        return _match_seq(exprs, self.plan, definitions, start, stop)
+
+    def required_head(self):
+        return self.head
+
+    def orderless_rank(self):
+        return 1
+
+
+class FlatMatcher(Matcher):
+    """
+    a pattern for one leaf of an expression with the Flat head `head`, which
+    matches runs of one or more leaves: a run of one as the leaf itself and
+    longer ones as head[run]
+    """
+    _immutable_fields_ = ['pattern', 'head']
+
+    def __init__(self, pattern, head):
+        Matcher.__init__(self, pattern.source, 1, -1)
+        self.pattern = pattern
+        self.head = head
+
+    def match(self, expr, definitions):
+        return self.pattern.match(expr, definitions)
+
+    def matches_element(self, expr, definitions):
+        # a run is matched as a whole by bind_sequence
+        return True
+
+    def bind_sequence(self, exprs, start, stop, definitions):
+        if stop - start == 1:
+            return self.pattern.match(exprs[start], definitions)
+        return self.pattern.match_run(self.head, exprs, start, stop,
+                                      definitions)
+
+    def orderless_rank(self):
+        return self.pattern.orderless_rank()
+
+
+class SequencePlan(object):
+    """
+    how to match a list of patterns against a list of leaves
+
+    The list is split at `pivot`, the pattern whose candidate matches are
+    tried first: the first pattern matching exactly one leaf, otherwise the
+    first BlankSequence, otherwise the first BlankNullSequence. The patterns
+    before and after it are matched recursively by the plans `left` and
+    `right` (None for no patterns).
+
+    `index` numbers the plans of one expression pattern, `count` is the
+    number of plans in this one (including itself), and `min_length` and
+    `max_length` (-1 for any) bound the number of leaves it can match.
+    """
+    _immutable_fields_ = ['index', 'pivot', 'left', 'right', 'count',
+                          'min_length', 'max_length']
+
+    def __init__(self, index, pivot, left, right):
+        self.index = index
+        self.pivot = pivot
+        self.left = left
+        self.right = right
+        self.count = 1 + _count(left) + _count(right)
+        self.min_length = (
+            pivot.min_length + _min_length(left) + _min_length(right))
+        if (pivot.max_length < 0 or _max_length(left) < 0 or
+                _max_length(right) < 0):
+            self.max_length = -1
+        else:
+            self.max_length = (
+                pivot.max_length + _max_length(left) + _max_length(right))
+
+
+def _count(plan):
+    if plan is None:
+        return 0
+    return plan.count
+
+
+def _min_length(plan):
+    if plan is None:
+        return 0
+    return plan.min_length
+
+
+def _max_length(plan):
+    if plan is None:
+        return 0
+    return plan.max_length
+
+
+def make_plan(patts, index=0):
+    if not patts:
+        return None
+    pivot = -1
+    for i, patt in enumerate(patts):
+        if patt.max_length == 1:
+            pivot = i
+            break
+    if pivot < 0:
+        for i, patt in enumerate(patts):
+            if patt.min_length > 0:
+                pivot = i
+                break
+    if pivot < 0:
+        pivot = 0
+    left = make_plan(patts[:pivot], index + 1)
+    right = make_plan(patts[pivot + 1:], index + 1 + _count(left))
+    return SequencePlan(index, patts[pivot], left, right)
+
+
+class OrderlessPlan(object):
+    """
+    how to match a list of patterns against the leaves of an Orderless
+    expression, in any order
+
+    `singles` are the patterns matching one leaf each, most selective first,
+    and `sequences` the others. `symmetric[i]` is set if singles[i] is the
+    same pattern as singles[i - 1], so that only one of the equivalent ways
+    to assign leaves to them is tried. `min_length` and `max_length` (-1 for
+    any) bound the number of leaves the patterns can match together.
+    """
+    _immutable_fields_ = ['singles[*]', 'symmetric[*]', 'sequences[*]',
+                          'min_length', 'max_length']
+
+    def __init__(self, patts):
+        singles = []
+        for rank in range(4):
+            for patt in patts:
+                if patt.max_length == 1 and patt.orderless_rank() == rank:
+                    singles.append(patt)
+        sequences = [patt for patt in patts if patt.max_length != 1]
+        # fixed-size copies, the lists built by appending are resizable
+        self.singles = [patt for patt in singles]
+        self.symmetric = [i > 0 and singles[i].source.same(
+            singles[i - 1].source) for i in range(len(singles))]
+        self.sequences = [patt for patt in sequences]
+        self.min_length = 0
+        self.max_length = 0
+        for patt in patts:
+            self.min_length += patt.min_length
+            if patt.max_length < 0 or self.max_length < 0:
+                self.max_length = -1
+            else:
+                self.max_length += patt.max_length
+
+
+def compile_pattern(patt):
+    """
+    compile a pattern expression into a `Matcher`, with its signature
+    """
+    matcher = _compile(patt)
+    matcher.signature = make_signature(matcher)
+    return matcher
+
+
+def make_signature(matcher):
+    head = matcher.required_head()
+    while isinstance(matcher, NamedMatcher):
+        matcher = matcher.pattern
+    if not isinstance(matcher, ExpressionMatcher):
+        if head is None:
+            return any_signature
+        return Signature(head)
+    atoms = 0
+    for leaf in matcher.leaves:
+        # Reals which are `same` may have different hashes, hence bits
+        if (isinstance(leaf, LiteralMatcher) and leaf.source.is_atom() and
+                not isinstance(leaf.source, Real)):
+            atoms |= atom_bit(leaf.source)
+    return Signature(head, _min_length(matcher.plan),
+                     _max_length(matcher.plan), atoms)
+
+
+def _compile(patt):
+    if isinstance(patt, Atom):
+        return LiteralMatcher(patt)
+    assert isinstance(patt, Expression)
+    head = patt.head
+    leaves = patt.get_leaves()
+    if head.same(SymbolPattern):
+        if len(leaves) != 2 or not isinstance(leaves[0], Symbol):
+            # TODO message Pattern::argr:
+            return FailMatcher(patt)
+        return NamedMatcher(patt, leaves[0].get_name(), _compile(leaves[1]))
+    if head.same(SymbolHoldPattern) and len(leaves) == 1:
+        return _compile(leaves[0])
+    if head.same(SymbolBlank):
+        return _compile_blank(patt, 1, 1)
+    if head.same(SymbolBlankSequence):
+        return _compile_blank(patt, 1, -1)
+    if head.same(SymbolBlankNullSequence):
+        return _compile_blank(patt, 0, -1)
+    return ExpressionMatcher(patt, head, [_compile(leaf) for leaf in leaves])
+
+
+def _compile_blank(patt, min_length, max_length):
+    leaves = patt.get_leaves()
+    if len(leaves) == 0:
+        return BlankMatcher(patt, None, min_length, max_length)
+    elif len(leaves) == 1:
+        return BlankMatcher(patt, leaves[0], min_length, max_length)
+    # TODO message p.head::argt
+    return FailMatcher(patt)
+
+
+def match(expr, pattern, definitions):
+    """
+    match expr against the pattern expression, returning like
+    `Matcher.match`
+
+    this compiles the pattern on every call; compile it once with
+    `compile_pattern` to match it repeatedly.
+    """
+    return compile_pattern(pattern).match(expr, definitions)
 
 
 def _merge_dicts(dict1, dict2):
     """
-    merge 2 dicts but raise ValueError if collisions do not agree.
+    merge 2 dicts into a new one but raise ValueError if collisions do not
+    agree.
 
     dicts should be of the form {str: BaseExpression}
 
     TIP: since we loop over dict2, it's more efficient for dict2 to be smaller
     """
-    result = dict1
+    result = dict1.copy()
     for key in dict2:
         value = result.get(key, None)
         if value is not None:
@@ -75,144 +561,385 @@ def _merge_dicts(dict1, dict2):
     return result
 
 
-def _match_seq(exprs, patts, definitions):
+# the most candidate matches tried for the pivots of one list of leaves
+MATCH_BUDGET = 1 << 16
+
+
+class MatchBudgetExceeded(Exception):
+    """
+    raised when matching the leaves of an expression takes more than
+    `MATCH_BUDGET` candidates, so that whether it matches is unknown
+    """
+
+
+class _Solution(object):
+    def __init__(self, matched, mapping):
+        self.matched = matched
+        self.mapping = mapping
+
+
+class _SequenceMatch(object):
     """
-    matches a list of expressions against a list of patterns
+    matches a list of expressions against the patterns of plans
 
-    We match by pairing each pattern to a list of expressions
+    We match by pairing each pattern to a range of expressions
       - BlankSequence matches to one or more expression
       - BlankNullSequence matches to zero or more
       - everything else (including Blank[]) matches to exactly one expression
 
-    Try to match the 'everything else' first. It's more efficient this way.
+    Subproblems are (plan, lo, hi), matching plan against exprs[lo:hi]. The
+    pivot of the plan is matched first, shortest candidates first, and the
+    ranges left on either side of it go to the left and right plans. The
+    solution of every subproblem is memoized, so each is solved once
+    however many candidates lead to it, and the candidates tried are capped
+    by `MATCH_BUDGET`.
+    """
+    def __init__(self, exprs, definitions):
+        self.exprs = exprs
+        self.definitions = definitions
+        self.size = len(exprs) + 1
+        self.memo = {}
+        self.budget = MATCH_BUDGET
+
+    def match(self, plan, lo, hi):
+        """
+        returns (bool, {str: BaseExpression}) like `Matcher.match`.
+        """
+        if plan is None:
+            return lo == hi, {}
+        if hi - lo < plan.min_length:
+            return False, {}
+        if plan.max_length >= 0 and hi - lo > plan.max_length:
+            return False, {}
+        key = (plan.index * self.size + lo) * self.size + hi
+        solution = self.memo.get(key, None)
+        if solution is None:
+            matched, mapping = self.solve(plan, lo, hi)
+            solution = _Solution(matched, mapping)
+            self.memo[key] = solution
+        return solution.matched, solution.mapping
+
+    def spend(self):
+        self.budget -= 1
+        if self.budget < 0:
+            raise MatchBudgetExceeded
+
+    def combine(self, plan, lo, start, stop, hi, mapping0):
+        """
+        match the ranges on either side of a pivot matching exprs[start:stop]
+        """
+        match1, mapping1 = self.match(plan.left, lo, start)
+        if not match1:
+            return False, {}
+        match2, mapping2 = self.match(plan.right, stop, hi)
+        if not match2:
+            return False, {}
+        try:
+            mapping = _merge_dicts(mapping1, mapping2)
+            mapping = _merge_dicts(mapping, mapping0)
+        except ValueError:
+            return False, {}
+        return True, mapping
+
+    def solve(self, plan, lo, hi):
+        patt = plan.pivot
+        # bounds on where the pivot starts and stops, leaving enough (but not
+        # too many) leaves for the plans on either side
+        first_start = lo + _min_length(plan.left)
+        last_start = hi
+        if _max_length(plan.left) >= 0:
+            last_start = min(hi, lo + _max_length(plan.left))
+        last_stop = hi - _min_length(plan.right)
+        first_stop = lo
+        if _max_length(plan.right) >= 0:
+            first_stop = max(lo, hi - _max_length(plan.right))
+
+        if patt.max_length == 1:
+            for start in range(first_start, last_start + 1):
+                stop = start + 1
+                if stop > last_stop:
+                    break
+                if stop < first_stop:
+                    continue
+                match_driver.jit_merge_point(patt=patt)
+                self.spend()
+                match0, mapping0 = patt.match(self.exprs[start],
+                                              self.definitions)
+                if match0:
+                    matched, mapping = self.combine(
+                        plan, lo, start, stop, hi, mapping0)
+                    if matched:
+                        return True, mapping
+            return False, {}
+
+        if last_stop < first_start:
+            return False, {}
+        # runs[i] is the number of consecutive leaves from first_start + i
+        # which can belong to the pivot's match
+        runs = [0] * (last_stop - first_start + 1)
+        for i in range(last_stop - first_start - 1, -1, -1):
+            if patt.matches_element(self.exprs[first_start + i],
+                                    self.definitions):
+                runs[i] = runs[i + 1] + 1
+        max_len = last_stop - first_start
+        if patt.max_length >= 0:
+            max_len = min(max_len, patt.max_length)
+        for match_len in range(patt.min_length, max_len + 1):
+            # begin looking for the shortest matches
+            for start in range(first_start, last_start + 1):
+                stop = start + match_len
+                if stop > last_stop:
+                    break
+                if stop < first_stop or runs[start - first_start] < match_len:
+                    continue
+                self.spend()
+                match0, mapping0 = patt.bind_sequence(self.exprs, start, stop,
+                                                     self.definitions)
+                if match0:
+                    matched, mapping = self.combine(
+                        plan, lo, start, stop, hi, mapping0)
+                    if matched:
+                        return True, mapping
+        return False, {}
+
+
+# classes of equal leaves by leaf, and lists of classes by head
+_new_class_index = expression_dict_factory()
+_new_bucket_dict = expression_dict_factory()
+
 
-    returns (bool, {str: BaseExpression}) like the function match above.
+class _OrderlessMatch(object):
     """
-    if len(patts) == len(exprs) == 0:
-        return True, {}
+    matches the leaves of an Orderless expression against an OrderlessPlan
 
-    patti, name = -1, None
-    for i, patt in enumerate(patts):
-        if patt.head.same(Symbol('System`Pattern')):
-            if len(patt.leaves) != 2:
-                # TODO message Pattern::argr:
-                return False, {}
-            name2, patt2 = patt.leaves
-            if patt2.head.same(Symbol('System`BlankSequence')):
+    Equal leaves are grouped into classes, so that assignments which only
+    differ by exchanging equal leaves are not tried twice, and classes are
+    bucketed by head so that a pattern requiring a head only looks at the
+    leaves which have it.
+
+    The single patterns are assigned a class each by backtracking, checking
+    that their bindings agree, and the remaining leaves are then distributed
+    over the sequence patterns as sub-multisets. Whether a pattern matches a
+    class is computed at most once.
+    """
+    def __init__(self, exprs, plan, definitions):
+        self.plan = plan
+        self.definitions = definitions
+        self.budget = MATCH_BUDGET
+        # classes of equal leaves, in order of first occurrence
+        self.classes = []
+        self.counts = []
+        index = _new_class_index()
+        for expr in exprs:
+            c = index.get(expr, -1)
+            if c < 0:
+                index[expr] = len(self.classes)
+                self.classes.append(expr)
+                self.counts.append(1)
+            else:
+                self.counts[c] += 1
+        self.all_classes = range(len(self.classes))
+        self.buckets = _new_bucket_dict()
+        for c, expr in enumerate(self.classes):
+            bucket = self.buckets.get(expr.head, None)
+            if bucket is None:
+                bucket = []
+                self.buckets[expr.head] = bucket
+            bucket.append(c)
+        nclasses = len(self.classes)
+        # per single pattern and class: None if not tried yet, otherwise the
+        # result of matching
+        self.single_results = [None] * (len(plan.singles) * nclasses)
+        # per sequence pattern and class: 0 if not tried yet, 1 if the class
+        # can be part of its match and -1 if not
+        self.element_results = [0] * (len(plan.sequences) * nclasses)
+        self.chosen = [0] * len(plan.singles)
+
+    def spend(self):
+        self.budget -= 1
+        if self.budget < 0:
+            raise MatchBudgetExceeded
+
+    def candidates(self, patt):
+        head = patt.required_head()
+        if head is None:
+            return self.all_classes
+        return self.buckets.get(head, _no_classes)
+
+    def match_single(self, i, c):
+        key = i * len(self.classes) + c
+        solution = self.single_results[key]
+        if solution is None:
+            matched, mapping = self.plan.singles[i].match(
+                self.classes[c], self.definitions)
+            solution = _Solution(matched, mapping)
+            self.single_results[key] = solution
+        return solution.matched, solution.mapping
+
+    def allows(self, j, c):
+        key = j * len(self.classes) + c
+        result = self.element_results[key]
+        if result == 0:
+            result = -1
+            if self.plan.sequences[j].matches_element(self.classes[c],
+                                                      self.definitions):
+                result = 1
+            self.element_results[key] = result
+        return result > 0
+
+    def assign(self, i, mapping):
+        """
+        assign classes to singles[i:], then distribute what is left
+        """
+        singles = self.plan.singles
+        if i == len(singles):
+            return self.distribute(0, mapping)
+        first = 0
+        if self.plan.symmetric[i]:
+            first = self.chosen[i - 1]
+        for c in self.candidates(singles[i]):
+            if c < first or self.counts[c] == 0:
                 continue
-            if patt2.head.same(Symbol('System`BlankNullSequence')):
+            self.spend()
+            match0, mapping0 = self.match_single(i, c)
+            if not match0:
                 continue
-            else:
-                name = name2.get_name()
-                patti = i
-                break
-        if patt.head.same(Symbol('System`BlankSequence')):
-            continue
-        elif patt.head.same(Symbol('System`BlankNullSequence')):
-            continue
-        else:
-            patti = i
-            break
-    if patti >= 0:       # everything else
-        patt = patts[patti]
-        if patt.head.same(Symbol('System`Pattern')):
-            patt = patt.leaves[0]
-        for expri, expr in enumerate(exprs):
-            match0, mapping0 = match(expr, patt, definitions)
-            if match0:
-                match1, mapping1 = _match_seq(
-                    exprs[:expri], patts[:patti], definitions)
-                match2, mapping2 = _match_seq(
-                    exprs[expri+1:], patts[patti+1:], definitions)
-                try:
-                    if match1 and match2:
-                        mapping = _merge_dicts(mapping1, mapping2)
-                        mapping = _merge_dicts(mapping, mapping0)
-                        if name is not None:
-                            mapping = _merge_dicts(mapping, {name: expr})
-                        return True, mapping
-                except ValueError:
-                    pass
+            try:
+                merged = _merge_dicts(mapping, mapping0)
+            except ValueError:
+                continue
+            self.counts[c] -= 1
+            self.chosen[i] = c
+            matched, result = self.assign(i + 1, merged)
+            self.counts[c] += 1
+            if matched:
+                return True, result
         return False, {}
 
-    for i, patt in enumerate(patts):
-        if patt.head.same(Symbol('System`Pattern')):
-            assert len(patt.leaves) == 2
-            name2, patt2 = patt.leaves
-            if patt2.head.same(Symbol('System`BlankSequence')):
-                name = name2.get_name()
-                patti = i
+    def distribute(self, j, mapping):
+        """
+        give sub-multisets of the remaining leaves to sequences[j:]
+
+        Leaves which no later sequence can take must go to sequences[j], so
+        only the leaves which later ones could take as well are enumerated.
+        """
+        sequences = self.plan.sequences
+        if j == len(sequences):
+            for count in self.counts:
+                if count:
+                    return False, {}
+            return True, mapping
+        patt = sequences[j]
+        taken = [0] * len(self.counts)
+        forced = 0
+        optional = []
+        available = 0
+        for c in range(len(self.counts)):
+            if self.counts[c] == 0:
+                continue
+            later = False
+            for k in range(j + 1, len(sequences)):
+                if self.allows(k, c):
+                    later = True
+                    break
+            if not later:
+                if not self.allows(j, c):
+                    return False, {}
+                taken[c] = self.counts[c]
+                forced += self.counts[c]
+            elif self.allows(j, c):
+                optional.append(c)
+                available += self.counts[c]
+        # begin looking for the smallest matches
+        for extra in range(available + 1):
+            size = forced + extra
+            if size < patt.min_length:
+                continue
+            if patt.max_length >= 0 and size > patt.max_length:
                 break
-        if patt.head.same(Symbol('System`BlankSequence')):
-            patti = i
-            break
-    if patti >= 0:
-        patt = patts[patti]
-        if patt.head.same(Symbol('System`Pattern')):
-            patt = patt.leaves[1]
-        for match_len in range(1, len(exprs)+1):
-            # begin looking for length 1 matches
-            for start_pos in range(len(exprs)+1-match_len):
-                if len(patt.leaves) == 0:
-                    pass
-                elif len(patt.leaves) == 1:
-                    if not all([expr.head.same(patt.leaves[0]) for expr in
-                                exprs[start_pos:start_pos+match_len]]):
-                        continue
-                else:
-                    raise ValueError
-                match0, mapping0 = _match_seq(
-                    exprs[:start_pos], patts[:patti], definitions)
-                match1, mapping1 = _match_seq(
-                    exprs[start_pos+match_len:], patts[patti+1:], definitions)
-                expr = Expression(Symbol('System`Sequence'))
-                expr.leaves = exprs[start_pos:start_pos+match_len]
-                try:
-                    mapping = _merge_dicts(mapping0, mapping1)
-                    if match0 and match1:
-                        if name is not None:
-                            mapping = _merge_dicts(mapping, {name: expr})
-                        return True, mapping
-                except ValueError:
-                    pass
+            matched, result = self.choose(j, mapping, taken, optional, 0,
+                                          extra)
+            if matched:
+                return True, result
         return False, {}
 
-    if patts == []:
-        assert exprs != []
+    def choose(self, j, mapping, taken, optional, k, size):
+        """
+        enumerate the sub-multisets of `size` more leaves from the classes
+        optional[k:] for sequences[j], then continue with the next sequence
+        """
+        if size == 0:
+            return self.take(j, mapping, taken)
+        if k == len(optional):
+            return False, {}
+        c = optional[k]
+        for n in range(min(self.counts[c], size), -1, -1):
+            taken[c] = n
+            matched, result = self.choose(j, mapping, taken, optional, k + 1,
+                                          size - n)
+            taken[c] = 0
+            if matched:
+                return True, result
         return False, {}
-    patti = 0
-    patt = patts[patti]
-    if patt.head.same(Symbol('System`Pattern')):
-            assert len(patt.leaves) == 2
-            name2, patt2 = patt.leaves
-            name = name2.get_name()
-            assert patt2.head.same(Symbol('System`BlankNullSequence'))
-            patt = patt2
-    else:
-        assert patt.head.same(Symbol('System`BlankNullSequence'))
-    for match_len in range(0, len(exprs)+1):
-        # begin looking for length 0 matches
-        for start_pos in range(len(exprs)+1-match_len):
-            if len(patt.leaves) == 0:
-                pass
-            elif len(patt.leaves) == 1:
-                if not all([expr.head.same(patt.leaves[0]) for expr in
-                            exprs[start_pos:start_pos+match_len]]):
-                    continue
-            else:
-                raise ValueError
-            match0, mapping0 = _match_seq(
-                exprs[:start_pos], patts[:patti], definitions)
-            match1, mapping1 = _match_seq(
-                exprs[start_pos+match_len:], patts[patti+1:], definitions)
-            expr = Expression(Symbol('System`Sequence'))
-            expr.leaves = exprs[start_pos:start_pos+match_len]
-            try:
-                mapping = _merge_dicts(mapping0, mapping1)
-                if match0 and match1:
-                    if name is not None:
-                        mapping = _merge_dicts(mapping, {name: expr})
-                    return True, mapping
-            except ValueError:
-                pass
-    return False, {}
+
+    def take(self, j, mapping, taken):
+        """
+        bind sequences[j] to taken[c] leaves of each class c, then distribute
+        the others
+        """
+        patt = self.plan.sequences[j]
+        leaves = []
+        for c in range(len(self.counts)):
+            if taken[c] and not self.allows(j, c):
+                return False, {}
+            for k in range(taken[c]):
+                leaves.append(self.classes[c])
+        if len(leaves) < patt.min_length:
+            return False, {}
+        if patt.max_length >= 0 and len(leaves) > patt.max_length:
+            return False, {}
+        self.spend()
+        match0, mapping0 = patt.bind_sequence(leaves, 0, len(leaves),
+                                              self.definitions)
+        if not match0:
+            return False, {}
+        try:
+            merged = _merge_dicts(mapping, mapping0)
+        except ValueError:
+            return False, {}
+        for c in range(len(self.counts)):
+            self.counts[c] -= taken[c]
+        matched, result = self.distribute(j + 1, merged)
+        for c in range(len(self.counts)):
+            self.counts[c] += taken[c]
+        return matched, result
+
+_no_classes = []
+
+
+def _match_orderless(exprs, plan, definitions):
+    """
+    matches the leaves of an Orderless expression against the patterns of a
+    plan in any order
+
+    returns (bool, {str: BaseExpression}) like `Matcher.match`
+    """
+    if len(exprs) < plan.min_length:
+        return False, {}
+    if plan.max_length >= 0 and len(exprs) > plan.max_length:
+        return False, {}
+    matcher = _OrderlessMatch(exprs, plan, definitions)
+    return matcher.assign(0, {})
+
+
+def _match_seq(exprs, plan, definitions, start=0, stop=-1):
+    """
+    matches the expressions exprs[start:stop] (all of them by default)
+    against the patterns of a plan
+
+    returns (bool, {str: BaseExpression}) like `Matcher.match`
+    """
+    if stop < 0:
+        stop = len(exprs)
+    matcher = _SequenceMatch(exprs, definitions)
+    return matcher.match(plan, start, stop)
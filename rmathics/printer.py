@@ -0,0 +1,118 @@
+"""
+FullForm printing of expression trees.
+
+The tree is walked once with an explicit stack and streamed into a single
+`StringBuilder`, so printing takes time linear in the size of the output and
+does not recurse on deeply nested expressions.
+
+An optional size cap elides whatever does not fit, as Short does: once the
+output reaches `limit` characters the remaining leaves of every open
+expression are replaced by `<<n>>`, where n is the number of leaves omitted.
+Heads are always printed.
+"""
+
+from rpython.rlib.rstring import StringBuilder
+
+from rmathics.expression import Expression, PackedArray
+
+
+class _Frame(object):
+    """
+    an expression whose leaves are being printed
+
+    `index` is the next leaf to print, or -1 while the head is printed.
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        if isinstance(expr, PackedArray):
+            self.leaves = None
+            self.length = expr.shape[0]
+        else:
+            self.leaves = expr.get_leaves()
+            self.length = len(self.leaves)
+        self.index = -1
+
+
+class Printer(object):
+    def __init__(self, limit=-1):
+        self.builder = StringBuilder()
+        self.limit = limit
+        self.stack = []
+
+    def is_full(self):
+        return self.limit >= 0 and self.builder.getlength() >= self.limit
+
+    def fits(self, text):
+        return (self.limit < 0 or
+                self.builder.getlength() + len(text) <= self.limit)
+
+    def visit(self, expr, elide=True):
+        """
+        print an atom, or open a frame for an expression
+        """
+        if isinstance(expr, Expression):
+            self.stack.append(_Frame(expr))
+        else:
+            self.emit_atom(expr.repr(), elide)
+
+    def emit_atom(self, text, elide=True):
+        if not elide or self.fits(text):
+            self.builder.append(text)
+        else:
+            self.builder.append('<<1>>')
+
+    def visit_leaf(self, frame, i):
+        if frame.leaves is not None:
+            self.visit(frame.leaves[i])
+            return
+        array = frame.expr
+        assert isinstance(array, PackedArray)
+        if len(array.shape) > 1:
+            self.stack.append(_Frame(array.get_row(i)))
+        elif array.ints is not None:
+            self.emit_atom(str(array.ints[array.offset + i]))
+        else:
+            self.emit_atom(array.get_atom(array.offset + i).repr())
+
+    def step(self):
+        frame = self.stack[-1]
+        if frame.index == -1:
+            # print the head (atomic heads are never elided), then come back
+            # to open the bracket
+            frame.index = 0
+            self.visit(frame.expr.head, False)
+            return
+        if frame.index == 0:
+            self.builder.append('[')
+        if frame.index >= frame.length:
+            self.builder.append(']')
+            self.stack.pop()
+            return
+        if frame.index > 0:
+            self.builder.append(', ')
+        if self.is_full():
+            self.builder.append('<<%d>>]' % (frame.length - frame.index))
+            self.stack.pop()
+            return
+        i = frame.index
+        frame.index += 1
+        self.visit_leaf(frame, i)
+
+    def print_expr(self, expr):
+        self.visit(expr)
+        while self.stack:
+            self.step()
+
+    def build(self):
+        return self.builder.build()
+
+
+def fullform(expr, limit=-1):
+    """
+    FullForm of `expr`, eliding leaves beyond roughly `limit` characters
+
+    a negative limit prints the whole expression.
+    """
+    printer = Printer(limit)
+    printer.print_expr(expr)
+    return printer.build()
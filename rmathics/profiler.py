@@ -0,0 +1,147 @@
+"""
+An opt-in profiler for evaluation.
+
+While `profiler.enabled` is set the evaluator records, for every head it
+evaluates and every builtin rule it tries, how often and for how long. When
+it is not set the evaluator only reads the flag, which is quasi-immutable so
+JITted code does not even do that.
+
+Times are in seconds:
+  - for heads, `inclusive` covers evaluating the whole expression and
+    `exclusive` excludes the nested expressions evaluated along the way
+  - for builtin rules, `inclusive` covers matching the pattern and calling the
+    rule and `exclusive` only the call
+
+It also counts how many expressions pattern signatures were checked against
+and how many of them they rejected (see `rmathics.pattern.Signature`).
+"""
+
+from rpython.rlib.listsort import make_timsort_class
+
+
+class Stats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.attempts = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+
+def _slower(stats1, stats2):
+    return stats1.exclusive > stats2.exclusive
+
+StatsSort = make_timsort_class(lt=_slower)
+
+
+class Profiler(object):
+    _immutable_fields_ = ['enabled?']
+
+    def __init__(self):
+        self.enabled = False
+        self.heads = {}
+        self.rules = {}
+        self.signatures_checked = 0
+        self.signatures_rejected = 0
+
+    def start(self):
+        """
+        discard the data collected so far and start collecting
+        """
+        self.heads = {}
+        self.rules = {}
+        self.signatures_checked = 0
+        self.signatures_rejected = 0
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def record_head(self, name, inclusive, exclusive):
+        stats = self.heads.get(name, None)
+        if stats is None:
+            stats = Stats(name)
+            self.heads[name] = stats
+        stats.calls += 1
+        stats.inclusive += inclusive
+        stats.exclusive += exclusive
+
+    def record_rule(self, name, matched, inclusive, exclusive):
+        """
+        record an attempt to apply a builtin rule, which was called only if
+        its pattern matched
+        """
+        stats = self.rules.get(name, None)
+        if stats is None:
+            stats = Stats(name)
+            self.rules[name] = stats
+        stats.attempts += 1
+        if matched:
+            stats.calls += 1
+        stats.inclusive += inclusive
+        stats.exclusive += exclusive
+
+    def record_signature(self, admitted):
+        self.signatures_checked += 1
+        if not admitted:
+            self.signatures_rejected += 1
+
+    def head_stats(self):
+        """
+        the Stats of every head, slowest (by exclusive time) first
+        """
+        return _sorted(self.heads)
+
+    def rule_stats(self):
+        """
+        the Stats of every builtin rule, slowest (by exclusive time) first
+        """
+        return _sorted(self.rules)
+
+    def dump(self):
+        """
+        a plain text report
+        """
+        lines = [_row('head', ['calls', 'inclusive', 'exclusive'],
+                      [10, 12, 12])]
+        for stats in self.head_stats():
+            lines.append(_row(stats.name, [
+                str(stats.calls), '%f' % stats.inclusive,
+                '%f' % stats.exclusive], [10, 12, 12]))
+        lines.append('')
+        lines.append(_row('builtin rule', [
+            'attempts', 'matches', 'inclusive', 'exclusive'],
+            [10, 10, 12, 12]))
+        for stats in self.rule_stats():
+            lines.append(_row(stats.name, [
+                str(stats.attempts), str(stats.calls), '%f' % stats.inclusive,
+                '%f' % stats.exclusive], [10, 10, 12, 12]))
+        lines.append('')
+        lines.append('signatures: %d checked, %d rejected' % (
+            self.signatures_checked, self.signatures_rejected))
+        return '\n'.join(lines)
+
+
+def _pad(text, width):
+    if len(text) >= width:
+        return ''
+    return ' ' * (width - len(text))
+
+
+def _row(name, columns, widths):
+    """
+    a line of the report: name left aligned in 40 characters, then the
+    columns right aligned in their widths (RPython's % has no widths)
+    """
+    parts = [name + _pad(name, 40)]
+    for i in range(len(columns)):
+        parts.append(_pad(columns[i], widths[i]) + columns[i])
+    return ' '.join(parts)
+
+
+def _sorted(table):
+    result = table.values()
+    StatsSort(result).sort()
+    return result
+
+profiler = Profiler()
@@ -0,0 +1,424 @@
+"""
+Binary serialization of expression trees.
+
+`dumps` turns an expression into a byte string and `loads` reverses it. The
+format is in the spirit of Mathematica's WXF:
+
+    magic    "RMX" followed by a version byte
+    symbols  varint count, then each name as a varint length and its bytes
+    strings  varint count, then each value as a varint length and its bytes
+    body     a single node, written in preorder
+
+Each node starts with a one byte tag:
+
+    'S'  symbol: varint index into the symbol table
+    's'  string: varint index into the string table
+    'i'  machine integer: zigzag varint
+    'I'  big integer: sign byte (0, 1 or 2 for zero, positive, negative),
+         varint byte count, magnitude as little endian bytes
+    'q'  rational: numerator and positive denominator, each encoded as for
+         'I'. Common factors are cancelled when it is read.
+    'r'  real: varint precision, zigzag varint binary exponent and a mantissa
+         encoded as for 'I', so that value = mantissa * 2^exponent exactly
+    'f'  expression: varint leaf count, the head node, then the leaves
+    'p'  packed array: kind byte ('i' or 'r'), varint rank, varint dimensions,
+         then every element as 8 little endian bytes (two's complement ints
+         or IEEE doubles)
+
+Big numbers are copied limb by limb so nothing is formatted as text, and
+symbols and strings are stored once however often they occur.
+"""
+
+from rpython.rtyper.lltypesystem import rffi, lltype
+from rpython.rlib.rarithmetic import intmask, ovfcheck, r_uint, LONG_BIT
+from rpython.rlib.rstring import StringBuilder
+from rpython.rlib.rstruct.ieee import float_pack, float_unpack
+
+from rmathics.expression import (
+    BaseExpression, Expression, PackedArray, Symbol, String, MachineInteger,
+    BigInteger, Rational, Real, Complex)
+from rmathics.gmp import (
+    MP_LIMB_T, MP_SIZE_T, MP_EXP_TP,
+    c_mpz_size, c_mpz_getlimbn, c_mpz_cmp_si, c_mpz_import, c_mpz_neg,
+    c_mpz_set_f, c_mpz_set_si, c_mpz_sizeinbase,
+    c_mpq_get_num, c_mpq_get_den, c_mpq_set_num, c_mpq_set_den,
+    c_mpq_canonicalize,
+    c_mpf_get_prec, c_mpf_get_d_2exp, c_mpf_mul_2exp, c_mpf_div_2exp,
+    c_mpf_set, c_mpf_set_z,
+    mpz_acquire, mpz_release, mpf_acquire, mpf_release,
+)
+
+MAGIC = 'RMX'
+VERSION = 1
+
+LIMB_BYTES = rffi.sizeof(MP_LIMB_T)
+
+
+def _zigzag(value):
+    return (r_uint(value) << 1) ^ r_uint(value >> (LONG_BIT - 1))
+
+
+def _unzigzag(value):
+    return intmask(value >> 1) ^ -intmask(value & 1)
+
+
+class _Writer(object):
+    def __init__(self):
+        self.body = StringBuilder()
+        self.symbols = []
+        self.symbol_index = {}
+        self.strings = []
+        self.string_index = {}
+
+    def write_byte(self, byte):
+        self.body.append(chr(byte))
+
+    def write_varint(self, value):
+        """
+        write an r_uint in 7 bit groups, least significant first
+        """
+        while value >= 0x80:
+            self.body.append(chr(intmask(value & 0x7f) | 0x80))
+            value >>= 7
+        self.body.append(chr(intmask(value)))
+
+    def write_word(self, value):
+        """
+        write an r_uint as 8 little endian bytes
+        """
+        for i in range(8):
+            self.body.append(chr(intmask(value & 0xff)))
+            value >>= 8
+
+    def write_mpz(self, value):
+        sign = c_mpz_cmp_si(value, 0)
+        if sign == 0:
+            self.write_byte(0)
+            return
+        self.write_byte(1 if sign > 0 else 2)
+        nlimbs = intmask(c_mpz_size(value))
+        self.write_varint(r_uint(nlimbs * LIMB_BYTES))
+        for i in range(nlimbs):
+            limb = r_uint(c_mpz_getlimbn(value, rffi.cast(MP_SIZE_T, i)))
+            for j in range(LIMB_BYTES):
+                self.body.append(chr(intmask(limb & 0xff)))
+                limb >>= 8
+
+    def write_real(self, expr):
+        value = expr.value
+        expp = lltype.malloc(MP_EXP_TP.TO, 1, flavor='raw')
+        c_mpf_get_d_2exp(expp, value)
+        exp = intmask(expp[0])
+        lltype.free(expp, flavor='raw')
+
+        # An mpf holds at most get_prec + 2 limbs of mantissa, so scaling it
+        # to `bits` bits above the binary point leaves an exact integer.
+        bits = intmask(c_mpf_get_prec(value)) + 2 * LIMB_BYTES * 8
+        shift = bits - exp
+        scaled = mpf_acquire(rffi.r_ulong(bits + LIMB_BYTES * 8))
+        if shift >= 0:
+            c_mpf_mul_2exp(scaled, value, rffi.r_ulong(shift))
+        else:
+            c_mpf_div_2exp(scaled, value, rffi.r_ulong(-shift))
+        mantissa = mpz_acquire()
+        c_mpz_set_f(mantissa, scaled)
+        mpf_release(scaled)
+
+        self.write_varint(r_uint(expr.prec))
+        self.write_varint(_zigzag(-shift))
+        self.write_mpz(mantissa)
+        mpz_release(mantissa)
+
+    def write_packed(self, expr):
+        self.write_byte(ord('r') if expr.is_real() else ord('i'))
+        self.write_varint(r_uint(len(expr.shape)))
+        for dim in expr.shape:
+            self.write_varint(r_uint(dim))
+        size = expr.get_size()
+        if expr.floats is not None:
+            for i in range(size):
+                bits = float_pack(expr.floats[expr.offset + i], 8)
+                self.write_word(r_uint(bits))
+        else:
+            assert expr.ints is not None
+            for i in range(size):
+                self.write_word(r_uint(expr.ints[expr.offset + i]))
+
+    def write(self, expr):
+        """
+        write expr in preorder, taking its parts from an explicit stack
+        """
+        stack = [expr]
+        while stack:
+            expr = stack.pop()
+            if isinstance(expr, PackedArray):
+                self.write_byte(ord('p'))
+                self.write_packed(expr)
+            elif isinstance(expr, Expression):
+                leaves = expr.get_leaves()
+                self.write_byte(ord('f'))
+                self.write_varint(r_uint(len(leaves)))
+                i = len(leaves) - 1
+                while i >= 0:
+                    stack.append(leaves[i])
+                    i -= 1
+                stack.append(expr.head)
+            else:
+                self.write_atom(expr)
+
+    def write_atom(self, expr):
+        if isinstance(expr, Symbol):
+            index = self.symbol_index.get(expr.name, -1)
+            if index < 0:
+                index = len(self.symbols)
+                self.symbols.append(expr.name)
+                self.symbol_index[expr.name] = index
+            self.write_byte(ord('S'))
+            self.write_varint(r_uint(index))
+        elif isinstance(expr, String):
+            index = self.string_index.get(expr.value, -1)
+            if index < 0:
+                index = len(self.strings)
+                self.strings.append(expr.value)
+                self.string_index[expr.value] = index
+            self.write_byte(ord('s'))
+            self.write_varint(r_uint(index))
+        elif isinstance(expr, MachineInteger):
+            self.write_byte(ord('i'))
+            self.write_varint(_zigzag(expr.intval))
+        elif isinstance(expr, BigInteger):
+            self.write_byte(ord('I'))
+            self.write_mpz(expr.value)
+        elif isinstance(expr, Rational):
+            part = mpz_acquire()
+            self.write_byte(ord('q'))
+            c_mpq_get_num(part, expr.value)
+            self.write_mpz(part)
+            c_mpq_get_den(part, expr.value)
+            self.write_mpz(part)
+            mpz_release(part)
+        elif isinstance(expr, Real):
+            self.write_byte(ord('r'))
+            self.write_real(expr)
+        elif isinstance(expr, Complex):
+            raise ValueError("cannot serialize Complex numbers")
+        else:
+            raise ValueError("cannot serialize %s" % expr.repr())
+
+    def getvalue(self):
+        header = StringBuilder()
+        header.append(MAGIC)
+        header.append(chr(VERSION))
+        body = self.body.build()
+        self.body = header
+        for table in [self.symbols, self.strings]:
+            self.write_varint(r_uint(len(table)))
+            for item in table:
+                self.write_varint(r_uint(len(item)))
+                self.body.append(item)
+        self.body.append(body)
+        return self.body.build()
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.symbols = []
+        self.strings = []
+
+    def read_byte(self):
+        if self.pos >= len(self.data):
+            raise ValueError("truncated data")
+        byte = ord(self.data[self.pos])
+        self.pos += 1
+        return byte
+
+    def read_bytes(self, n):
+        start = self.pos
+        stop = start + n
+        if n < 0 or stop > len(self.data):
+            raise ValueError("truncated data")
+        assert start >= 0 and stop >= 0
+        self.pos = stop
+        return self.data[start:stop]
+
+    def read_varint(self):
+        result = r_uint(0)
+        shift = 0
+        while True:
+            if shift >= LONG_BIT:
+                raise ValueError("malformed varint")
+            byte = self.read_byte()
+            result |= r_uint(byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read_count(self):
+        value = intmask(self.read_varint())
+        if value < 0:
+            raise ValueError("malformed count")
+        return value
+
+    def read_word(self):
+        result = r_uint(0)
+        for i in range(8):
+            result |= r_uint(self.read_byte()) << (8 * i)
+        return result
+
+    def read_mpz(self, dest):
+        sign = self.read_byte()
+        if sign == 0:
+            c_mpz_set_si(dest, 0)
+            return
+        if sign > 2:
+            raise ValueError("malformed integer sign")
+        n = self.read_count()
+        p = rffi.str2charp(self.read_bytes(n))
+        c_mpz_import(dest, rffi.r_size_t(n), rffi.r_int(-1),
+                     rffi.r_size_t(1), rffi.r_int(0), rffi.r_size_t(0), p)
+        rffi.free_charp(p)
+        if sign == 2:
+            c_mpz_neg(dest, dest)
+
+    def read_real(self):
+        prec = self.read_count()
+        shift = _unzigzag(self.read_varint())
+        mantissa = mpz_acquire()
+        self.read_mpz(mantissa)
+        bits = intmask(c_mpz_sizeinbase(mantissa, rffi.r_int(2)))
+        scaled = mpf_acquire(rffi.r_ulong(bits + 64))
+        c_mpf_set_z(scaled, mantissa)
+        mpz_release(mantissa)
+        if shift >= 0:
+            c_mpf_mul_2exp(scaled, scaled, rffi.r_ulong(shift))
+        else:
+            c_mpf_div_2exp(scaled, scaled, rffi.r_ulong(-shift))
+        result = Real(prec)
+        c_mpf_set(result.value, scaled)
+        mpf_release(scaled)
+        return result
+
+    def read_packed(self):
+        kind = self.read_byte()
+        if kind != ord('i') and kind != ord('r'):
+            raise ValueError("malformed packed array")
+        rank = self.read_count()
+        if rank == 0:
+            raise ValueError("malformed packed array")
+        shape = []
+        size = 1
+        for i in range(rank):
+            dim = self.read_count()
+            shape.append(dim)
+            try:
+                size = ovfcheck(size * dim)
+            except OverflowError:
+                raise ValueError("malformed packed array")
+        if size > (len(self.data) - self.pos) // 8:
+            raise ValueError("truncated data")
+        if kind == ord('r'):
+            floats = [float_unpack(self.read_word(), 8) for i in range(size)]
+            return PackedArray(shape, None, floats)
+        ints = [intmask(self.read_word()) for i in range(size)]
+        return PackedArray(shape, ints, None)
+
+    def read_table(self):
+        table = []
+        for i in range(self.read_count()):
+            table.append(self.read_bytes(self.read_count()))
+        return table
+
+    def read(self):
+        """
+        read an expression written by `_Writer.write`
+
+        The expressions under construction are kept on explicit stacks: the
+        parts read so far, head first, and the number of parts expected.
+        """
+        parts_stack = []
+        counts = []
+        while True:
+            tag = chr(self.read_byte())
+            if tag == 'f':
+                counts.append(self.read_count() + 1)
+                parts_stack.append([])
+                continue
+            expr = self.read_atom(tag)
+            while parts_stack:
+                parts = parts_stack[-1]
+                parts.append(expr)
+                if len(parts) < counts[-1]:
+                    break
+                parts_stack.pop()
+                counts.pop()
+                expr = Expression(parts[0])
+                expr.set_leaves(parts[1:])
+            if not parts_stack:
+                return expr
+
+    def read_atom(self, tag):
+        if tag == 'S':
+            index = self.read_count()
+            if index >= len(self.symbols):
+                raise ValueError("symbol index out of range")
+            return Symbol.intern(self.symbols[index])
+        elif tag == 's':
+            index = self.read_count()
+            if index >= len(self.strings):
+                raise ValueError("string index out of range")
+            return String(self.strings[index])
+        elif tag == 'i':
+            return MachineInteger(_unzigzag(self.read_varint()))
+        elif tag == 'I':
+            big = BigInteger()
+            self.read_mpz(big.value)
+            return big.normalize()
+        elif tag == 'q':
+            rational = Rational()
+            part = mpz_acquire()
+            self.read_mpz(part)
+            c_mpq_set_num(rational.value, part)
+            self.read_mpz(part)
+            if c_mpz_cmp_si(part, 0) <= 0:
+                mpz_release(part)
+                raise ValueError("malformed rational")
+            c_mpq_set_den(rational.value, part)
+            mpz_release(part)
+            c_mpq_canonicalize(rational.value)
+            return rational
+        elif tag == 'r':
+            return self.read_real()
+        elif tag == 'p':
+            return self.read_packed()
+        raise ValueError("unknown tag %s" % tag)
+
+
+def dumps(expr):
+    """
+    serialize an expression to a byte string
+    """
+    assert isinstance(expr, BaseExpression)
+    writer = _Writer()
+    writer.write(expr)
+    return writer.getvalue()
+
+
+def loads(data):
+    """
+    rebuild an expression serialized with `dumps`
+
+    raises ValueError if `data` is malformed
+    """
+    reader = _Reader(data)
+    if reader.read_bytes(len(MAGIC)) != MAGIC:
+        raise ValueError("not a serialized expression")
+    if reader.read_byte() != VERSION:
+        raise ValueError("unsupported serialization version")
+    reader.symbols = reader.read_table()
+    reader.strings = reader.read_table()
+    result = reader.read()
+    if reader.pos != len(data):
+        raise ValueError("trailing data")
+    return result
@@ -2,10 +2,19 @@
 A collection of functions for transforming expression trees
 """
 
-from rmathics.expression import BaseExpression, Expression, Symbol
+from rpython.rlib.listsort import make_timsort_class
+
+from rmathics.expression import (
+    BaseExpression, Expression, PackedArray, Symbol, SymbolList, compare)
 from rmathics.rpython_util import all
 
 
+def _canonical_lt(expr1, expr2):
+    return compare(expr1, expr2) < 0
+
+CanonicalSort = make_timsort_class(lt=_canonical_lt)
+
+
 def flatten(expr, depth=-1, head=None):
     """
     flattens an Expression
@@ -21,56 +30,63 @@ def flatten(expr, depth=-1, head=None):
     assert isinstance(head, BaseExpression)     # head could be Expression
 
     leaves = []
-    for leaf in expr.leaves:
+    changed = False
+    for leaf in expr.get_leaves():
         if leaf.head.same(head):
             assert isinstance(leaf, Expression)
-            for leaf2 in leaf.leaves:
+            changed = True
+            for leaf2 in leaf.get_leaves():
                 if isinstance(leaf2, Expression):
                     leaves.append(flatten(leaf2, head=head, depth=depth-1))
                 else:
                     leaves.append(leaf2)
         else:
             if isinstance(leaf, Expression):
-                leaves.append(flatten(leaf, head=head, depth=depth-1))
+                new_leaf = flatten(leaf, head=head, depth=depth-1)
+                if new_leaf is not leaf:
+                    changed = True
+                leaves.append(new_leaf)
             else:
                 leaves.append(leaf)
-    expr = Expression(head)
-    expr.leaves = leaves
-    return expr
+    if not changed:
+        return expr     # already flat
+    result = Expression(expr.head)
+    result.set_leaves(leaves)
+    return result
 
 
-def thread(expr, head=Symbol('System`List')):
+def thread(expr, evaluation, head=SymbolList):
     """
     threads an Expression
       - given expr=f[args], thread over args whose head matches head
       - args whose heads don't match are repeated
+      - messages are reported to evaluation
     """
     assert isinstance(expr, Expression)
     assert isinstance(head, BaseExpression)
 
-    messages = []
-    args = expr.leaves
+    args = expr.get_leaves()
     exprhead = expr.head
 
     # indices of args with matching heads
     match_indices = [i for i, arg in enumerate(args) if arg.head.same(head)]
 
     if match_indices == []:     # nothing to thread over
-        return expr, messages
+        return expr
     else:
-        thread_len = len(args[match_indices[0]].leaves)
+        thread_len = len(args[match_indices[0]].get_leaves())
 
     # check all matching args have the same length
     for i in match_indices:
-        if len(args[i].leaves) != thread_len:
-            messages.append(('Thread', 'tdlen'))
-            return expr, messages
+        if len(args[i].get_leaves()) != thread_len:
+            evaluation.message('Thread', 'tdlen')
+            return expr
 
     # args with heads that don't match are repeated thread_len times
     new_args = []
     for i, arg in enumerate(args):
         if i in match_indices:
-            new_args.append(arg.leaves)
+            new_args.append(arg.get_leaves())
         else:
             new_args.append(thread_len * [arg])
 
@@ -80,12 +96,88 @@ def thread(expr, head=Symbol('System`List')):
     leaves = []
     for i in range(thread_len):
         expr = Expression(exprhead)
-        expr.leaves = [arg[i] for arg in new_args]
+        expr.set_leaves([arg[i] for arg in new_args])
         leaves.append(expr)
     result = Expression(head)
-    result.leaves = leaves
-    return result, messages
+    result.set_leaves(leaves)
+    return result
 
 
 def sort(expr):
-    return expr
+    """
+    sorts the leaves of an Expression into canonical order
+    """
+    assert isinstance(expr, Expression)
+    leaves = expr.get_leaves()
+    for i in range(len(leaves) - 1):
+        if compare(leaves[i], leaves[i + 1]) > 0:
+            break
+    else:
+        return expr     # already sorted
+    leaves = list(leaves)
+    CanonicalSort(leaves).sort()
+    result = Expression(expr.head)
+    result.set_leaves(leaves)
+    return result
+
+
+def substitute(expr, mapping):
+    """
+    replaces the symbols named in mapping {str: BaseExpression} throughout
+    expr, as the right hand side of a rule
+
+    subexpressions without any such symbol are kept, not copied. The
+    expressions under construction are kept on explicit stacks, so deeply
+    nested expressions do not exhaust the native stack.
+    """
+    # each pending expression, with its head and the leaves substituted so
+    # far (the head first)
+    sources = []
+    parts_stack = []
+    while True:
+        result = _substitute_atom(expr, mapping)
+        if result is None:
+            sources.append(expr)
+            parts_stack.append([])
+            expr = expr.head
+            continue
+        while sources:
+            source = sources[-1]
+            parts = parts_stack[-1]
+            parts.append(result)
+            if len(parts) <= len(source.leaves):
+                break
+            sources.pop()
+            parts_stack.pop()
+            result = _rebuild(source, parts)
+        if not sources:
+            return result
+        expr = sources[-1].leaves[len(parts_stack[-1]) - 1]
+
+
+def _substitute_atom(expr, mapping):
+    """
+    expr with the symbols in mapping replaced, or None if it is an
+    expression whose parts need substituting
+    """
+    if isinstance(expr, Symbol):
+        return mapping.get(expr.get_name(), expr)
+    if not isinstance(expr, Expression) or isinstance(expr, PackedArray):
+        return expr
+    return None
+
+
+def _rebuild(source, parts):
+    """
+    source with the head and leaves `parts`, or source itself if they are
+    unchanged
+    """
+    changed = parts[0] is not source.head
+    for i in range(len(source.leaves)):
+        if parts[i + 1] is not source.leaves[i]:
+            changed = True
+    if not changed:
+        return source
+    result = Expression(parts[0])
+    result.set_leaves(parts[1:])
+    return result
@@ -0,0 +1,172 @@
+"""
+Translation smoke test, annotated and rtyped by `make check` and built by
+`make smoke`. It needs no parser, so it also covers the core when the parser
+cannot be translated.
+
+    bin/smoke [steps]
+
+runs a few checks of evaluation, pattern matching, the rule index, the
+profiler and serialization, printing any which fail, then times a numeric
+loop of `steps` rule rewrites.
+"""
+import os
+import sys
+import time
+
+from rmathics.expression import (
+    Expression, Symbol, String, MachineInteger, SymbolList, SymbolPlus,
+    SymbolPattern, SymbolBlank, SymbolBlankSequence, SymbolInteger,
+    machine_real, pack)
+from rmathics.convert import int2Rational, str2Real
+from rmathics.evaluation import evaluate, Evaluation
+from rmathics.definitions import Definitions
+from rmathics.printer import fullform
+from rmathics.profiler import profiler
+from rmathics.pattern import match
+from rmathics.serialize import dumps, loads
+from rmathics.transformations import substitute
+
+# deep enough to overflow the native stack of a recursive walk
+NESTING = 100000
+
+SymbolLoop = Symbol.intern('Global`loop')
+
+
+def make_list(leaves):
+    result = Expression(SymbolList)
+    result.set_leaves(leaves)
+    return result
+
+
+def check(name, got, expected):
+    if got == expected:
+        return True
+    os.write(2, '%s: got %s, expected %s\n' % (name, got, expected))
+    return False
+
+
+def check_evaluation():
+    f = Symbol.intern('Global`f')
+    x = Symbol.intern('Global`x')
+    definitions = Definitions()
+    # enough rules for the DownValues of f to be indexed
+    for i in range(20):
+        definitions.add_downvalue(
+            'Global`f', Expression(f, MachineInteger(i)), MachineInteger(i * i))
+    definitions.add_downvalue(
+        'Global`f', Expression(f, Expression(SymbolPattern, x,
+                                             Expression(SymbolBlank))), x)
+    leaves = [MachineInteger(1), int2Rational(1, 3), machine_real(0.5),
+              str2Real('1.5', 100), String('s'),
+              Expression(f, MachineInteger(3)), Expression(f, String('t'))]
+    expr = make_list([Expression(SymbolPlus, leaf, leaf) for leaf in leaves])
+    profiler.start()
+    result = evaluate(expr, Evaluation(definitions))
+    profiler.stop()
+    ok = check('evaluate', fullform(result),
+               'System`List[2, 2/3, 1., 3., System`Plus["s", "s"], 18, '
+               'System`Plus["t", "t"]]')
+    if profiler.signatures_checked == 0:
+        os.write(2, 'profile: no signatures checked\n')
+        ok = False
+
+    pattern = Expression(f, Expression(
+        SymbolPattern, x, Expression(SymbolBlankSequence, SymbolInteger)))
+    matched, mapping = match(
+        Expression(f, MachineInteger(1), MachineInteger(2)), pattern,
+        definitions)
+    if not matched or 'Global`x' not in mapping:
+        os.write(2, 'match: f[1, 2] does not match f[x__Integer]\n')
+        ok = False
+    return ok
+
+
+def check_serialize():
+    ints = make_list([MachineInteger(i) for i in range(5)])
+    floats = make_list([machine_real(0.5 * i) for i in range(5)])
+    expr = make_list([pack(ints), pack(floats), str2Real('0.1', 200),
+                      int2Rational(-7, 3), String('s')])
+    result = loads(dumps(expr))
+    ok = check('serialize', fullform(result), fullform(expr))
+    if not result.identical(expr):
+        os.write(2, 'serialize: result is not identical\n')
+        ok = False
+    return ok
+
+
+def check_nesting():
+    f = Symbol.intern('Global`f')
+    x = Symbol.intern('Global`x')
+    expr = x
+    for i in range(NESTING):
+        expr = Expression(f, expr, MachineInteger(i))
+    ok = check('depth', '%d' % expr.get_depth(), '%d' % (NESTING + 1))
+    copy = loads(dumps(expr))
+    if not (copy.identical(expr) and copy.get_hash() == expr.get_hash()):
+        os.write(2, 'nesting: serialized copy differs\n')
+        ok = False
+    replaced = substitute(expr, {'Global`x': MachineInteger(0)})
+    if replaced.same(expr) or substitute(replaced, {}) is not replaced:
+        os.write(2, 'nesting: substitute\n')
+        ok = False
+    return ok
+
+
+def define_loop(definitions):
+    """
+    loop[0, acc_] :> acc and loop[n_, acc_] :> loop[n + -1, acc + n], so
+    that loop[n, 0] adds up 1, ..., n with one rewrite per step
+    """
+    n = Symbol.intern('Global`n')
+    acc = Symbol.intern('Global`acc')
+    acc_ = Expression(SymbolPattern, acc, Expression(SymbolBlank))
+    n_ = Expression(SymbolPattern, n, Expression(SymbolBlank))
+    definitions.add_downvalue(
+        'Global`loop', Expression(SymbolLoop, MachineInteger(0), acc_), acc)
+    definitions.add_downvalue(
+        'Global`loop', Expression(SymbolLoop, n_, acc_),
+        Expression(SymbolLoop, Expression(SymbolPlus, n, MachineInteger(-1)),
+                   Expression(SymbolPlus, acc, n)))
+    definitions.set_ownvalues('System`$IterationLimit',
+                              Symbol.intern('System`Infinity'))
+
+
+def entry_point(argv):
+    if len(argv) > 2:
+        os.write(2, 'usage: %s [steps]\n' % argv[0])
+        return 1
+    steps = 1
+    if len(argv) == 2:
+        steps = int(argv[1])
+
+    ok = check_evaluation()
+    ok = check_serialize() and ok
+    ok = check_nesting() and ok
+    if not ok:
+        return 1
+
+    # one Definitions throughout, so that its version stays the same and
+    # the JIT can fold the lookups keyed on it
+    definitions = Definitions()
+    define_loop(definitions)
+    expr = Expression(SymbolLoop, MachineInteger(steps), MachineInteger(0))
+    start = time.time()
+    result = evaluate(expr, Evaluation(definitions))
+    elapsed = time.time() - start
+
+    os.write(1, '%s\n' % result.repr())
+    os.write(1, '%d steps in %f s\n' % (steps, elapsed))
+    return 0
+
+
+def target(*args):
+    return entry_point, None
+
+
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
+
+if __name__ == "__main__":
+    entry_point(sys.argv)